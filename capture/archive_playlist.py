@@ -0,0 +1,199 @@
+"""滚动归档播放列表
+HLS 复用器只维护一个固定窗口的 video.m3u8，归档由本模块按固定时长切分为多个子播放列表
+(archive_<首个切片编号>.m3u8)，每个切片只追加写入两行，并由 archive_index.json 记录各子列表，
+客户端可以只拉取需要的时间段
+"""
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+import json
+import re
+import time
+
+
+INDEX_NAME = 'archive_index.json'
+ENTRY_PATTERN = re.compile(r'video_(\d+)\.ts\s*$')
+EXTINF_PATTERN = re.compile(r'^#EXTINF:([0-9.]+)')
+
+
+def parse_playlist_entries(text: str) -> List[Tuple[int, float]]:
+    """
+    解析 m3u8 文本中的切片条目
+
+    Returns:
+        list: [(切片编号, 时长秒), ...]，不完整的末尾条目会被忽略
+    """
+    entries = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        m = EXTINF_PATTERN.match(line)
+        if m:
+            try:
+                duration = float(m.group(1))
+            except ValueError:
+                duration = None
+            continue
+        if line.startswith('#') or not line:
+            continue
+        m = ENTRY_PATTERN.search(line)
+        if m and duration is not None:
+            entries.append((int(m.group(1)), duration))
+        duration = None
+    return entries
+
+
+class ArchivePlaylist:
+    """
+    按固定时长滚动的归档播放列表
+
+    Args:
+        output_path: 录制器的输出目录
+        chunk_duration: 每个子播放列表覆盖的时长（秒）
+        target_duration: 子播放列表声明的 EXT-X-TARGETDURATION
+    """
+
+    def __init__(self, output_path: Path, chunk_duration: float = 3600.0, target_duration: int = 4):
+        self.output_path = Path(output_path)
+        self.chunk_duration = chunk_duration
+        self.target_duration = target_duration
+        self.index_path = self.output_path / INDEX_NAME
+        self.chunks: List[Dict] = []
+        self.last_segment: Optional[int] = None
+        # 新会话的第一个切片前需要插入不连续标记
+        self._discontinuity = False
+        self._lock = Lock()
+        self._load_index()
+
+    def _load_index(self):
+        if not self.index_path.exists():
+            return
+        try:
+            index = json.loads(self.index_path.read_text(encoding='utf-8'))
+            self.chunks = index.get('chunks', [])
+        except Exception:
+            self.chunks = []
+        if self.chunks:
+            self.last_segment = self.chunks[-1].get('last_segment')
+            self._discontinuity = True
+
+    def _write_index(self):
+        index = {'target_duration': self.target_duration, 'chunks': self.chunks}
+        tmp_path = self.index_path.with_suffix('.json.tmp')
+        tmp_path.write_text(json.dumps(index, ensure_ascii=False), encoding='utf-8')
+        tmp_path.replace(self.index_path)
+
+    @property
+    def current_chunk(self) -> Optional[Dict]:
+        if self.chunks and not self.chunks[-1].get('ended'):
+            return self.chunks[-1]
+        return None
+
+    def _start_chunk(self, first_segment: int) -> Dict:
+        chunk = {
+            'playlist': f'archive_{first_segment}.m3u8',
+            'first_segment': first_segment,
+            'last_segment': None,
+            'segments': 0,
+            'duration': 0.0,
+            'start_time': time.time(),
+            'ended': False,
+        }
+        header = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            f"#EXT-X-MEDIA-SEQUENCE:{first_segment}",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+        ]
+        with open(self.output_path / chunk['playlist'], 'w', encoding='utf-8') as f:
+            f.write("\n".join(header) + "\n")
+        self.chunks.append(chunk)
+        # 新的子列表从头开始，不需要不连续标记
+        self._discontinuity = False
+        return chunk
+
+    def _end_chunk(self, chunk: Dict):
+        with open(self.output_path / chunk['playlist'], 'a', encoding='utf-8') as f:
+            f.write("#EXT-X-ENDLIST\n")
+        chunk['ended'] = True
+
+    def append(self, entries: List[Tuple[int, float]]) -> int:
+        """
+        追加已完成的切片条目，已归档的编号会被跳过
+
+        Returns:
+            int: 实际追加的条目数
+        """
+        with self._lock:
+            return self._append(entries)
+
+    def _append(self, entries: List[Tuple[int, float]]) -> int:
+        added = 0
+        for number, duration in entries:
+            if self.last_segment is not None and number <= self.last_segment:
+                continue
+            chunk = self.current_chunk
+            if chunk and chunk['duration'] >= self.chunk_duration:
+                self._end_chunk(chunk)
+                chunk = None
+            if chunk is None:
+                chunk = self._start_chunk(number)
+            lines = []
+            # 编号不连续（窗口外丢失或录制重启）时插入不连续标记
+            if self._discontinuity or (chunk['segments'] and number != self.last_segment + 1):
+                lines.append("#EXT-X-DISCONTINUITY")
+                self._discontinuity = False
+            lines.append(f"#EXTINF:{duration:.6f},")
+            lines.append(f"video_{number}.ts")
+            with open(self.output_path / chunk['playlist'], 'a', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+            chunk['last_segment'] = number
+            chunk['segments'] += 1
+            chunk['duration'] += duration
+            self.last_segment = number
+            added += 1
+        if added:
+            self._write_index()
+        return added
+
+    def mark_discontinuity(self):
+        """编码器重新启动时调用，下一个追加到当前子列表的切片前插入不连续标记"""
+        with self._lock:
+            self._discontinuity = True
+
+    def ended_chunks(self) -> List[Dict]:
+        """返回已结束（不会再追加）的子列表信息副本"""
+        with self._lock:
+            return [dict(c) for c in self.chunks if c.get('ended')]
+
+    def mark_chunk(self, playlist: str, **fields):
+        """为已结束的子列表记录后台任务的处理状态（例如 reencoded=True）"""
+        with self._lock:
+            for chunk in self.chunks:
+                if chunk['playlist'] == playlist and chunk.get('ended'):
+                    chunk.update(fields)
+            self._write_index()
+
+    def drop_chunk(self, playlist: str):
+        """删除一个已结束的子列表（保留策略清理其切片后调用）"""
+        with self._lock:
+            self.chunks = [c for c in self.chunks if not (c['playlist'] == playlist and c.get('ended'))]
+            (self.output_path / playlist).unlink(missing_ok=True)
+            self._write_index()
+
+    def sync_from_playlist(self, playlist_path: Path) -> int:
+        """读取复用器的窗口播放列表，把新完成的切片追加到归档"""
+        try:
+            text = Path(playlist_path).read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return 0
+        return self.append(parse_playlist_entries(text))
+
+    def close(self):
+        """结束当前子播放列表，下次录制从新的子列表开始"""
+        with self._lock:
+            chunk = self.current_chunk
+            if chunk:
+                self._end_chunk(chunk)
+                self._write_index()
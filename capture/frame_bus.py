@@ -0,0 +1,38 @@
+"""录制器最新帧的共享出口
+录制线程每采集一帧就把帧的引用（不复制）连同递增序号发布到 FrameBus，截图等消费者按需读取最新帧，
+没有消费者时不产生任何额外开销。序号用于消费者判断帧是否变化（缓存、ETag）。
+序号在每个 FrameBus（即每个录制器实例）中从 1 开始，消费者需要同时使用 epoch 区分不同实例
+"""
+from threading import Lock
+from typing import NamedTuple, Optional
+import time
+
+import numpy as np
+
+
+class Frame(NamedTuple):
+    seq: int
+    timestamp: float
+    # BGR 格式，消费者只读，不得原地修改
+    image: np.ndarray
+    # 发布该帧的 FrameBus 实例标识
+    epoch: str
+
+
+class FrameBus:
+    def __init__(self):
+        self._lock = Lock()
+        self._latest: Optional[Frame] = None
+        self._seq = 0
+        # 实例创建时间，同名录制器重启或进程重启后序号重新计数，用它区分
+        self.epoch = f'{time.time_ns():x}'
+
+    def publish(self, image: np.ndarray):
+        """发布新采集的一帧，只保存引用"""
+        with self._lock:
+            self._seq += 1
+            self._latest = Frame(self._seq, time.time(), image, self.epoch)
+
+    def latest(self) -> Optional[Frame]:
+        with self._lock:
+            return self._latest
@@ -0,0 +1,356 @@
+"""低延迟直播：把录制编码器输出的数据包封装为分片 MP4 (fMP4) 推送给订阅者
+录制线程只把编码后的数据包复制一份放入队列（不阻塞），由独立线程统一封装一次 fMP4，
+再把同一份分片字节分发给所有订阅者：
+- 始终缓存最近一个 GOP，新订阅者先收到初始化段，再从最新关键帧开始播放
+- 每个订阅者有独立的待发送字节上限，超出时丢弃积压并等待下一个关键帧，慢速观看者不会拖慢录制或其他观看者
+- 没有订阅者时不进行封装
+"""
+from collections import deque
+from fractions import Fraction
+from threading import Thread, Lock
+from typing import NamedTuple, Optional
+import asyncio
+import queue
+import struct
+
+import av
+
+from utils.logger import getLogger
+
+
+logger = getLogger("recorder.live_stream")
+
+# 每帧一个分片，使浏览器 MSE 可以逐帧追加；delay_moov 使 moov 中带有从首个数据包提取的 SPS/PPS
+FMP4_OPTIONS = {'movflags': 'frag_every_frame+empty_moov+delay_moov+default_base_moof'}
+
+
+class EncodedPacket(NamedTuple):
+    """编码器输出数据包的独立副本，可跨线程保存"""
+    data: bytes
+    pts: Optional[int]
+    dts: Optional[int]
+    duration: int
+    time_base: Fraction
+    keyframe: bool
+
+    @classmethod
+    def from_av(cls, packet: av.Packet) -> 'EncodedPacket':
+        return cls(bytes(packet), packet.pts, packet.dts, packet.duration or 0, packet.time_base, packet.is_keyframe)
+
+    @property
+    def seconds(self) -> float:
+        return float((self.pts or 0) * self.time_base)
+
+    def to_av(self, stream) -> av.Packet:
+        packet = av.Packet(self.data)
+        packet.pts = self.pts
+        packet.dts = self.dts
+        packet.duration = self.duration
+        packet.time_base = self.time_base
+        packet.is_keyframe = self.keyframe
+        packet.stream = stream
+        return packet
+
+
+def add_stream_like(container, template):
+    """按录制流的编码参数添加一个只用于复用的输出流（兼容新旧 PyAV 接口）"""
+    if hasattr(container, 'add_stream_from_template'):
+        return container.add_stream_from_template(template)
+    return container.add_stream(template=template)
+
+
+def codec_mime(init: bytes) -> str:
+    """从初始化段的 avcC 盒中读取 profile/level，生成 MSE 需要的 MIME 类型"""
+    pos = init.find(b'avcC')
+    if pos < 0 or len(init) < pos + 8:
+        return 'video/mp4'
+    profile, compat, level = init[pos + 5:pos + 8]
+    return f'video/mp4; codecs="avc1.{profile:02x}{compat:02x}{level:02x}"'
+
+
+class FragmentSplitter:
+    """fMP4 复用器的输出文件对象，把顶层盒切分为初始化段 (ftyp+moov) 和媒体分片 (moof+mdat)"""
+
+    def __init__(self, on_init, on_fragment):
+        self.on_init = on_init
+        self.on_fragment = on_fragment
+        self._buffer = bytearray()
+        self._group = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= 8:
+            size, box_type = struct.unpack('>I4s', self._buffer[:8])
+            if size == 1:
+                if len(self._buffer) < 16:
+                    break
+                size = struct.unpack('>Q', self._buffer[8:16])[0]
+            if size < 8 or len(self._buffer) < size:
+                break
+            self._group += self._buffer[:size]
+            del self._buffer[:size]
+            if box_type == b'moov':
+                self.on_init(bytes(self._group))
+                self._group.clear()
+            elif box_type == b'mdat':
+                self.on_fragment(bytes(self._group))
+                self._group.clear()
+        return len(data)
+
+    # 不提供 seek，复用器把输出视为不可回写的流，分片模式只顺序写入
+    def flush(self):
+        pass
+
+
+class LiveSubscriber:
+    """一个观看者的发送队列，由封装线程写入，由事件循环读取"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_pending_bytes: int):
+        self.loop = loop
+        self.max_pending_bytes = max_pending_bytes
+        self.init: Optional[bytes] = None
+        self._init_sent = False
+        self._queue: deque[bytes] = deque()
+        self._pending = 0
+        self._lock = Lock()
+        self._event = asyncio.Event()
+        self.waiting_keyframe = False
+        self.dropped = 0
+        self.closed = False
+
+    def _notify(self):
+        try:
+            self.loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # 事件循环已关闭
+            self.closed = True
+
+    def push_init(self, init: bytes):
+        """设置（或在编码会话重建后替换）初始化段，之后只接受从关键帧开始的分片"""
+        with self._lock:
+            self.init = init
+            self._init_sent = False
+            self._queue.clear()
+            self._pending = 0
+            self.waiting_keyframe = True
+        self._notify()
+
+    def push(self, fragment: bytes, keyframe: bool):
+        with self._lock:
+            if self.waiting_keyframe:
+                if not keyframe:
+                    return
+                self.waiting_keyframe = False
+            if self._pending + len(fragment) > self.max_pending_bytes:
+                # 积压过多：丢弃全部待发送分片，从下一个关键帧重新开始
+                self._queue.clear()
+                self._pending = 0
+                self.dropped += 1
+                if not keyframe:
+                    self.waiting_keyframe = True
+                    return
+            self._queue.append(fragment)
+            self._pending += len(fragment)
+        self._notify()
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    async def get(self) -> Optional[bytes]:
+        """返回下一块待发送数据：先是初始化段，之后是合并的分片；直播结束时返回 None"""
+        while True:
+            with self._lock:
+                if self.init is not None and not self._init_sent:
+                    self._init_sent = True
+                    return self.init
+                if self._queue and self._init_sent:
+                    data = b''.join(self._queue)
+                    self._queue.clear()
+                    self._pending = 0
+                    return data
+            if self.closed:
+                return None
+            await self._event.wait()
+            self._event.clear()
+
+
+class LiveStreamHub:
+    def __init__(self, name: str, max_pending_bytes: int = 4 * 1024 * 1024, max_queued_packets: int = 240):
+        """
+        name: 录制器名称
+        max_pending_bytes: 单个订阅者允许积压的最大字节数
+        max_queued_packets: 录制线程到封装线程的队列长度，溢出时丢包并在下一个关键帧重新同步
+        """
+        self.name = name
+        self.max_pending_bytes = max_pending_bytes
+        self._packets: queue.Queue = queue.Queue(maxsize=max_queued_packets)
+        self._lock = Lock()
+        self._subscribers: list[LiveSubscriber] = []
+        self._template = None
+        self._container = None
+        self._out_stream = None
+        # 最近一个 GOP 的数据包（用于启动封装）与分片（用于新订阅者）
+        self._gop: list[EncodedPacket] = []
+        self._init: Optional[bytes] = None
+        self._fragment_gop: list[tuple[bytes, bool]] = []
+        self._keyframe_flags: deque[bool] = deque()
+        self._resync = False
+        self._thread: Optional[Thread] = None
+        self._closed = False
+
+    def attach(self, stream):
+        """录制器开始新的编码会话时调用，stream 为录制编码流"""
+        with self._lock:
+            self._closed = False
+        self._packets.put(('attach', stream))
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, name=f"live-{self.name}", daemon=True)
+            self._thread.start()
+
+    def publish(self, packet: EncodedPacket):
+        """录制线程调用，必须立即返回；队列已满时丢弃数据包，直到下一个关键帧处重新同步"""
+        if self._thread is None:
+            return
+        if self._resync and not packet.keyframe:
+            return
+        kind = 'resync' if self._resync else 'packet'
+        try:
+            self._packets.put_nowait((kind, packet))
+            self._resync = False
+        except queue.Full:
+            self._resync = True
+
+    def close(self):
+        """结束直播并关闭所有订阅，可重复调用"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is None:
+            self._close_subscribers()
+            return
+        try:
+            self._packets.put_nowait(('close', None))
+        except queue.Full:
+            # 封装线程卡住时仍要结束所有订阅
+            self._close_subscribers()
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop) -> LiveSubscriber:
+        sub = LiveSubscriber(loop, self.max_pending_bytes)
+        with self._lock:
+            if self._closed:
+                # 录制已停止：订阅者立即收到结束
+                sub.close()
+                return sub
+            if self._init is not None:
+                sub.push_init(self._init)
+                for fragment, keyframe in self._fragment_gop:
+                    sub.push(fragment, keyframe)
+            self._subscribers.append(sub)
+            count = len(self._subscribers)
+        logger.info("%s 新增直播订阅者，当前 %d 个", self.name, count)
+        return sub
+
+    def unsubscribe(self, sub: LiveSubscriber):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            remaining = len(self._subscribers)
+        sub.close()
+        logger.info("%s 直播订阅者离开（丢弃积压 %d 次），剩余 %d 个", self.name, sub.dropped, remaining)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def _close_subscribers(self):
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for sub in subscribers:
+            sub.close()
+
+    def _run(self):
+        while True:
+            kind, item = self._packets.get()
+            try:
+                if kind == 'close':
+                    self._close_muxer()
+                    self._close_subscribers()
+                    self._thread = None
+                    return
+                if kind == 'attach':
+                    self._close_muxer()
+                    self._template = item
+                    self._gop = []
+                    continue
+                if kind == 'resync':
+                    # 之前有数据包被丢弃，时间线已不连续，重建封装
+                    self._close_muxer()
+                self._handle_packet(item)
+            except Exception as e:
+                logger.error(f"{self.name} 直播封装失败: {e}", exc_info=True)
+                self._close_muxer()
+
+    def _handle_packet(self, packet: EncodedPacket):
+        if packet.keyframe:
+            self._gop = [packet]
+        elif self._gop:
+            self._gop.append(packet)
+        else:
+            return
+
+        if not self.subscriber_count():
+            self._close_muxer()
+            return
+        if self._container is None:
+            self._open_muxer()
+            for p in self._gop:
+                self._mux(p)
+        else:
+            self._mux(packet)
+
+    def _open_muxer(self):
+        splitter = FragmentSplitter(self._on_init, self._on_fragment)
+        self._container = av.open(splitter, mode='w', format='mp4', options=FMP4_OPTIONS)
+        self._out_stream = add_stream_like(self._container, self._template)
+        self._keyframe_flags.clear()
+        logger.debug("%s 直播 fMP4 封装已启动", self.name)
+
+    def _close_muxer(self):
+        if self._container is None:
+            return
+        container, self._container = self._container, None
+        try:
+            container.close()
+        except Exception:
+            # 不可回写的输出在结束时报错属正常情况
+            pass
+        self._out_stream = None
+        with self._lock:
+            self._init = None
+            self._fragment_gop = []
+
+    def _mux(self, packet: EncodedPacket):
+        self._keyframe_flags.append(packet.keyframe)
+        self._container.mux(packet.to_av(self._out_stream))
+
+    def _on_init(self, init: bytes):
+        with self._lock:
+            self._init = init
+            self._fragment_gop = []
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.push_init(init)
+
+    def _on_fragment(self, fragment: bytes):
+        # 每帧一个分片，分片与送入的数据包一一对应
+        keyframe = self._keyframe_flags.popleft() if self._keyframe_flags else False
+        with self._lock:
+            if keyframe:
+                self._fragment_gop = [(fragment, True)]
+            elif self._fragment_gop:
+                self._fragment_gop.append((fragment, False))
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.push(fragment, keyframe)
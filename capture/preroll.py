@@ -0,0 +1,96 @@
+"""内存预录缓冲（即时回放）
+录制器把最近的编码数据包保存在按时长和字节数限制的环形缓冲中，需要"最近 N 秒"时直接在内存中
+从关键帧开始封装为可播放的片段，不读取磁盘切片，也不需要手工拼接播放列表
+"""
+from collections import deque
+from threading import Lock
+from typing import Optional
+import io
+
+import av
+
+from capture.live_stream import EncodedPacket, add_stream_like
+
+
+# 封装格式 -> (复用器名称, 复用器参数, MIME 类型)
+# 片段写入内存，faststart 需要重新打开输出文件移动 moov，不可用；改用分片 MP4，
+# delay_moov 使 moov 中带有从首个数据包提取的 SPS/PPS
+CLIP_FORMATS = {
+    'mp4': ('mp4', {'movflags': 'frag_keyframe+empty_moov+delay_moov'}, 'video/mp4'),
+    'ts': ('mpegts', {}, 'video/mp2t'),
+}
+
+
+class PrerollBuffer:
+    def __init__(self, max_seconds: float = 60.0, max_bytes: int = 32 * 1024 * 1024):
+        """
+        max_seconds: 保留的最长时长（秒）
+        max_bytes: 保留数据包的总字节数上限
+        """
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self._packets: deque[EncodedPacket] = deque()
+        self._bytes = 0
+        self._template = None
+        self._lock = Lock()
+
+    def attach(self, stream):
+        """新的编码会话开始，时间戳与之前不连续，清空缓冲"""
+        with self._lock:
+            self._template = stream
+            self._packets.clear()
+            self._bytes = 0
+
+    def append(self, packet: EncodedPacket):
+        """录制线程调用：追加数据包并淘汰超出时长或字节上限的最旧数据包"""
+        with self._lock:
+            self._packets.append(packet)
+            self._bytes += len(packet.data)
+            newest = packet.seconds
+            while len(self._packets) > 1 and (self._bytes > self.max_bytes
+                                              or newest - self._packets[0].seconds > self.max_seconds):
+                self._bytes -= len(self._packets.popleft().data)
+
+    def snapshot(self, seconds: float) -> tuple[list[EncodedPacket], object]:
+        """返回覆盖最近 seconds 秒、从关键帧开始的数据包列表及其编码流"""
+        with self._lock:
+            packets = list(self._packets)
+            template = self._template
+        if not packets:
+            return [], template
+        start_time = packets[-1].seconds - seconds
+        start = None
+        for i, packet in enumerate(packets):
+            if not packet.keyframe:
+                continue
+            if start is None or packet.seconds <= start_time:
+                start = i
+            if packet.seconds > start_time:
+                break
+        if start is None:
+            return [], template
+        return packets[start:], template
+
+    def stats(self) -> dict:
+        with self._lock:
+            duration = self._packets[-1].seconds - self._packets[0].seconds if self._packets else 0.0
+            return {'packets': len(self._packets), 'bytes': self._bytes, 'seconds': duration}
+
+    def clip(self, seconds: float, fmt: str = 'mp4') -> Optional[bytes]:
+        """把最近 seconds 秒封装为可播放的片段（在内存中完成），缓冲为空时返回 None"""
+        packets, template = self.snapshot(seconds)
+        if not packets or template is None:
+            return None
+        format_name, options, _ = CLIP_FORMATS[fmt]
+        # 片段从 0 开始计时
+        base_dts = packets[0].dts if packets[0].dts is not None else packets[0].pts or 0
+        buf = io.BytesIO()
+        with av.open(buf, mode='w', format=format_name, options=options) as container:
+            stream = add_stream_like(container, template)
+            for packet in packets:
+                packet = packet._replace(
+                    pts=None if packet.pts is None else packet.pts - base_dts,
+                    dts=None if packet.dts is None else packet.dts - base_dts,
+                )
+                container.mux(packet.to_av(stream))
+        return buf.getvalue()
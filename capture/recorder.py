@@ -1,5 +1,6 @@
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, current_thread
 from pathlib import Path
+from typing import Callable
 import time
 import atexit
 import hashlib
@@ -7,19 +8,39 @@ import hashlib
 import av
 import cv2
 
+from capture.archive_playlist import ArchivePlaylist
 from capture.accel_utils import select_best_encoder, get_encoder_options
 from capture.base_capture import BaseCapture
+from capture.frame_bus import FrameBus
+from capture.live_stream import EncodedPacket, LiveStreamHub
+from capture.preroll import PrerollBuffer
+from capture.storyboard import StoryboardBuilder
+from capture.segment_io import make_segment_io_open, signature_salt
+from config import (video_sign_mode, video_sign_batch_size, live_stream_max_pending_bytes,
+                    preroll_seconds, preroll_max_bytes, storyboard_interval, storyboard_thumb_width,
+                    storyboard_columns, storyboard_rows, media_archive_chunk_duration)
 from utils.logger import getLogger
+from utils.merkle import build_manifest, write_manifest
 
 
 class Recorder:
-    def __init__(self, capture: BaseCapture, sid: str = "", preferred_encoder=None):
+    def __init__(self, capture: BaseCapture, sid: str = "", preferred_encoder=None, sign_mode: str | None = None,
+                 segment_listeners: list[Callable[['Recorder', int], None]] | None = None,
+                 stop_listeners: list[Callable[['Recorder'], None]] | None = None):
         self.capture = capture
         self.name = capture.name
         self.sid = sid
         self.output_path = Path('./media') / self.capture.name
         self.preferred_encoder = preferred_encoder
         self.recording = False
+        # 录制负载：单帧处理耗时占帧间隔的比例（指数滑动平均），>1 表示跟不上目标帧率
+        self.load = 0.0
+        # 最新采集帧的共享出口，截图等功能直接复用录制帧而不再单独采集
+        self.frames = FrameBus()
+        # 低延迟直播：编码数据包封装为 fMP4 后分发给 WebSocket 订阅者
+        self.live = LiveStreamHub(self.name, max_pending_bytes=live_stream_max_pending_bytes)
+        # 最近若干秒编码数据包的内存环形缓冲，用于即时回放
+        self.preroll = PrerollBuffer(max_seconds=preroll_seconds, max_bytes=preroll_max_bytes)
         self.stop_event = Event()
         self.output_path.mkdir(parents=True, exist_ok=True)
         
@@ -31,8 +52,35 @@ class Recorder:
         # 用于保护 latest_segments 的锁
         self.segments_lock = Lock()
         
-        # 签名计数器，每3次运行生成一次签名
+        # 签名模式：merkle 按批签名全部切片，sample 每3次运行抽样签名一个切片
+        self.sign_mode = sign_mode or video_sign_mode
+        # 签名计数器，每3次运行生成一次签名（sample 模式）
         self.sign_counter = 0
+        # 切片关闭时由输出 IO 层增量计算得到的加盐哈希 {切片编号: 哈希}，哈希为 None 表示需要回读文件计算
+        self.segment_digests: dict[int, str | None] = {}
+        self.digests_lock = Lock()
+        # 切片关闭事件的监听者，回调参数为 (录制器, 切片编号)，在录制线程中调用，必须立即返回
+        self.segment_listeners = segment_listeners if segment_listeners is not None else []
+        # 录制会话结束（资源已释放、剩余切片已签名）后的监听者，参数为录制器；
+        # 通常在录制线程退出前调用，不得在回调中调用 stop()
+        self.stop_listeners = stop_listeners if stop_listeners is not None else []
+        # 输出是否经过增量哈希 IO 层；不支持 io_open 时由监控线程根据切片文件判断切片关闭
+        self._hashing_io = True
+        self._last_notified_segment = -1
+        # 录制会话的收尾只执行一次（录制线程退出、看门狗或 stop() 中先到者执行）
+        self._finish_lock = Lock()
+        self._finished = True
+        
+        # 故事板缩略图：切片关闭后只解码关键帧生成精灵图
+        self.storyboard = StoryboardBuilder(self.output_path, self.capture.width, self.capture.height,
+                                            interval=storyboard_interval, thumb_width=storyboard_thumb_width,
+                                            columns=storyboard_columns, rows=storyboard_rows)
+        
+        # 归档播放列表：按固定时长（默认一小时）滚动的子播放列表 + 索引，复用器自身只维护固定窗口的 video.m3u8
+        self.archive = ArchivePlaylist(self.output_path, chunk_duration=media_archive_chunk_duration,
+                                      target_duration=4)
+        # 先归档上次录制遗留在 video.m3u8 中的切片（包括旧版本生成的完整列表），复用器启动后会裁剪该列表
+        self._sync_archive()
         
         # 注册退出时的清理函数
         atexit.register(self._cleanup)
@@ -60,12 +108,21 @@ class Recorder:
         
         hls_options = {
             'hls_time': '3',  # 单个切片时长（秒）
-            'hls_list_size': '0',  # 保留所有切片
-            'hls_flags': 'append_list+independent_segments',  # 追加到现有列表，确保每个切片独立可播放
+            'hls_list_size': '20',  # 只保留最近的切片，完整归档由 ArchivePlaylist 按小时滚动维护
+            'hls_flags': 'append_list+independent_segments',  # 追加到现有列表（延续切片编号），确保每个切片独立可播放
             'hls_segment_type': 'mpegts',  # 使用 mpegts 格式
             'hls_segment_filename': str(self.output_path / 'video_%d.ts'),
         }
-        self.output_container = av.open(self.output_path / 'video.m3u8', mode='w', format='hls', options=hls_options)
+        # 通过自定义 IO 写入切片，写入的同时计算签名哈希，避免切片完成后再整体读回
+        io_open = make_segment_io_open(signature_salt(self.sid), self._on_segment_closed)
+        try:
+            self.output_container = av.open(self.output_path / 'video.m3u8', mode='w', format='hls', options=hls_options, io_open=io_open)
+        except TypeError:
+            # 旧版本 PyAV 不支持 io_open，退化为签名时回读文件
+            self.logger.warning("当前 PyAV 不支持 io_open，由监控线程检测切片关闭并回读切片文件计算签名")
+            self.output_container = av.open(self.output_path / 'video.m3u8', mode='w', format='hls', options=hls_options)
+            self._hashing_io = False
+        self._last_notified_segment = self.start_segment_number - 1
         stream = self.output_container.add_stream(selected_encoder, rate=self.capture.fps)
         if not isinstance(stream, av.VideoStream):
             raise RuntimeError("无法创建视频流")
@@ -85,7 +142,13 @@ class Recorder:
         encoder_options['g'] = str(self.capture.fps * 3)  # 每 2 秒一个关键帧
         self.stream.options = encoder_options
         
+        # 新的编码会话，时间戳与上一次录制不连续
+        self.archive.mark_discontinuity()
+        self.live.attach(self.stream)
+        self.preroll.attach(self.stream)
+        
         self.recording = True
+        self._finished = False
         self.stop_event.clear()
         self.recording_thread = Thread(target=self._record_screen, daemon=True)
         self.recording_thread.start()
@@ -108,6 +171,7 @@ class Recorder:
                 capture_start = time.time()
                 frame_array = self.capture.capture_frame()
                 capture_time = time.time() - capture_start
+                self.frames.publish(frame_array)
 
                 # 转换为合适的颜色空间
                 convert_start = time.time()
@@ -122,12 +186,20 @@ class Recorder:
                 # 编码并写入
                 encode_start = time.time()
                 for packet in self.stream.encode(av_frame):
+                    # 复用前复制一份分发给直播与预录缓冲，复用会改写数据包的时间基
+                    encoded = EncodedPacket.from_av(packet)
+                    self.live.publish(encoded)
+                    self.preroll.append(encoded)
                     if self.output_container:
                         self.output_container.mux(packet)
                 encode_time = time.time() - encode_start
 
                 # 如果成功执行到此，重置重试计数器
                 retry_count = 0
+                
+                # 更新录制负载，供后台任务判断是否存在采集压力
+                busy = time.time() - start_time
+                self.load = 0.9 * self.load + 0.1 * busy * self.capture.fps
 
             except Exception as e:
                 # 记录异常并尝试重试
@@ -160,8 +232,8 @@ class Recorder:
                     f"实际帧率={fps_actual:.2f}fps"
                 )
         self.recording = False
-        if hasattr(self, 'capture') and self.capture:
-            self.capture.stop()
+        # 录制线程持有输出容器，由它完成收尾：此后不会再有数据包写入
+        self._finish_recording()
     
     def _monitor_segments(self):
         """监控切片文件，每3秒检查一次新生成的切片"""
@@ -199,13 +271,23 @@ class Recorder:
                 with self.segments_lock:
                     self.logger.debug(f"检测到新切片，最新切片编号: {self.latest_segments}")
                 
-                # 签名计数器递增
-                self.sign_counter += 1
+                # 把复用器窗口列表中新完成的切片追加到归档
+                self._sync_archive()
+                if not self._hashing_io and last_segment_number is not None:
+                    # 没有 IO 层的关闭回调：最新切片之前的切片均已关闭
+                    self._notify_closed_segments(last_segment_number - 1)
                 
-                # 每3次运行生成一次签名
-                if self.sign_counter >= 3 and last_segment_number is not None:
-                    self._generate_signature(last_segment_number)
-                    self.sign_counter = 0  # 重置计数器
+                if self.sign_mode == 'merkle':
+                    # 已关闭切片凑满一批后签名
+                    self._sign_merkle_batch()
+                else:
+                    # 签名计数器递增
+                    self.sign_counter += 1
+                    
+                    # 每3次运行生成一次签名
+                    if self.sign_counter >= 3 and last_segment_number is not None:
+                        self._generate_signature(self._latest_closed_segment(last_segment_number))
+                        self.sign_counter = 0  # 重置计数器
                 # 重置看门狗计数器
                 no_new_counter = 0
             else:
@@ -222,49 +304,33 @@ class Recorder:
                     except Exception:
                         pass
 
-                    # 尝试等待录制线程退出，若超时则主动进行清理
-                    wait_secs = 5
-                    waited = 0
-                    while waited < wait_secs and getattr(self, 'recording', False):
-                        time.sleep(0.5)
-                        waited += 0.5
-
-                    # 调用清理，确保容器和资源被释放（_cleanup 内部会检查 recording 状态）
-                    try:
-                        # 停止捕获
-                        if hasattr(self, 'capture') and self.capture:
-                            try:
-                                self.capture.stop()
-                                self.logger.info("捕获已停止")
-                            except Exception as e:
-                                self.logger.error(f"停止捕获时出错: {e}", exc_info=True)
-                        
-                        # 刷新并关闭输出容器
-                        if hasattr(self, 'output_container') and self.output_container:
-                            try:
-                                # 刷新编码器
-                                if hasattr(self, 'stream'):
-                                    for packet in self.stream.encode():
-                                        self.output_container.mux(packet)
-                                self.logger.info("编码器已刷新")
-                            except Exception as e:
-                                self.logger.error(f"刷新编码器时出错: {e}", exc_info=True)
-                            
-                            try:
-                                self.output_container.close()
-                                self.logger.info("输出容器已关闭")
-                            except Exception as e:
-                                self.logger.error(f"关闭输出容器时出错: {e}", exc_info=True)
-                            finally:
-                                self.output_container = None
-                    except Exception as e:
-                        self.logger.error(f"看门狗触发后清理失败: {e}", exc_info=True)
+                    # 等待录制线程退出并自行收尾，超时（如采集卡住）则在此收尾
+                    self.recording_thread.join(timeout=5.0)
+                    self._finish_recording()
                     # 退出监控循环
                     break
             
             # 等待3秒后再次检查
             time.sleep(3)
     
+    def _on_segment_closed(self, segment_number: int, digest: str | None):
+        """输出 IO 层在切片关闭时回调（位于录制线程），仅记录哈希，签名文件由监控线程写入"""
+        with self.digests_lock:
+            self.segment_digests[segment_number] = digest
+        self.logger.debug(f"切片已关闭: video_{segment_number}.ts, 增量哈希{'可用' if digest else '不可用'}")
+        self.storyboard.submit(segment_number, self.output_path / f'video_{segment_number}.ts')
+        for listener in self.segment_listeners:
+            try:
+                listener(self, segment_number)
+            except Exception as e:
+                self.logger.error(f"切片关闭事件回调失败: {e}", exc_info=True)
+
+    def _latest_closed_segment(self, upper: int) -> int:
+        """返回不超过 upper 的最新已关闭切片编号；切片仍在写入时签名前一个已完成的切片"""
+        with self.digests_lock:
+            closed = [n for n in self.segment_digests if n <= upper]
+        return max(closed) if closed else upper
+
     def _generate_signature(self, segment_number: int):
         """
         为指定的切片文件生成签名文件
@@ -273,23 +339,19 @@ class Recorder:
             segment_number: 切片编号
         """
         try:
-            segment_file = self.output_path / f'video_{segment_number}.ts'
             sig_file = self.output_path / f'video_{segment_number}.sig'
             
-            # 读取切片文件内容
-            if not segment_file.exists():
-                self.logger.warning(f"切片文件不存在: {segment_file}")
-                return
-            
-            with open(segment_file, 'rb') as f:
-                file_content = f.read()
+            with self.digests_lock:
+                hash_value = self.segment_digests.get(segment_number)
+                # 已签名及更早的哈希不再需要
+                for n in [n for n in self.segment_digests if n <= segment_number]:
+                    del self.segment_digests[n]
             
-            # 使用 sha1 算法计算哈希，加盐：固定字符串 + self.sid
-            salt = f"CkyfExamClient_video_signature_{self.sid}"
-            sha1 = hashlib.sha1()
-            sha1.update(salt.encode('utf-8'))
-            sha1.update(file_content)
-            hash_value = sha1.hexdigest()
+            if hash_value is None:
+                # 没有增量哈希（旧版 PyAV 或复用器回写过数据），回读切片文件计算
+                hash_value = self._segment_digest(segment_number)
+                if hash_value is None:
+                    return
             
             # 写入签名文件：格式为 "hash+sid"
             signature_content = f"{hash_value}+{self.sid}"
@@ -301,6 +363,62 @@ class Recorder:
         except Exception as e:
             self.logger.error(f"生成签名文件失败 (video_{segment_number}.sig): {e}", exc_info=True)
     
+    def _segment_digest(self, segment_number: int) -> str | None:
+        """回读切片文件计算加盐哈希（sha1，盐为固定字符串 + self.sid），用于没有增量哈希的切片"""
+        segment_file = self.output_path / f'video_{segment_number}.ts'
+        if not segment_file.exists():
+            self.logger.warning(f"切片文件不存在: {segment_file}")
+            return None
+        sha1 = hashlib.sha1(signature_salt(self.sid))
+        with open(segment_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _sign_merkle_batch(self, force: bool = False):
+        """
+        将已关闭的切片按批构建 Merkle 树，写入一个包含树根签名和各切片包含证明的清单文件
+        
+        Args:
+            force: 为 True 时不足一批也立即签名（录制结束时使用）
+        """
+        with self.digests_lock:
+            if not self.segment_digests or (len(self.segment_digests) < video_sign_batch_size and not force):
+                return
+            pending = dict(self.segment_digests)
+            self.segment_digests.clear()
+        
+        try:
+            digests = {}
+            for number, digest in pending.items():
+                if digest is None:
+                    digest = self._segment_digest(number)
+                if digest is not None:
+                    digests[number] = digest
+            if not digests:
+                return
+            manifest = build_manifest(digests, self.sid, signature_salt(self.sid))
+            path = write_manifest(self.output_path, manifest)
+            self.logger.debug(f"已生成批量签名: {path.name} ({len(digests)} 个切片)")
+        except Exception as e:
+            self.logger.error(f"生成批量签名失败 (切片 {sorted(pending)}): {e}", exc_info=True)
+
+    def _sync_archive(self, final: bool = False):
+        """
+        同步复用器的窗口播放列表到滚动归档
+        
+        Args:
+            final: 录制结束时为 True，结束当前归档子列表
+        """
+        try:
+            added = self.archive.sync_from_playlist(self.output_path / 'video.m3u8')
+            if added:
+                self.logger.debug(f"归档新增 {added} 个切片，最新切片编号: {self.archive.last_segment}")
+            if final:
+                self.archive.close()
+        except Exception as e:
+            self.logger.error(f"同步归档播放列表失败: {e}", exc_info=True)
+
     def get_latest_segments(self):
         """
         获取最新的切片编号列表（线程安全）
@@ -342,21 +460,35 @@ class Recorder:
         return "\n".join(m3u8_lines) + "\n"
                     
     def stop(self):
-        self.stop_event.set()
-        if hasattr(self, 'recording_thread') and self.recording_thread.is_alive():
-            self.recording_thread.join(timeout=5.0)  # 设置超时时间，避免无限等待
-        if hasattr(self, 'monitor_thread') and self.monitor_thread.is_alive():
-            self.monitor_thread.join(timeout=5.0)  # 等待监控线程结束
-            
         self._cleanup()
+        if hasattr(self, 'monitor_thread') and self.monitor_thread.is_alive() \
+                and self.monitor_thread is not current_thread():
+            self.monitor_thread.join(timeout=5.0)  # 等待监控线程结束
 
     def __del__(self):
         self.stop()
 
     def _cleanup(self):
-        if self.recording is False:
-            return
+        self.stop_event.set()
+        if hasattr(self, 'recording_thread') and self.recording_thread.is_alive() \
+                and self.recording_thread is not current_thread():
+            self.recording_thread.join(timeout=5.0)  # 设置超时时间，避免无限等待
+        # 录制线程未能自行收尾（未启动、卡住或进程退出）时在此完成
+        self._finish_recording()
+        # 结束所有直播订阅（可重复调用，未开始录制时也要结束已有订阅）
+        self.live.close()
+
+    def _finish_recording(self):
+        """结束录制会话，只执行一次：停止捕获、刷新编码器并关闭输出容器，
+        签名剩余切片、结束归档子列表并结束直播订阅
+        """
+        with self._finish_lock:
+            if self._finished:
+                return
+            self._finished = True
         self.recording = False
+        # 录制线程因错误退出时也要让监控线程结束
+        self.stop_event.set()
         self.logger.info("开始清理资源")
         
         # 停止捕获
@@ -385,3 +517,32 @@ class Recorder:
                 self.logger.error(f"关闭输出容器时出错: {e}", exc_info=True)
             finally:
                 self.output_container = None
+        
+        # 容器关闭后最后一个切片已完成，签名剩余切片并结束归档子列表
+        if not self._hashing_io:
+            self._notify_closed_segments(self._newest_segment_file())
+        if self.sign_mode == 'merkle':
+            self._sign_merkle_batch(force=True)
+        self._sync_archive(final=True)
+        self.live.close()
+        for listener in self.stop_listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                self.logger.error(f"录制结束事件回调失败: {e}", exc_info=True)
+
+    def _newest_segment_file(self) -> int:
+        numbers = []
+        for seg in self.output_path.glob('video_*.ts'):
+            try:
+                numbers.append(int(seg.stem.split('_')[1]))
+            except (ValueError, IndexError):
+                pass
+        return max(numbers, default=-1)
+
+    def _notify_closed_segments(self, upper: int):
+        """不支持 io_open 时根据切片文件触发切片关闭事件，签名时回读文件计算哈希"""
+        for number in range(self._last_notified_segment + 1, upper + 1):
+            if (self.output_path / f'video_{number}.ts').exists():
+                self._on_segment_closed(number, None)
+            self._last_notified_segment = number
@@ -0,0 +1,246 @@
+"""空闲时后台重编码
+实时录制使用 ultrafast/zerolatency 等低延迟参数，体积较大。本模块在机器空闲、且所有录制器都没有
+采集压力时，把已结束归档子列表中的切片用更高压缩率的参数重新编码为更小的文件。
+
+签名链保留方式：只处理被 Merkle 批量签名覆盖且校验通过的切片；新切片写入
+reencode_<first>_<last>.msig 清单，清单对新切片做 Merkle 签名，并在 sources 字段中记录每个切片
+原始内容的加盐哈希，校验时先用新清单校验新文件，再用记录的原始哈希校验原始批量签名。
+清单落盘是提交点，之后才逐个原子替换切片文件
+"""
+from pathlib import Path
+from threading import Thread, Event
+from typing import Callable, Dict, Tuple
+import hashlib
+import os
+import re
+import time
+
+import av
+import psutil
+
+from capture.archive_playlist import ArchivePlaylist
+from capture.segment_io import signature_salt
+from utils.logger import getLogger
+from utils.merkle import MANIFEST_SUFFIX, build_manifest, leaf_hash, load_manifest, root_from_proof, write_manifest
+from utils.segment_pack import index_name
+
+
+logger = getLogger("recorder.reencoder")
+
+REENCODE_PREFIX = 'reencode'
+TMP_SUFFIX = '.reenc'
+BATCH_PATTERN = re.compile(r'^batch_(\d+)_(\d+)' + re.escape(MANIFEST_SUFFIX) + '$')
+# 重编码过程中检查空闲状态的间隔（秒）：psutil.cpu_percent 统计两次调用之间的占用，间隔过短时读数噪声很大
+IDLE_CHECK_INTERVAL = 2.0
+
+
+class IdleInterrupted(Exception):
+    """机器不再空闲，放弃当前切片稍后重试"""
+
+
+class SegmentReencoder:
+    def __init__(self, media_root: Path, get_recorders: Callable[[], Dict], interval: float = 60.0,
+                 preset: str = 'slow', crf: int = 23, idle_cpu_threshold: float = 30.0, max_recorder_load: float = 0.6):
+        """
+        media_root: 媒体根目录
+        get_recorders: 返回当前活动录制器 {name: Recorder} 的函数
+        interval: 检查间隔（秒）
+        preset / crf: libx264 重编码参数
+        idle_cpu_threshold: 系统 CPU 占用低于该百分比才视为空闲
+        max_recorder_load: 任一录制器负载（Recorder.load）高于该值时视为存在采集压力
+        """
+        self.media_root = Path(media_root)
+        self.get_recorders = get_recorders
+        self.interval = interval
+        self.preset = preset
+        self.crf = crf
+        self.idle_cpu_threshold = idle_cpu_threshold
+        self.max_recorder_load = max_recorder_load
+        self._process = psutil.Process()
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info("后台重编码已启动: preset=%s, crf=%s", self.preset, self.crf)
+
+    def stop(self, join: bool = False):
+        self._stop_event.set()
+        if join and self._thread:
+            self._thread.join(timeout=5.0)
+
+    def _run(self):
+        # cpu_percent(interval=None) 统计的是两次调用之间的占用，先取一次基准
+        psutil.cpu_percent(interval=None)
+        self._process.cpu_percent(interval=None)
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("后台重编码执行失败")
+            self._stop_event.wait(self.interval)
+
+    def is_idle(self) -> bool:
+        """没有采集压力，且除本进程外的系统 CPU 占用低于阈值（自身的重编码不计入）"""
+        if self._stop_event.is_set():
+            return False
+        if any(getattr(r, 'load', 0.0) > self.max_recorder_load for r in self.get_recorders().values()):
+            return False
+        total = psutil.cpu_percent(interval=None)
+        own = self._process.cpu_percent(interval=None) / (psutil.cpu_count() or 1)
+        return max(0.0, total - own) < self.idle_cpu_threshold
+
+    def _archive_for(self, folder: Path) -> ArchivePlaylist:
+        recorder = self.get_recorders().get(folder.name)
+        if recorder is not None:
+            return recorder.archive
+        return ArchivePlaylist(folder)
+
+    def run_once(self):
+        if not self.media_root.is_dir():
+            return
+        for folder in sorted(p for p in self.media_root.iterdir() if p.is_dir()):
+            archive = self._archive_for(folder)
+            self._recover(folder)
+            for chunk in archive.ended_chunks():
+                if chunk.get('reencoded') or chunk['last_segment'] is None:
+                    continue
+                if not self.is_idle():
+                    return
+                try:
+                    self._reencode_chunk(folder, chunk, archive)
+                except IdleInterrupted:
+                    logger.debug("机器不再空闲，暂停重编码: %s/%s", folder.name, chunk['playlist'])
+                    return
+                except Exception:
+                    logger.exception("重编码失败: %s/%s", folder.name, chunk['playlist'])
+
+    def _recover(self, folder: Path):
+        """处理上次中断遗留的临时文件：已被重编码清单提交的完成替换，否则丢弃"""
+        tmps = list(folder.glob('video_*.ts' + TMP_SUFFIX))
+        if not tmps:
+            return
+        committed = set()
+        for path in folder.glob(f'{REENCODE_PREFIX}_*' + MANIFEST_SUFFIX):
+            manifest = load_manifest(path)
+            if manifest:
+                committed.update(int(n) for n in manifest.get('sources', {}))
+        for tmp in tmps:
+            n = int(re.match(r'^video_(\d+)\.ts', tmp.name).group(1))
+            if n in committed:
+                os.replace(tmp, folder / f'video_{n}.ts')
+            else:
+                tmp.unlink(missing_ok=True)
+
+    def _batches(self, folder: Path, first: int, last: int):
+        """与子列表有交集的原始批量签名清单，按编号排序"""
+        batches = []
+        for path in folder.glob('batch_*' + MANIFEST_SUFFIX):
+            m = BATCH_PATTERN.match(path.name)
+            if m and int(m.group(2)) >= first and int(m.group(1)) <= last:
+                batches.append((int(m.group(2)), path))
+        return sorted(batches)
+
+    def _reencode_chunk(self, folder: Path, chunk: Dict, archive: ArchivePlaylist):
+        """按原始签名批次逐批处理一个子列表，每批提交后记录进度，被打断时下次从断点继续"""
+        first, last = chunk['first_segment'], chunk['last_segment']
+        # 已被保留管理器打包的子列表不再处理
+        if (folder / index_name(first, last)).exists():
+            archive.mark_chunk(chunk['playlist'], reencoded=True)
+            return
+        done_upto = chunk.get('reencoded_upto', first - 1)
+        for batch_last, path in self._batches(folder, first, last):
+            if batch_last <= done_upto and batch_last <= last:
+                continue
+            manifest = load_manifest(path)
+            if manifest:
+                self._reencode_batch(folder, manifest, first, last)
+            done_upto = min(batch_last, last)
+            archive.mark_chunk(chunk['playlist'], reencoded_upto=done_upto)
+        archive.mark_chunk(chunk['playlist'], reencoded=True)
+
+    def _reencode_batch(self, folder: Path, manifest: Dict, first: int, last: int):
+        sid = manifest['sid']
+        root = bytes.fromhex(manifest['root'])
+        entries: Dict[int, Tuple[str, str]] = {}
+        saved = 0
+        for n in sorted(int(n) for n in manifest['segments']):
+            ts_path = folder / f'video_{n}.ts'
+            if not first <= n <= last or not ts_path.exists():
+                continue
+            # 只处理签名校验通过的切片，避免为被篡改的内容重新签名
+            original = _file_digest(ts_path, sid)
+            proof = manifest['proofs'].get(str(n))
+            if proof is None or root_from_proof(leaf_hash(n, original), proof) != root:
+                logger.warning("切片签名校验失败，不进行重编码: %s/%s", folder.name, ts_path.name)
+                continue
+            tmp_path = folder / f'video_{n}.ts{TMP_SUFFIX}'
+            try:
+                self._reencode_file(ts_path, tmp_path)
+            except IdleInterrupted:
+                # 本批尚未提交，丢弃全部临时文件
+                tmp_path.unlink(missing_ok=True)
+                for done in entries:
+                    (folder / f'video_{done}.ts{TMP_SUFFIX}').unlink(missing_ok=True)
+                raise
+            except Exception:
+                logger.exception("重编码切片失败，保留原文件: %s/%s", folder.name, ts_path.name)
+                tmp_path.unlink(missing_ok=True)
+                continue
+            new_size, old_size = tmp_path.stat().st_size, ts_path.stat().st_size
+            if new_size >= old_size:
+                tmp_path.unlink(missing_ok=True)
+                continue
+            saved += old_size - new_size
+            entries[n] = (_file_digest(tmp_path, sid), original)
+        if not entries:
+            return
+
+        # 写入新清单（提交点），再逐个原子替换切片
+        new_manifest = build_manifest({n: new for n, (new, _) in entries.items()}, sid, signature_salt(sid))
+        new_manifest['sources'] = {str(n): original for n, (_, original) in entries.items()}
+        write_manifest(folder, new_manifest, prefix=REENCODE_PREFIX)
+        for n in entries:
+            os.replace(folder / f'video_{n}.ts{TMP_SUFFIX}', folder / f'video_{n}.ts')
+        logger.info("已重编码 %s: 切片 %d-%d 中 %d 个，节省 %d 字节", folder.name, min(entries), max(entries), len(entries), saved)
+
+    def _reencode_file(self, src: Path, dst: Path):
+        """保留原始时间戳重新编码一个切片，使其仍能与相邻切片连续播放"""
+        with av.open(str(src)) as inp:
+            in_stream = inp.streams.video[0]
+            with av.open(str(dst), mode='w', format='mpegts', options={'mpegts_copyts': '1'}) as out:
+                out_stream = out.add_stream('libx264', rate=in_stream.average_rate or 24)
+                out_stream.width = in_stream.codec_context.width
+                out_stream.height = in_stream.codec_context.height
+                out_stream.pix_fmt = 'yuv420p'
+                out_stream.codec_context.time_base = in_stream.time_base
+                # 单线程编码，降低对前台的影响
+                out_stream.thread_count = 1
+                out_stream.options = {'preset': self.preset, 'crf': str(self.crf)}
+                next_check = time.monotonic() + IDLE_CHECK_INTERVAL
+                for frame in inp.decode(in_stream):
+                    if time.monotonic() >= next_check:
+                        if not self.is_idle():
+                            raise IdleInterrupted()
+                        next_check = time.monotonic() + IDLE_CHECK_INTERVAL
+                    # 编码器输入沿用源帧的时间戳与时间基，不重新编号；
+                    # 清除源帧的帧类型，由编码器按新参数重新决定
+                    frame.pts = frame.pts if frame.pts is not None else frame.dts
+                    frame.time_base = in_stream.time_base
+                    frame.pict_type = av.video.frame.PictureType.NONE
+                    for packet in out_stream.encode(frame):
+                        out.mux(packet)
+                for packet in out_stream.encode():
+                    out.mux(packet)
+
+
+def _file_digest(path: Path, sid: str) -> str:
+    sha1 = hashlib.sha1(signature_salt(sid))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
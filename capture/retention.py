@@ -0,0 +1,237 @@
+"""媒体目录保留与压缩管理
+后台线程定期把已结束的归档子列表 (archive_<first>.m3u8) 中的小切片及其签名打包为
+pack_<first>_<last>.pack + 索引，并按磁盘预算与保留天数删除最旧的打包数据。
+打包过程限速且在系统繁忙时暂停，不与实时录制争抢磁盘和 CPU
+"""
+from pathlib import Path
+from threading import Thread, Event
+from typing import Callable, Dict, List, Optional
+import json
+import os
+import re
+import time
+
+import psutil
+
+from capture.archive_playlist import ArchivePlaylist
+from utils.logger import getLogger
+from utils.merkle import MANIFEST_SUFFIX
+from utils.segment_pack import PACK_VERSION, iter_pack_indexes, load_index, pack_name, index_name
+
+
+logger = getLogger("recorder.retention")
+
+# 批量签名清单与重编码清单
+BATCH_PATTERN = re.compile(r'^(?:batch|reencode)_(\d+)_(\d+)' + re.escape(MANIFEST_SUFFIX) + '$')
+
+
+class RetentionManager:
+    def __init__(self, media_root: Path, get_recorders: Callable[[], Dict], interval: float = 300.0,
+                 max_bytes: Optional[int] = None, max_age_days: Optional[float] = None,
+                 io_rate: float = 8 * 1024 * 1024, cpu_threshold: float = 70.0, require_reencoded: bool = False):
+        """
+        media_root: 媒体根目录（其下每个子目录对应一个录制器）
+        get_recorders: 返回当前活动录制器 {name: Recorder} 的函数，用于复用其归档播放列表对象
+        interval: 检查间隔（秒）
+        max_bytes: 磁盘预算，None 表示不限制
+        max_age_days: 打包数据最长保留天数，None 表示不限制
+        io_rate: 打包时的读写速率上限（字节/秒）
+        cpu_threshold: 系统 CPU 占用高于该值时暂停打包
+        require_reencoded: 启用后台重编码时为 True，只打包已完成重编码的子列表
+        """
+        self.media_root = Path(media_root)
+        self.get_recorders = get_recorders
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.io_rate = io_rate
+        self.cpu_threshold = cpu_threshold
+        self.require_reencoded = require_reencoded
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info("保留管理器已启动: interval=%s, max_bytes=%s, max_age_days=%s", self.interval, self.max_bytes, self.max_age_days)
+
+    def stop(self, join: bool = False):
+        self._stop_event.set()
+        if join and self._thread:
+            self._thread.join(timeout=5.0)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("保留管理器执行失败")
+            self._stop_event.wait(self.interval)
+
+    def run_once(self):
+        if not self.media_root.is_dir():
+            return
+        for folder in sorted(p for p in self.media_root.iterdir() if p.is_dir()):
+            if self._stop_event.is_set():
+                return
+            try:
+                self._compact_folder(folder)
+            except Exception:
+                logger.exception("打包切片失败: %s", folder.name)
+        self._prune()
+
+    def _archive_for(self, folder: Path) -> ArchivePlaylist:
+        """活动录制器的归档对象由录制线程同时写入，必须复用同一个实例"""
+        recorder = self.get_recorders().get(folder.name)
+        if recorder is not None:
+            return recorder.archive
+        return ArchivePlaylist(folder)
+
+    def _wait_until_quiet(self):
+        """系统 CPU 占用过高时等待，避免与录制争抢资源"""
+        while not self._stop_event.is_set() and psutil.cpu_percent(interval=1.0) > self.cpu_threshold:
+            self._stop_event.wait(5.0)
+
+    def _throttled_copy(self, src: Path, dst) -> int:
+        written = 0
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                dst.write(chunk)
+                written += len(chunk)
+                if self.io_rate:
+                    time.sleep(len(chunk) / self.io_rate)
+        return written
+
+    def _compact_folder(self, folder: Path):
+        for chunk in self._archive_for(folder).ended_chunks():
+            if self._stop_event.is_set():
+                return
+            first, last = chunk['first_segment'], chunk['last_segment']
+            if last is None:
+                continue
+            if self.require_reencoded and not chunk.get('reencoded'):
+                continue
+            if not (folder / index_name(first, last)).exists():
+                self._wait_until_quiet()
+                if self._stop_event.is_set():
+                    return
+                if not self._write_pack(folder, chunk):
+                    continue
+            # 索引写入后即视为打包完成；删除散落文件（也用于补全上次中断的清理）
+            self._remove_loose_files(folder, first, last)
+
+    def _write_pack(self, folder: Path, chunk: Dict) -> bool:
+        first, last = chunk['first_segment'], chunk['last_segment']
+        segments = [n for n in range(first, last + 1) if (folder / f'video_{n}.ts').exists()]
+        if not segments:
+            return False
+
+        pack_path = folder / pack_name(first, last)
+        pack_tmp = pack_path.with_suffix('.pack.tmp')
+        index = {
+            'version': PACK_VERSION,
+            'pack': pack_path.name,
+            'playlist': chunk['playlist'],
+            'segments': {},
+            'sigs': {},
+            'manifests': {},
+        }
+        offset = 0
+        with open(pack_tmp, 'wb') as out:
+            for n in segments:
+                ts_path = folder / f'video_{n}.ts'
+                mtime = ts_path.stat().st_mtime
+                length = self._throttled_copy(ts_path, out)
+                index['segments'][str(n)] = {'offset': offset, 'length': length, 'mtime': mtime}
+                offset += length
+                sig_path = folder / f'video_{n}.sig'
+                if sig_path.exists():
+                    index['sigs'][str(n)] = sig_path.read_text(encoding='utf-8')
+            out.flush()
+            os.fsync(out.fileno())
+        # 批量签名清单归入包含其最后一个切片的 pack
+        for path in folder.glob('*' + MANIFEST_SUFFIX):
+            m = BATCH_PATTERN.match(path.name)
+            if m and first <= int(m.group(2)) <= last:
+                index['manifests'][path.name] = path.read_text(encoding='utf-8')
+
+        index_path = folder / index_name(first, last)
+        index_tmp = index_path.with_suffix('.json.tmp')
+        index_tmp.write_text(json.dumps(index, separators=(',', ':')), encoding='utf-8')
+        pack_tmp.replace(pack_path)
+        # 索引最后落盘，作为打包完成的提交点
+        index_tmp.replace(index_path)
+        logger.info("已打包切片: %s/%s (%d 个切片, %d 字节)", folder.name, pack_path.name, len(segments), offset)
+        return True
+
+    def _remove_loose_files(self, folder: Path, first: int, last: int):
+        index = load_index(folder / index_name(first, last))
+        if not index:
+            return
+        for n in index['segments']:
+            (folder / f'video_{n}.ts').unlink(missing_ok=True)
+        # 只删除内容已保存到索引中的签名；打包之后才写入（或改写）的签名保留为散落文件
+        captured = {f'video_{n}.sig': text for n, text in index['sigs'].items()}
+        captured.update(index['manifests'])
+        for name, text in captured.items():
+            path = folder / name
+            try:
+                if path.read_text(encoding='utf-8') == text:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
+
+    def _pack_candidates(self) -> List[Dict]:
+        candidates = []
+        for folder in (p for p in self.media_root.iterdir() if p.is_dir()):
+            for index_path in iter_pack_indexes(folder):
+                index = load_index(index_path)
+                if not index:
+                    continue
+                pack_path = folder / index['pack']
+                newest = max((s.get('mtime', 0.0) for s in index['segments'].values()), default=0.0)
+                size = index_path.stat().st_size + (pack_path.stat().st_size if pack_path.exists() else 0)
+                candidates.append({'folder': folder, 'index_path': index_path, 'pack_path': pack_path,
+                                   'playlist': index.get('playlist'), 'newest': newest, 'size': size})
+        candidates.sort(key=lambda c: c['newest'])
+        return candidates
+
+    def _media_usage(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.media_root):
+            for name in files:
+                try:
+                    total += os.stat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def _delete_pack(self, candidate: Dict):
+        candidate['index_path'].unlink(missing_ok=True)
+        candidate['pack_path'].unlink(missing_ok=True)
+        if candidate['playlist']:
+            self._archive_for(candidate['folder']).drop_chunk(candidate['playlist'])
+        logger.info("已按保留策略删除: %s/%s", candidate['folder'].name, candidate['pack_path'].name)
+
+    def _prune(self):
+        """只删除已打包的数据，正在录制的散落切片永远不会被删除"""
+        if self.max_bytes is None and self.max_age_days is None:
+            return
+        candidates = self._pack_candidates()
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 86400
+            expired = [c for c in candidates if c['newest'] < cutoff]
+            for c in expired:
+                self._delete_pack(c)
+            candidates = [c for c in candidates if c['newest'] >= cutoff]
+        if self.max_bytes is not None:
+            usage = self._media_usage()
+            while usage > self.max_bytes and candidates:
+                c = candidates.pop(0)
+                self._delete_pack(c)
+                usage -= c['size']
+            if usage > self.max_bytes:
+                logger.warning("媒体目录仍超出磁盘预算: %d > %d 字节（剩余数据尚未打包）", usage, self.max_bytes)
@@ -0,0 +1,105 @@
+"""HLS 切片输出 IO 层
+通过 PyAV 的 io_open 回调接管 HLS 复用器打开的文件，对 .ts 切片在写入的同时增量计算加盐 SHA-1，
+切片关闭时即可得到签名所需的哈希，无需再从磁盘读回整个切片，也不需要在内存中缓存整个切片
+"""
+from typing import Callable, Optional
+import hashlib
+import io
+import os
+import re
+
+
+# libavformat 中的 AVIO 打开标志
+AVIO_FLAG_READ = 1
+AVIO_FLAG_WRITE = 2
+
+SEGMENT_PATTERN = re.compile(r'video_(\d+)\.ts$')
+
+
+def signature_salt(sid: str) -> bytes:
+    """切片签名使用的盐：固定字符串 + sid"""
+    return f"CkyfExamClient_video_signature_{sid}".encode('utf-8')
+
+
+class HashingSegmentWriter:
+    """写入切片文件的同时增量计算加盐 SHA-1 的文件对象
+
+    只有按顺序追加写入的字节会进入哈希；如果复用器回退 seek 覆写已写入的数据，
+    增量哈希不再可信，关闭时回调的哈希为 None，由调用方回退为重新读取文件计算。
+    """
+
+    def __init__(self, path: str, salt: bytes, on_close: Callable[[Optional[str]], None]):
+        self._file = open(path, 'wb')
+        self._sha1 = hashlib.sha1(salt)
+        self._on_close = on_close
+        # 当前写入位置与已进入哈希的字节数
+        self._offset = 0
+        self._hashed = 0
+        self._contiguous = True
+        self.closed = False
+
+    def write(self, data) -> int:
+        if self._contiguous:
+            if self._offset == self._hashed:
+                self._sha1.update(data)
+                self._hashed += len(data)
+            else:
+                self._contiguous = False
+        written = self._file.write(data)
+        self._offset += len(data)
+        return written if written is not None else len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._offset = self._file.seek(offset, whence)
+        return self._offset
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        # 文件末尾之后的数据必须全部进入哈希，否则视为不完整
+        digest = self._sha1.hexdigest() if self._contiguous and self._hashed == self._offset else None
+        try:
+            self._on_close(digest)
+        finally:
+            self._on_close = None
+
+
+def make_segment_io_open(salt: bytes, on_segment_closed: Callable[[int, Optional[str]], None]):
+    """
+    构造传给 av.open(io_open=...) 的回调
+
+    Args:
+        salt: 签名盐
+        on_segment_closed: 切片关闭时的回调，参数为 (切片编号, 十六进制哈希或 None)
+
+    Returns:
+        callable: io_open(url, flags, options) -> file-like
+    """
+    def io_open(url: str, flags: int, options):
+        path = url[len('file:'):] if url.startswith('file:') else url
+        match = SEGMENT_PATTERN.search(path)
+        if match and flags & AVIO_FLAG_WRITE and not flags & AVIO_FLAG_READ:
+            number = int(match.group(1))
+            return HashingSegmentWriter(path, salt, lambda digest: on_segment_closed(number, digest))
+        if flags & AVIO_FLAG_WRITE and flags & AVIO_FLAG_READ:
+            mode = 'r+b'
+        elif flags & AVIO_FLAG_WRITE:
+            mode = 'wb'
+        else:
+            if not os.path.exists(path):
+                # append_list 会先读取已有的 video.m3u8；新目录中该文件不存在。
+                # 回调抛出的异常会被 PyAV 在 write_header 中重新抛出，而默认 AVIO 只是打开失败、
+                # 复用器忽略后继续，这里返回空内容达到同样的效果
+                return io.BytesIO()
+            mode = 'rb'
+        return open(path, mode)
+
+    return io_open
@@ -1,63 +1,142 @@
-from threading import Thread
+from threading import Thread, RLock
+from pathlib import Path
 import time
 
 from capture.recorder import Recorder
 from capture.base_capture import process_name
 from capture.screen_capture import create_capture
 from capture.camera_capture import CameraCapture
+from capture.retention import RetentionManager
+from capture.reencoder import SegmentReencoder
+from capture.uploader import SegmentUploader
+from config import (media_retention_interval, media_max_bytes, media_max_age_days,
+                    media_compact_io_rate, media_compact_cpu_threshold,
+                    media_reencode_enabled, media_reencode_preset, media_reencode_crf, media_reencode_idle_cpu,
+                    upload_enabled, upload_chunk_size, upload_max_rate, upload_min_rate, upload_max_recorder_load)
+from utils.event_bus import event_bus
 from utils.logger import getLogger
 
 
 recorders : dict[str, Recorder] = {}
 screens = []
 cameras = []
+# 所有录制器共享的切片关闭事件监听者，回调参数为 (录制器, 切片编号)
+segment_listeners = []
+# 保护 recorders / screens / cameras：录制器结束时会在其录制线程中移除自身
+_recorders_lock = RLock()
 logger = getLogger("recorder.service")
 
 def start_screen_recording(monitor_idx: int, monitor_name: str, fps: int = 24):
     monitor_name = process_name(monitor_name, monitor_idx)
-    if monitor_name in screens:
-        return recorders[monitor_name]
+    with _recorders_lock:
+        if monitor_name in screens:
+            return recorders[monitor_name]
     capture = create_capture(monitor_idx, monitor_name, fps)
     capture.capture_frame()
-    recorder = Recorder(capture)
-    recorders[recorder.name] = recorder
-    screens.append(recorder.name)
+    recorder = Recorder(capture, segment_listeners=segment_listeners, stop_listeners=[_remove_recorder])
+    with _recorders_lock:
+        recorders[recorder.name] = recorder
+        screens.append(recorder.name)
     recorder.start()
+    event_bus.publish('recorder.started', {'name': recorder.name, 'kind': 'screen'})
+    _publish_health()
     return recorder
 
 
 def start_camera_recording(camera_idx: int, camera_name: str, fps: int = 24):
     camera_name = process_name(camera_name, camera_idx)
-    if camera_name in cameras:
-        return recorders[camera_name]
+    with _recorders_lock:
+        if camera_name in cameras:
+            return recorders[camera_name]
     capture = CameraCapture(camera_idx, camera_name, fps)
     capture.capture_frame()
-    recorder = Recorder(capture)
-    recorders[recorder.name] = recorder
-    cameras.append(recorder.name)
+    recorder = Recorder(capture, segment_listeners=segment_listeners, stop_listeners=[_remove_recorder])
+    with _recorders_lock:
+        recorders[recorder.name] = recorder
+        cameras.append(recorder.name)
     recorder.start()
+    event_bus.publish('recorder.started', {'name': recorder.name, 'kind': 'camera'})
+    _publish_health()
     return recorder
 
 
+def _remove_recorder(recorder: Recorder):
+    """录制结束后移除录制器并立即发布 recorder.stopped 与健康状态，可重复调用。
+    作为录制器的结束事件监听者时在其录制线程中调用，因此不调用 recorder.stop()
+    """
+    with _recorders_lock:
+        name = recorder.name
+        if recorders.get(name) is not recorder:
+            return
+        logger.info(f"清理录制器: {name}")
+        del recorders[name]
+        kind = 'screen' if name in screens else 'camera'
+        if name in screens:
+            screens.remove(name)
+        if name in cameras:
+            cameras.remove(name)
+    event_bus.publish('recorder.stopped', {'name': name, 'kind': kind})
+    _publish_health()
+
+
 def _cleanup_recorders():
+    """兜底：录制器未能触发结束事件（如录制线程卡住）时由这里停止并移除"""
     while True:
-        to_remove = []
-        for name, recorder in recorders.items():
-            if not recorder.recording:
-                recorder.stop()
-                to_remove.append(name)
-        for name in to_remove:
-            logger.info(f"清理录制器: {name}")
-            del recorders[name]
-            if name in screens:
-                screens.remove(name)
-            if name in cameras:
-                cameras.remove(name)
+        with _recorders_lock:
+            stopped = [recorder for recorder in recorders.values() if not recorder.recording]
+        for recorder in stopped:
+            recorder.stop()
+            _remove_recorder(recorder)
+        _publish_health()
         time.sleep(5)
 
-            
-cleanup_thread = Thread(target=_cleanup_recorders, daemon=True)
-cleanup_thread.start()
+
+retention_manager = RetentionManager(
+    Path('./media'),
+    get_recorders=lambda: dict(recorders),
+    interval=media_retention_interval,
+    max_bytes=media_max_bytes,
+    max_age_days=media_max_age_days,
+    io_rate=media_compact_io_rate,
+    cpu_threshold=media_compact_cpu_threshold,
+    require_reencoded=media_reencode_enabled,
+)
+retention_manager.start()
+
+reencoder = SegmentReencoder(
+    Path('./media'),
+    get_recorders=lambda: dict(recorders),
+    preset=media_reencode_preset,
+    crf=media_reencode_crf,
+    idle_cpu_threshold=media_reencode_idle_cpu,
+)
+if media_reencode_enabled:
+    reencoder.start()
+
+# 上传地址在登录后由 configure() 设置
+uploader = SegmentUploader(
+    Path('./media'),
+    get_recorders=lambda: dict(recorders),
+    chunk_size=upload_chunk_size,
+    max_rate=upload_max_rate,
+    min_rate=upload_min_rate,
+    max_recorder_load=upload_max_recorder_load,
+)
+if upload_enabled:
+    uploader.start()
+
+
+def _publish_segment_closed(recorder: Recorder, segment_number: int):
+    event_bus.publish('segment.closed', {'recorder': recorder.name, 'segment': segment_number})
+
+
+segment_listeners.append(_publish_segment_closed)
+segment_listeners.append(uploader.on_segment_closed)
+
+
+def add_segment_listener(listener):
+    """注册切片关闭事件监听者（对已有和之后创建的录制器都生效）"""
+    segment_listeners.append(listener)
 
 
 def get_recorder_names():
@@ -69,7 +148,28 @@ def get_recorder(name: str) -> Recorder | None:
 
 
 def health() -> bool:
-    screen_ok = all(recorders[recorder].recording for recorder in screens)
-    camera_ok = all(recorders[recorder].recording for recorder in cameras)
-    logger.debug(f"Health check - Screens: {screens}, Cameras: {cameras}, Recorders: {list(recorders.keys())}")
-    return screen_ok and camera_ok and len(cameras) > 0 and len(screens) > 0 and len(recorders) == len(screens) + len(cameras)
+    with _recorders_lock:
+        screen_ok = all(recorders[recorder].recording for recorder in screens)
+        camera_ok = all(recorders[recorder].recording for recorder in cameras)
+        logger.debug(f"Health check - Screens: {screens}, Cameras: {cameras}, Recorders: {list(recorders.keys())}")
+        return screen_ok and camera_ok and len(cameras) > 0 and len(screens) > 0 and len(recorders) == len(screens) + len(cameras)
+
+
+_last_health: bool | None = None
+
+
+def _publish_health():
+    """健康状态变化时发布 'health' 事件"""
+    global _last_health
+    with _recorders_lock:
+        ok = health()
+        if ok == _last_health:
+            return
+        _last_health = ok
+        data = {'ok': ok, 'recorders': {'screen': list(screens), 'camera': list(cameras)}}
+    event_bus.publish('health', data)
+
+
+# 启动放在模块末尾：清理线程会调用上面定义的 health / _publish_health
+cleanup_thread = Thread(target=_cleanup_recorders, daemon=True)
+cleanup_thread.start()
@@ -0,0 +1,211 @@
+"""故事板缩略图
+每个切片关闭后，后台线程只解码其中的关键帧（跳过非关键帧），每隔 interval 秒取一帧缩小后拼入
+精灵图 storyboard/sprite_<k>.jpg（columns x rows 网格），并在 storyboard/index.json 中按
+(切片编号, 切片内偏移秒数) 记录每张缩略图。WebVTT 缩略图轨道由服务端按所请求的播放列表生成，
+因此同一组精灵图可以用于实时窗口列表和任意归档子列表
+"""
+from pathlib import Path
+from threading import Thread, Lock
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+import queue
+
+import av
+import cv2
+import numpy as np
+
+from utils.logger import getLogger
+
+
+logger = getLogger("recorder.storyboard")
+
+STORYBOARD_DIR = 'storyboard'
+INDEX_NAME = 'index.json'
+
+
+def sprite_name(sheet: int) -> str:
+    return f'sprite_{sheet}.jpg'
+
+
+def load_storyboard_index(folder: Path) -> Optional[Dict]:
+    path = Path(folder) / STORYBOARD_DIR / INDEX_NAME
+    try:
+        return json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+def build_vtt(index: Dict, entries: List[Tuple[int, float]], url_prefix: str) -> str:
+    """
+    按播放列表条目生成 WebVTT 缩略图轨道
+
+    Args:
+        index: 故事板索引
+        entries: 播放列表中的 [(切片编号, 时长秒), ...]
+        url_prefix: 精灵图 URL 前缀
+    """
+    starts = {}
+    elapsed = 0.0
+    for number, duration in entries:
+        starts[number] = (elapsed, duration)
+        elapsed += duration
+
+    cues = []
+    for i, (number, offset) in enumerate(index['thumbs']):
+        if number in starts:
+            seg_start, duration = starts[number]
+            cues.append((seg_start + min(offset, duration), i))
+
+    w, h, columns = index['thumb_width'], index['thumb_height'], index['columns']
+    per_sheet = columns * index['rows']
+    lines = ['WEBVTT', '']
+    for j, (start, i) in enumerate(cues):
+        end = cues[j + 1][0] if j + 1 < len(cues) else elapsed
+        if end <= start:
+            continue
+        sheet, pos = divmod(i, per_sheet)
+        row, col = divmod(pos, columns)
+        sheet += index.get('first_sheet', 0)
+        lines.append(f'{_vtt_time(start)} --> {_vtt_time(end)}')
+        lines.append(f'{url_prefix}{sprite_name(sheet)}#xywh={col * w},{row * h},{w},{h}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def _vtt_time(seconds: float) -> str:
+    ms = int(round(seconds * 1000))
+    h, ms = divmod(ms, 3600_000)
+    m, ms = divmod(ms, 60_000)
+    s, ms = divmod(ms, 1000)
+    return f'{h:02d}:{m:02d}:{s:02d}.{ms:03d}'
+
+
+class StoryboardBuilder:
+    def __init__(self, output_path: Path, width: int, height: int, interval: float = 10.0,
+                 thumb_width: int = 160, columns: int = 10, rows: int = 10):
+        """
+        output_path: 录制器输出目录
+        width / height: 录制画面尺寸，用于确定缩略图高度
+        interval: 缩略图间隔（秒），实际取不早于该间隔的下一个关键帧
+        thumb_width: 缩略图宽度
+        columns / rows: 每张精灵图的网格大小
+        """
+        self.folder = Path(output_path) / STORYBOARD_DIR
+        self.interval = interval
+        self.thumb_width = thumb_width
+        self.thumb_height = max(2, round(height * thumb_width / max(1, width)) // 2 * 2)
+        self.columns = columns
+        self.rows = rows
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        self._sheet: Optional[np.ndarray] = None
+        self._sheet_number = -1
+        # 距离上一张缩略图已经过的时长
+        self._since_last = interval
+        self._index = self._load_index()
+
+    def _load_index(self) -> Dict:
+        index = load_storyboard_index(self.folder.parent)
+        if index and (index.get('thumb_width'), index.get('thumb_height'), index.get('columns'), index.get('rows')) == \
+                (self.thumb_width, self.thumb_height, self.columns, self.rows):
+            return index
+        if index:
+            # 画面尺寸或网格变化，旧精灵图不再适用，从新的精灵图编号开始
+            logger.info("故事板参数变化，开始新的精灵图: %s", self.folder)
+        first_sheet = 0
+        if index and index.get('thumbs'):
+            per_sheet = index['columns'] * index['rows']
+            first_sheet = (len(index['thumbs']) - 1) // per_sheet + 1 + index.get('first_sheet', 0)
+        return {'thumb_width': self.thumb_width, 'thumb_height': self.thumb_height, 'columns': self.columns,
+                'rows': self.rows, 'interval': self.interval, 'first_sheet': first_sheet, 'thumbs': []}
+
+    def submit(self, segment_number: int, path: Path):
+        """切片关闭时调用（录制线程），立即返回"""
+        self._queue.put((segment_number, Path(path)))
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, name=f"storyboard-{self.folder.parent.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            segment_number, path = self._queue.get()
+            try:
+                self._process_segment(segment_number, path)
+            except Exception as e:
+                logger.error(f"生成故事板缩略图失败 ({path.name}): {e}", exc_info=True)
+
+    def _process_segment(self, segment_number: int, path: Path):
+        thumbs = []
+        duration = 0.0
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            # 只解码关键帧
+            stream.codec_context.skip_frame = 'NONKEY'
+            first = None
+            for frame in container.decode(stream):
+                if frame.time is None:
+                    continue
+                if first is None:
+                    first = frame.time
+                offset = frame.time - first
+                if self._since_last + offset >= self.interval:
+                    image = frame.to_ndarray(format='bgr24')
+                    thumbs.append((offset, cv2.resize(image, (self.thumb_width, self.thumb_height),
+                                                      interpolation=cv2.INTER_AREA)))
+                    self._since_last = -offset
+            if stream.duration and stream.time_base:
+                duration = float(stream.duration * stream.time_base)
+            elif container.duration:
+                duration = container.duration / av.time_base
+            else:
+                duration = 3.0
+        self._since_last += duration
+        for offset, thumb in thumbs:
+            self._add_thumb(segment_number, offset, thumb)
+        if thumbs:
+            self._write_sheet()
+            self._write_index()
+
+    def _add_thumb(self, segment_number: int, offset: float, thumb: np.ndarray):
+        per_sheet = self.columns * self.rows
+        with self._lock:
+            i = len(self._index['thumbs'])
+            self._index['thumbs'].append([segment_number, round(offset, 3)])
+        sheet, pos = divmod(i, per_sheet)
+        sheet += self._index.get('first_sheet', 0)
+        if sheet != self._sheet_number:
+            if self._sheet is not None and self._sheet_number >= 0:
+                self._write_sheet()
+            self._open_sheet(sheet, pos)
+        row, col = divmod(pos, self.columns)
+        y, x = row * self.thumb_height, col * self.thumb_width
+        self._sheet[y:y + self.thumb_height, x:x + self.thumb_width] = thumb
+
+    def _open_sheet(self, sheet: int, pos: int):
+        self._sheet_number = sheet
+        self._sheet = np.zeros((self.rows * self.thumb_height, self.columns * self.thumb_width, 3), dtype=np.uint8)
+        if pos > 0:
+            # 重启后继续填充未满的精灵图
+            existing = cv2.imread(str(self.folder / sprite_name(sheet)))
+            if existing is not None and existing.shape == self._sheet.shape:
+                self._sheet = existing
+
+    def _write_sheet(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self.folder / sprite_name(self._sheet_number)
+        ok, buf = cv2.imencode('.jpg', self._sheet, [cv2.IMWRITE_JPEG_QUALITY, 75])
+        if not ok:
+            raise RuntimeError("精灵图编码失败")
+        tmp = path.with_suffix('.jpg.tmp')
+        tmp.write_bytes(buf.tobytes())
+        os.replace(tmp, path)
+
+    def _write_index(self):
+        with self._lock:
+            text = json.dumps(self._index, separators=(',', ':'))
+        path = self.folder / INDEX_NAME
+        tmp = path.with_suffix('.json.tmp')
+        tmp.write_text(text, encoding='utf-8')
+        os.replace(tmp, path)
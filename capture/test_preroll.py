@@ -0,0 +1,38 @@
+import io
+
+import av
+import numpy as np
+
+from capture.live_stream import EncodedPacket
+from capture.preroll import CLIP_FORMATS, PrerollBuffer
+
+
+def main():
+    # 与录制器相同：编码流属于 mpegts 输出，数据包为 Annex B 格式
+    output = av.open(io.BytesIO(), mode='w', format='mpegts')
+    stream = output.add_stream('libx264', rate=30)
+    stream.width, stream.height, stream.pix_fmt = 64, 48, 'yuv420p'
+    stream.options = {'g': '30'}
+
+    preroll = PrerollBuffer(max_seconds=10)
+    preroll.attach(stream)
+    for i in range(90):
+        frame = av.VideoFrame.from_ndarray(np.full((48, 64, 3), i, np.uint8), format='rgb24')
+        frame.pts = i
+        for packet in stream.encode(frame):
+            preroll.append(EncodedPacket.from_av(packet))
+    for packet in stream.encode():
+        preroll.append(EncodedPacket.from_av(packet))
+    print('buffer:', preroll.stats())
+
+    for fmt in CLIP_FORMATS:
+        clip = preroll.clip(2, fmt)
+        with av.open(io.BytesIO(clip)) as container:
+            frames = sum(1 for _ in container.decode(video=0))
+        print(f'{fmt}: {len(clip)} bytes, {frames} frames')
+        assert frames >= 60, f'{fmt} clip decoded only {frames} frames'
+    print('ok')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import tempfile
+from pathlib import Path
+
+import av
+
+from capture.reencoder import SegmentReencoder
+from capture.test_segment_io import record
+
+
+def frame_times(path: Path):
+    with av.open(str(path)) as container:
+        return [(frame.pts, frame.time_base) for frame in container.decode(video=0)]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        record(folder, 24 * 7, {})
+        reencoder = SegmentReencoder(folder, get_recorders=dict, preset='slow', crf=30)
+        reencoder.is_idle = lambda: True
+        # 第二个切片的时间戳不从 0 开始，可以检查时间戳是否被保留
+        src = folder / 'video_1.ts'
+        dst = folder / 'video_1.ts.reenc'
+        reencoder._reencode_file(src, dst)
+
+        before, after = frame_times(src), frame_times(dst)
+        print('source:', before[0], '...', before[-1], len(before))
+        print('reencoded:', after[0], '...', after[-1], len(after))
+        assert before[0][0] > 0
+        assert after == before, 'reencoded timestamps differ from the source segment'
+        print('ok')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import hashlib
+import tempfile
+from pathlib import Path
+
+import av
+import numpy as np
+
+from capture.segment_io import make_segment_io_open, signature_salt
+
+
+def record(folder: Path, frames: int, digests: dict):
+    """用与录制器相同的 HLS 参数写入 frames 帧（24fps，每 3 秒一个切片）"""
+    options = {
+        'hls_time': '3',
+        'hls_list_size': '20',
+        'hls_flags': 'append_list+independent_segments',
+        'hls_segment_type': 'mpegts',
+        'hls_segment_filename': str(folder / 'video_%d.ts'),
+    }
+    io_open = make_segment_io_open(signature_salt('sid'), lambda n, digest: digests.__setitem__(n, digest))
+    with av.open(str(folder / 'video.m3u8'), mode='w', format='hls', options=options, io_open=io_open) as container:
+        stream = container.add_stream('libx264', rate=24)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, 'yuv420p'
+        stream.options = {'g': '72'}
+        for i in range(frames):
+            frame = av.VideoFrame.from_ndarray(np.full((48, 64, 3), i % 255, np.uint8), format='rgb24')
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        digests = {}
+        # 新目录：video.m3u8 还不存在，append_list 读取失败不能中断录制
+        record(folder, 24 * 7, digests)
+        segments = sorted(p.name for p in folder.glob('video_*.ts'))
+        print('fresh directory:', segments, sorted(digests))
+        assert (folder / 'video.m3u8').exists() and segments
+        # 再次录制：延续已有列表的切片编号
+        record(folder, 24 * 7, digests)
+        print('appended:', sorted(p.name for p in folder.glob('video_*.ts')))
+        for n, digest in digests.items():
+            expected = hashlib.sha1(signature_salt('sid') + (folder / f'video_{n}.ts').read_bytes()).hexdigest()
+            assert digest == expected, f'video_{n}.ts digest mismatch'
+        assert len(digests) == len(list(folder.glob('video_*.ts')))
+        print('ok')
+
+
+if __name__ == "__main__":
+    main()
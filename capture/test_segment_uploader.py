@@ -0,0 +1,92 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+import os
+import tempfile
+import time
+
+from capture.uploader import SegmentUploader
+
+
+class TusHandler(BaseHTTPRequestHandler):
+    """最小的 tus 服务端替身：上传内容保存在内存中，第一次 PATCH 返回 500 以测试续传"""
+    uploads = {}
+    failed_once = set()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, headers=None):
+        self.send_response(status)
+        self.send_header('Tus-Resumable', '1.0.0')
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        uid = str(len(self.uploads))
+        self.uploads[uid] = {'length': int(self.headers['Upload-Length']),
+                             'metadata': self.headers.get('Upload-Metadata'), 'data': b''}
+        self._reply(201, {'Location': f'/files/{uid}'})
+
+    def do_HEAD(self):
+        upload = self.uploads.get(self.path.rsplit('/', 1)[-1])
+        if upload is None:
+            return self._reply(404)
+        self._reply(200, {'Upload-Offset': str(len(upload['data'])), 'Upload-Length': str(upload['length'])})
+
+    def do_PATCH(self):
+        uid = self.path.rsplit('/', 1)[-1]
+        upload = self.uploads.get(uid)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if upload is None:
+            return self._reply(404)
+        if int(self.headers['Upload-Offset']) != len(upload['data']):
+            return self._reply(409)
+        if uid not in self.failed_once and len(upload['data']) > 0:
+            self.failed_once.add(uid)
+            return self._reply(500)
+        upload['data'] += data
+        self._reply(204, {'Upload-Offset': str(len(upload['data']))})
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TusHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_address[1]}/files/'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        media = Path(tmp)
+        folder = media / 'screen_0'
+        folder.mkdir()
+        for n in range(3):
+            (folder / f'video_{n}.ts').write_bytes(os.urandom(300 * 1024))
+        (folder / 'video_2.sig').write_text('signature')
+        old = time.time() - 10
+        os.utime(folder / 'video_2.sig', (old, old))
+
+        uploader = SegmentUploader(media, get_recorders=dict, endpoint=endpoint, chunk_size=64 * 1024,
+                                   max_rate=1024 * 1024, min_rate=256 * 1024)
+        uploader._load_state()
+        started = time.monotonic()
+        while not uploader.run_once():
+            pass
+        elapsed = time.monotonic() - started
+        print('stats:', uploader.stats, f'elapsed {elapsed:.1f}s')
+
+        received = {u['metadata']: u['data'] for u in TusHandler.uploads.values() if len(u['data']) == u['length']}
+        print('complete uploads:', len(received))
+        assert len(received) == 4
+        assert uploader.stats['errors'] > 0, 'resume path was not exercised'
+
+        # 已完成的文件在重启后不再上传
+        again = SegmentUploader(media, get_recorders=dict, endpoint=endpoint)
+        again._load_state()
+        assert not again._pending_items()
+        print('ok')
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""切片后台上传
+把已关闭的切片及其签名（video_<n>.sig、batch/reencode 清单 .msig）上传到考试服务器，
+使用 tus 1.0 可续传协议分块上传：POST 创建上传并得到地址，HEAD 查询服务端已接收的偏移，
+PATCH 从该偏移继续发送。进行中的上传（地址、偏移、文件指纹）与已完成列表保存在媒体根目录，
+进程重启后从断点继续。已被保留管理器打包的切片和签名从 pack 文件与索引中读取。
+
+带宽：发送速率不超过当前上限，上限在 [min_rate, max_rate] 内自适应——
+为本机其他网络流量（考试页面等）让出带宽，出错时减半、顺利时逐步恢复；
+任一录制器负载（Recorder.load）过高时暂停上传
+"""
+from pathlib import Path
+from threading import Thread, Event, Lock
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+import base64
+import json
+import os
+import re
+import time
+
+import psutil
+import requests
+
+from utils.logger import getLogger
+from utils.merkle import MANIFEST_SUFFIX
+from utils.segment_pack import iter_pack_indexes, load_index, packed_segments
+
+
+logger = getLogger("recorder.uploader")
+
+TUS_VERSION = '1.0.0'
+SEGMENT_PATTERN = re.compile(r'^video_(\d+)\.ts$')
+SIGNATURE_PATTERN = re.compile(r'^(?:video_(\d+)\.sig|(?:batch|reencode)_(\d+)_\d+' + re.escape(MANIFEST_SUFFIX) + ')$')
+# 进行中的上传与已完成列表，位于媒体根目录
+STATE_NAME = '.upload_state.json'
+DONE_NAME = '.uploaded'
+# .sig 直接写入（非原子），修改后至少经过该秒数才上传
+SIGNATURE_SETTLE_SECONDS = 2.0
+# (连接超时, 读取超时) 秒
+REQUEST_TIMEOUT = (5.0, 30.0)
+
+
+class UploadItem(NamedTuple):
+    key: str
+    recorder: str
+    name: str
+    size: int
+    # 内容不变时保持不变：大小 + 修改时间（打包后沿用原切片的修改时间）
+    fingerprint: str
+    order: int
+    read: Callable[[int, int], bytes]
+
+
+def _read_file(path: Path, base: int = 0) -> Callable[[int, int], bytes]:
+    def read(offset: int, length: int) -> bytes:
+        with open(path, 'rb') as f:
+            f.seek(base + offset)
+            return f.read(length)
+    return read
+
+
+def _read_bytes(data: bytes) -> Callable[[int, int], bytes]:
+    return lambda offset, length: data[offset:offset + length]
+
+
+def _b64(value: str) -> str:
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+class SegmentUploader:
+    def __init__(self, media_root: Path, get_recorders: Callable[[], Dict], endpoint: Optional[str] = None,
+                 interval: float = 10.0, chunk_size: int = 512 * 1024, max_rate: float = 2 * 1024 * 1024,
+                 min_rate: float = 128 * 1024, max_recorder_load: float = 0.6):
+        """
+        media_root: 媒体根目录
+        get_recorders: 返回当前活动录制器 {name: Recorder} 的函数
+        endpoint: tus 上传地址（创建上传的 URL），为 None 时等待 configure() 设置
+        interval: 没有待上传文件时的扫描间隔（秒）
+        chunk_size: 每个 PATCH 请求的字节数
+        max_rate / min_rate: 上传速率上限的取值范围（字节/秒）
+        max_recorder_load: 任一录制器负载高于该值时暂停上传
+        """
+        self.media_root = Path(media_root)
+        self.get_recorders = get_recorders
+        self.endpoint = endpoint
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_recorder_load = max_recorder_load
+        self.rate = max_rate
+        self.session = requests.Session()
+        self._stop_event = Event()
+        self._wake = Event()
+        self._thread = None
+        self._lock = Lock()
+        # 每个录制器已关闭的最大切片编号
+        self._closed: Dict[str, int] = {}
+        self._done: set = set()
+        self._active: Dict[str, Dict] = {}
+        self._backoff = 5.0
+        self._last_net = None
+        self._sent_since_net = 0
+        self._headroom = max_rate
+        self.stats = {'uploaded_files': 0, 'uploaded_bytes': 0, 'errors': 0, 'paused': False}
+
+    # ---- 状态持久化 ----
+
+    def _load_state(self):
+        try:
+            with open(self.media_root / DONE_NAME, encoding='utf-8') as f:
+                self._done = {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            self._done = set()
+        try:
+            self._active = json.loads((self.media_root / STATE_NAME).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self._active = {}
+
+    def _save_active(self):
+        path = self.media_root / STATE_NAME
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self._active), encoding='utf-8')
+        os.replace(tmp, path)
+
+    def _mark_done(self, item: UploadItem):
+        self._done.add(item.key)
+        with open(self.media_root / DONE_NAME, 'a', encoding='utf-8') as f:
+            f.write(item.key + '\n')
+        if self._active.pop(item.key, None) is not None:
+            self._save_active()
+
+    # ---- 外部接口 ----
+
+    def on_segment_closed(self, recorder, segment_number: int):
+        """切片关闭事件监听者（录制线程中调用）"""
+        with self._lock:
+            self._closed[recorder.name] = max(self._closed.get(recorder.name, -1), segment_number)
+        self._wake.set()
+
+    def configure(self, endpoint: str, cookies: Optional[Dict[str, str]] = None):
+        """设置上传地址，并使用登录会话的 cookie 认证上传请求（登录后调用）"""
+        self.endpoint = endpoint
+        if cookies:
+            self.session.cookies.update(cookies)
+        self._wake.set()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self.media_root.mkdir(parents=True, exist_ok=True)
+        self._load_state()
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info("切片上传已启动: endpoint=%s, max_rate=%s", self.endpoint, self.max_rate)
+
+    def stop(self, join: bool = False):
+        self._stop_event.set()
+        self._wake.set()
+        if join and self._thread:
+            self._thread.join(timeout=5.0)
+
+    # ---- 待上传文件 ----
+
+    def _is_closed(self, folder: str, number: int, recorder) -> bool:
+        if recorder is None:
+            return True
+        with self._lock:
+            closed = self._closed.get(folder, -1)
+        return number <= closed or number < getattr(recorder, 'start_segment_number', 0)
+
+    def _pending_items(self) -> List[UploadItem]:
+        items: List[UploadItem] = []
+        if not self.media_root.is_dir():
+            return items
+        recorders = self.get_recorders()
+        now = time.time()
+        for folder in sorted(p for p in self.media_root.iterdir() if p.is_dir()):
+            recorder = recorders.get(folder.name)
+            for item in self._folder_items(folder, recorder, now):
+                if item.key not in self._done:
+                    items.append(item)
+        items.sort(key=lambda item: (item.order, item.recorder, item.name))
+        return items
+
+    def _folder_items(self, folder: Path, recorder, now: float) -> Iterator[UploadItem]:
+        name = folder.name
+        seen = set()
+        for index_path in iter_pack_indexes(folder):
+            index = load_index(index_path)
+            if not index:
+                continue
+            for n, segment in packed_segments(index_path).items():
+                file = f'video_{n}.ts'
+                seen.add(file)
+                yield UploadItem(f'{name}/{file}', name, file, segment.length, f'{segment.length}-{segment.mtime:.6f}',
+                                 n, _read_file(segment.pack_path, segment.offset))
+            for n, content in index.get('sigs', {}).items():
+                file = f'video_{n}.sig'
+                data = content.encode('utf-8')
+                seen.add(file)
+                yield UploadItem(f'{name}/{file}', name, file, len(data), f'{len(data)}-packed', int(n), _read_bytes(data))
+            for file, content in index.get('manifests', {}).items():
+                m = SIGNATURE_PATTERN.match(file)
+                data = content.encode('utf-8')
+                seen.add(file)
+                yield UploadItem(f'{name}/{file}', name, file, len(data), f'{len(data)}-packed',
+                                 int(m.group(2)) if m else 0, _read_bytes(data))
+        for path in folder.iterdir():
+            file = path.name
+            if file in seen:
+                continue
+            segment = SEGMENT_PATTERN.match(file)
+            signature = None if segment else SIGNATURE_PATTERN.match(file)
+            if not segment and not signature:
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if segment:
+                number = int(segment.group(1))
+                if not self._is_closed(name, number, recorder):
+                    continue
+            else:
+                number = int(signature.group(1) or signature.group(2))
+                if now - st.st_mtime < SIGNATURE_SETTLE_SECONDS:
+                    continue
+            yield UploadItem(f'{name}/{file}', name, file, st.st_size, f'{st.st_size}-{st.st_mtime:.6f}', number,
+                             _read_file(path))
+
+    # ---- 限速与暂停 ----
+
+    def _under_pressure(self) -> bool:
+        return any(getattr(r, 'load', 0.0) > self.max_recorder_load for r in self.get_recorders().values())
+
+    def _wait_until_clear(self) -> bool:
+        """录制器负载过高时等待；返回 False 表示已停止"""
+        while not self._stop_event.is_set() and self._under_pressure():
+            if not self.stats['paused']:
+                logger.info("录制器负载过高，暂停上传")
+            self.stats['paused'] = True
+            self._stop_event.wait(2.0)
+        self.stats['paused'] = False
+        return not self._stop_event.is_set()
+
+    def _update_headroom(self):
+        """本机其他流量越大，留给上传的带宽越少"""
+        counters = psutil.net_io_counters()
+        now = time.monotonic()
+        if self._last_net is not None:
+            last_time, last_bytes = self._last_net
+            dt = now - last_time
+            if dt >= 1.0:
+                total = counters.bytes_sent + counters.bytes_recv - last_bytes
+                other = max(0.0, total - self._sent_since_net) / dt
+                self._headroom = max(self.min_rate, self.max_rate - other)
+                self._last_net = (now, counters.bytes_sent + counters.bytes_recv)
+                self._sent_since_net = 0
+        else:
+            self._last_net = (now, counters.bytes_sent + counters.bytes_recv)
+
+    def _current_rate(self) -> float:
+        return max(self.min_rate, min(self.rate, self._headroom))
+
+    def _throttle(self, sent: int, elapsed: float):
+        self._sent_since_net += sent
+        delay = sent / self._current_rate() - elapsed
+        if delay > 0:
+            self._stop_event.wait(delay)
+        # 顺利发送：逐步恢复上限
+        self.rate = min(self.max_rate, self.rate + self.min_rate / 4)
+
+    # ---- tus 协议 ----
+
+    def _headers(self, **extra) -> Dict[str, str]:
+        return {'Tus-Resumable': TUS_VERSION, 'user-agent': 'exam-client/1.0', **extra}
+
+    def _create(self, item: UploadItem) -> str:
+        metadata = f'recorder {_b64(item.recorder)},filename {_b64(item.name)}'
+        res = self.session.post(self.endpoint, headers=self._headers(**{'Upload-Length': str(item.size),
+                                                                         'Upload-Metadata': metadata}),
+                                timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        location = res.headers.get('Location')
+        if not location:
+            raise RuntimeError('Upload creation returned no Location')
+        return requests.compat.urljoin(self.endpoint, location)
+
+    def _remote_offset(self, url: str) -> Optional[int]:
+        res = self.session.head(url, headers=self._headers(), timeout=REQUEST_TIMEOUT)
+        if res.status_code in (404, 410):
+            return None
+        res.raise_for_status()
+        return int(res.headers['Upload-Offset'])
+
+    def _upload(self, item: UploadItem) -> bool:
+        """上传一个文件；返回 False 表示被停止"""
+        state = self._active.get(item.key)
+        offset = None
+        # 文件内容或上传服务器变化后重新创建上传
+        if state is not None and state.get('fingerprint') == item.fingerprint and state.get('endpoint') == self.endpoint:
+            offset = self._remote_offset(state['url'])
+        if offset is None:
+            state = {'url': self._create(item), 'endpoint': self.endpoint, 'fingerprint': item.fingerprint,
+                     'size': item.size, 'offset': 0}
+            offset = 0
+            self._active[item.key] = state
+            self._save_active()
+        while offset < item.size:
+            if not self._wait_until_clear():
+                return False
+            self._update_headroom()
+            data = item.read(offset, min(self.chunk_size, item.size - offset))
+            if not data:
+                raise RuntimeError(f'{item.key} shrank while uploading')
+            started = time.monotonic()
+            res = self.session.patch(state['url'], data=data, timeout=REQUEST_TIMEOUT,
+                                     headers=self._headers(**{'Upload-Offset': str(offset),
+                                                              'Content-Type': 'application/offset+octet-stream'}))
+            res.raise_for_status()
+            offset = int(res.headers.get('Upload-Offset', offset + len(data)))
+            state['offset'] = offset
+            self._save_active()
+            self.stats['uploaded_bytes'] += len(data)
+            self._throttle(len(data), time.monotonic() - started)
+        self._mark_done(item)
+        self.stats['uploaded_files'] += 1
+        logger.debug("已上传: %s (%d 字节)", item.key, item.size)
+        return True
+
+    def run_once(self) -> bool:
+        """上传当前所有待上传文件；返回 False 表示出错或被停止"""
+        if not self.endpoint:
+            return True
+        for item in self._pending_items():
+            if self._stop_event.is_set():
+                return False
+            try:
+                if not self._upload(item):
+                    return False
+            except (requests.RequestException, OSError, RuntimeError, ValueError, KeyError) as e:
+                self.stats['errors'] += 1
+                # 出错时上限减半
+                self.rate = max(self.min_rate, self.rate / 2)
+                logger.warning("上传失败 %s: %s，%.0f 秒后重试", item.key, e, self._backoff)
+                return False
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            # 先清除再扫描：扫描期间关闭的切片设置的唤醒不会丢失
+            self._wake.clear()
+            try:
+                ok = self.run_once()
+            except Exception:
+                logger.exception("切片上传执行失败")
+                ok = False
+            if ok:
+                self._backoff = 5.0
+                self._wake.wait(self.interval)
+            else:
+                self._stop_event.wait(self._backoff)
+                self._backoff = min(self._backoff * 2, 300.0)
@@ -8,3 +8,77 @@ lVe0qEYYvFfbAbDV3TCCbsMhl4rJBEHZD+o0S+9HMFNWHSK8ItXoOE0GIl7froYw
 VQIDAQAB
 -----END PUBLIC KEY-----"""
 
+
+# 切片签名模式:
+#   "merkle" - 每批切片构建 Merkle 树，只签名树根并为每个切片写入包含证明，覆盖全部切片
+#   "sample" - 每 3 批检测到的切片抽样签名其中一个切片（旧行为）
+video_sign_mode = "merkle"
+# merkle 模式下每批签名的切片数量
+video_sign_batch_size = 10
+
+# 归档播放列表（capture.archive_playlist.ArchivePlaylist）每个子播放列表覆盖的时长（秒），
+# 录制中的子列表结束后才会被保留策略与重编码处理
+media_archive_chunk_duration = 3600
+
+# 媒体目录保留与压缩策略（capture.retention.RetentionManager）
+# 检查间隔（秒）
+media_retention_interval = 300
+# 媒体目录磁盘预算（字节），超出时从最旧的打包切片开始删除；None 表示不限制
+media_max_bytes = None
+# 打包切片的最长保留天数；None 表示不按时间删除
+media_max_age_days = None
+# 打包时的磁盘读写速率上限（字节/秒）
+media_compact_io_rate = 8 * 1024 * 1024
+# 系统 CPU 占用高于该百分比时暂停打包，避免与录制争抢资源
+media_compact_cpu_threshold = 70.0
+
+# 空闲时后台重编码（capture.reencoder.SegmentReencoder），只处理 merkle 模式签名的切片
+media_reencode_enabled = True
+media_reencode_preset = "slow"
+media_reencode_crf = 23
+# 除本进程外的系统 CPU 占用低于该百分比才视为空闲
+media_reencode_idle_cpu = 30.0
+
+# 服务端热点媒体缓存（最新切片与播放列表）的内存上限（字节）
+media_cache_bytes = 64 * 1024 * 1024
+
+# 低延迟 WebSocket 直播：单个观看者允许积压的最大字节数，超出时丢弃积压并从下一个关键帧继续
+live_stream_max_pending_bytes = 4 * 1024 * 1024
+
+# 即时回放的内存预录缓冲：保留最近的时长（秒）与字节数上限（每个录制器）
+preroll_seconds = 60
+preroll_max_bytes = 32 * 1024 * 1024
+
+# 故事板缩略图：间隔（秒）、缩略图宽度与每张精灵图的网格大小
+storyboard_interval = 10
+storyboard_thumb_width = 160
+storyboard_columns = 10
+storyboard_rows = 10
+
+# /recorder/* 与 /screenshot 的令牌桶限流：每个客户端与全局各一组（请求数/秒、字节/秒及突发容量），None 表示不限制
+rate_limit_client_rps = 20.0
+rate_limit_client_burst = 40
+rate_limit_client_bps = 16 * 1024 * 1024
+rate_limit_client_burst_bytes = 32 * 1024 * 1024
+rate_limit_global_rps = 100.0
+rate_limit_global_burst = 200
+rate_limit_global_bps = 64 * 1024 * 1024
+rate_limit_global_burst_bytes = 128 * 1024 * 1024
+# 可信反向代理的地址：只有来自这些地址的请求才按 X-Forwarded-For 识别客户端，否则使用连接的对端地址
+rate_limit_trusted_proxies = []
+
+# 报警上报的本地 spool：文件路径、未确认记录的大小上限（字节，超出时丢弃最旧的）与每批上报的记录数
+alert_spool_path = "./spool/alerts.jsonl"
+alert_spool_max_bytes = 4 * 1024 * 1024
+alert_spool_batch_size = 200
+
+# 切片后台上传（capture.uploader.SegmentUploader）：登录后把已关闭的切片与签名分块续传到 http://<考试服务器><upload_path>
+upload_enabled = True
+upload_path = "/exam/upload"
+# 每个分块的字节数
+upload_chunk_size = 512 * 1024
+# 上传速率上限与下限（字节/秒），本机其他网络流量增大时在两者之间自动降低
+upload_max_rate = 2 * 1024 * 1024
+upload_min_rate = 128 * 1024
+# 任一录制器负载高于该值时暂停上传
+upload_max_recorder_load = 0.6
@@ -1,51 +1,135 @@
 """内存使用监视器
 检测系统内存占用并检测敏感进程名
+
+增量扫描：每次只列出 PID，新出现的进程才读取名称并用预编译的多模式正则匹配敏感名称，
+匹配结果按 (pid, create_time) 缓存；内存占用只对接近阈值的进程和敏感进程每次刷新，
+其余进程每隔 full_scan_every 次才全部刷新一次
 """
-from typing import List, Dict
+from typing import List, Dict, Tuple
+import re
 
 import psutil
 
+from .timeseries import TimeSeriesStore, default_store, series_name
 from utils.logger import getLogger
 
 
 logger = getLogger(__name__)
 
+# 单进程内存阈值：>= 6 GiB 或 >= 总内存的 70%
+PROCESS_LIMIT_MB = 6 * 1024
+PROCESS_LIMIT_RATIO = 0.7
+
+
+class _Tracked:
+    """一个已跟踪进程的缓存信息"""
+    __slots__ = ('process', 'name', 'matched', 'rss_mb')
+
+    def __init__(self, process: psutil.Process, name: str, matched: List[str]):
+        self.process = process
+        self.name = name
+        self.matched = matched
+        self.rss_mb = 0
+
 
 class MemMonitor:
-    def __init__(self, sensitive_names=None):
-        # sensitive_names: list of substrings to search in process names
+    def __init__(self, sensitive_names=None, full_scan_every: int = 6, near_ratio: float = 0.5,
+                 store: TimeSeriesStore | None = default_store, record_min_mb: int = 256):
+        """
+        sensitive_names: list of substrings to search in process names
+        full_scan_every: 每隔多少次采样刷新全部进程的内存占用
+        near_ratio: 内存占用达到阈值的该比例即视为接近阈值，每次采样都刷新
+        store: 记录进程内存占用的时序存储，None 表示不记录
+        record_min_mb: 只记录内存占用不低于该值（MiB）的进程，限制序列数量
+        """
+        self.store = store
+        self.record_min_mb = record_min_mb
         self.sensitive_names = sensitive_names or ['chatgpt', 'gpt', 'llama', 'minimax', 'gpt4', 'gpt-4', 'stable-diffusion', 'sd-webui']
+        # 一次正则搜索判断是否命中任一敏感名称，命中时再列出具体匹配项
+        self._matcher = re.compile('|'.join(re.escape(s) for s in sorted(self.sensitive_names, key=len, reverse=True)))
+        self.full_scan_every = max(1, full_scan_every)
+        self.near_ratio = near_ratio
+        # {(pid, create_time): _Tracked}
+        self._tracked: Dict[Tuple[int, float], _Tracked] = {}
+        self._by_pid: Dict[int, Tuple[int, float]] = {}
+        self._ticks = 0
+
+    def _match(self, name: str) -> List[str]:
+        if not self._matcher.search(name):
+            return []
+        return [s for s in self.sensitive_names if s in name]
+
+    def _track_new(self, pid: int):
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                key = (pid, process.create_time())
+                try:
+                    name = (process.name() or '').lower()
+                except psutil.AccessDenied:
+                    name = ''
+                tracked = _Tracked(process, name, self._match(name))
+                self._refresh(pid, tracked)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            # common and expected for short-lived or protected processes
+            logger.debug('Process disappeared or access denied during memory check')
+            return
+        self._tracked[key] = tracked
+        self._by_pid[pid] = key
+
+    def _forget(self, pid: int):
+        key = self._by_pid.pop(pid, None)
+        if key is not None:
+            self._tracked.pop(key, None)
+
+    def _refresh(self, pid: int, tracked: _Tracked):
+        try:
+            tracked.rss_mb = int(tracked.process.memory_info().rss / 1024 / 1024)
+            if self.store is not None and tracked.rss_mb >= self.record_min_mb:
+                self.store.record(series_name('mem.rss_mb', pid=pid, name=tracked.name), tracked.rss_mb)
+        except psutil.NoSuchProcess:
+            self._forget(pid)
+        except psutil.AccessDenied:
+            # protected process: keep it tracked so it is not probed again every tick
+            tracked.rss_mb = 0
+
+    def _scan(self, limit_mb: int):
+        pids = set(psutil.pids())
+        for pid in [pid for pid in self._by_pid if pid not in pids]:
+            self._forget(pid)
+        known = set(self._by_pid)
+        full = self._ticks % self.full_scan_every == 0
+        near = limit_mb * self.near_ratio
+        for pid, key in list(self._by_pid.items()):
+            tracked = self._tracked[key]
+            if full or tracked.matched or tracked.rss_mb >= near:
+                # is_running 同时校验 create_time，PID 被复用时重新识别
+                if not tracked.process.is_running():
+                    self._forget(pid)
+                    known.discard(pid)
+                    continue
+                self._refresh(pid, tracked)
+        for pid in pids - known:
+            self._track_new(pid)
+        self._ticks += 1
 
     def __call__(self) -> List[Dict]:
         alerts: List[Dict] = []
         try:
             vm = psutil.virtual_memory()
             total_mb = int(vm.total / 1024 / 1024)
-            # New heuristics (per your request):
-            # - single process uses >= 6 GiB -> alert
-            # - single process uses >= 70% of total memory -> alert
-            # (we check processes below)
+            pct_limit = int(total_mb * PROCESS_LIMIT_RATIO) if total_mb > 0 else PROCESS_LIMIT_MB
+            self._scan(min(PROCESS_LIMIT_MB, pct_limit))
 
-            # check processes for sensitive names and high memory usage
-            for p in psutil.process_iter(['pid', 'name', 'memory_info']):
-                try:
-                    name = (p.info.get('name') or '').lower()
-                    mem_rss = int(getattr(p.info.get('memory_info'), 'rss', 0) / 1024 / 1024)
-                    # check single-process thresholds: >=6GiB or >=70% of total
-                    try:
-                        if mem_rss >= 6 * 1024:
-                            alerts.append({'id': f'mem-process-6gb-{p.info.get("pid")}', 'text': f'Process {name} (pid {p.info.get("pid")}) using {mem_rss} MiB >= 6 GiB', 'meta': {'pid': p.info.get('pid'), 'process': name, 'used_mb': mem_rss}})
-                        elif total_mb > 0 and mem_rss >= int(total_mb * 0.7):
-                            alerts.append({'id': f'mem-process-highpct-{p.info.get("pid")}', 'text': f'Process {name} (pid {p.info.get("pid")}) using {mem_rss} MiB >= 70% of total memory ({total_mb} MiB)', 'meta': {'pid': p.info.get('pid'), 'process': name, 'used_mb': mem_rss}})
-                    except Exception:
-                        logger.debug('Error checking process memory thresholds', exc_info=True)
-                    for s in self.sensitive_names:
-                        if s in name:
-                            alerts.append({'id': f'mem-sensitive-{p.info.get("pid")}-{s}', 'text': f'Sensitive process name matched: {name} (pid {p.info.get("pid")}) memory {mem_rss} MiB', 'meta': {'pid': p.info.get('pid'), 'process': name, 'used_mb': mem_rss, 'matched': s}})
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
-                    # common and expected for short-lived or protected processes
-                    logger.debug('Process disappeared or access denied during memory check')
-                    continue
+            for (pid, _), tracked in self._tracked.items():
+                name, mem_rss = tracked.name, tracked.rss_mb
+                # check single-process thresholds: >=6GiB or >=70% of total
+                if mem_rss >= PROCESS_LIMIT_MB:
+                    alerts.append({'id': f'mem-process-6gb-{pid}', 'text': f'Process {name} (pid {pid}) using {mem_rss} MiB >= 6 GiB', 'meta': {'pid': pid, 'process': name, 'used_mb': mem_rss}})
+                elif total_mb > 0 and mem_rss >= pct_limit:
+                    alerts.append({'id': f'mem-process-highpct-{pid}', 'text': f'Process {name} (pid {pid}) using {mem_rss} MiB >= 70% of total memory ({total_mb} MiB)', 'meta': {'pid': pid, 'process': name, 'used_mb': mem_rss}})
+                for s in tracked.matched:
+                    alerts.append({'id': f'mem-sensitive-{pid}-{s}', 'text': f'Sensitive process name matched: {name} (pid {pid}) memory {mem_rss} MiB', 'meta': {'pid': pid, 'process': name, 'used_mb': mem_rss, 'matched': s}})
         except Exception:
             logger.exception('Failed to run MemMonitor')
         return alerts
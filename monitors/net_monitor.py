@@ -1,28 +1,137 @@
 """联网检测监视器
-定时请求互联网网站判断是否联网，发现可达外网则返回报警
+定时探测互联网是否可达，发现可达外网则返回报警
+
+各探测并发执行，任一成功即停止其余探测；探测都很轻量（TCP 连接、HTTP HEAD 或 DNS 解析），
+不会下载整个网页。失败的探测按指数退避暂缓，直到退避到期才重新探测
+探测项格式：
+    tcp://host:port       TCP 连接成功即视为可达
+    http(s)://host/path   HEAD 请求返回 2xx/3xx 即视为可达
+    dns://host            域名解析成功即视为可达
 """
-from typing import List, Dict
-import requests
+from typing import List, Dict, Optional
+from urllib.parse import urlsplit
+import asyncio
+import socket
+import ssl
+import time
+
 from utils.logger import getLogger
 
 
 logger = getLogger(__name__)
 
+DEFAULT_PROBES = ['tcp://www.baidu.com:443', 'tcp://www.bing.com:443', 'https://www.baidu.com']
+
+
+class ProbeFailed(Exception):
+    pass
+
+
+async def _probe_tcp(host: str, port: int) -> Dict:
+    _, writer = await asyncio.open_connection(host, port)
+    writer.close()
+    return {'host': host, 'port': port}
+
+
+async def _probe_head(url: str) -> Dict:
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl.create_default_context() if https else None)
+    try:
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        writer.write(f'HEAD {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        status_line = (await reader.readline()).decode(errors='replace').split()
+    finally:
+        writer.close()
+    if len(status_line) < 2 or not status_line[1].isdigit():
+        raise ProbeFailed(f'invalid HTTP response from {url}')
+    status_code = int(status_line[1])
+    if not 200 <= status_code < 400:
+        raise ProbeFailed(f'HTTP {status_code} from {url}')
+    return {'url': url, 'status_code': status_code}
+
+
+async def _probe_dns(host: str) -> Dict:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    return {'host': host, 'addresses': sorted({info[4][0] for info in infos})}
+
+
+class _Probe:
+    def __init__(self, spec: str):
+        self.spec = spec
+        parts = urlsplit(spec)
+        self.scheme = parts.scheme.lower()
+        if self.scheme == 'tcp' and parts.hostname and parts.port:
+            self.run = lambda: _probe_tcp(parts.hostname, parts.port)
+        elif self.scheme in ('http', 'https') and parts.hostname:
+            self.run = lambda: _probe_head(spec)
+        elif self.scheme == 'dns' and parts.hostname:
+            self.run = lambda: _probe_dns(parts.hostname)
+        else:
+            raise ValueError(f'Invalid network probe: {spec}')
+        self.failures = 0
+        self.retry_at = 0.0
+
 
 class NetMonitor:
-    def __init__(self, urls=None, timeout=3):
-        # urls to probe
-        self.urls = urls or ['https://www.baidu.com', 'https://www.bing.com']
+    def __init__(self, urls=None, timeout=3, probes=None, backoff_min=10.0, backoff_max=60.0):
+        """
+        urls: 兼容旧参数，http(s) 地址以 HEAD 方式探测
+        timeout: 单个探测的超时（秒）
+        probes: 探测项列表（见模块说明），默认 DEFAULT_PROBES；测试时可指向本地的替身服务
+        backoff_min / backoff_max: 探测失败后暂缓的初始与最大时长（秒），每次连续失败翻倍
+        """
+        self.probes = [_Probe(p) for p in (probes or urls or DEFAULT_PROBES)]
         self.timeout = timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+    async def _run_probe(self, probe: _Probe) -> Dict:
+        return await asyncio.wait_for(probe.run(), self.timeout)
+
+    def _failed(self, probe: _Probe, exc: BaseException):
+        probe.failures += 1
+        delay = min(self.backoff_max, self.backoff_min * 2 ** (probe.failures - 1))
+        probe.retry_at = time.monotonic() + delay
+        logger.debug('Network probe %s failed (%r); next try in %.0fs', probe.spec, exc, delay)
+
+    async def _first_success(self, due: List[_Probe]) -> Optional[tuple]:
+        tasks = {asyncio.ensure_future(self._run_probe(p)): p for p in due}
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    probe = tasks[task]
+                    exc = task.exception()
+                    if exc is None:
+                        probe.failures = 0
+                        probe.retry_at = 0.0
+                        return probe, task.result()
+                    self._failed(probe, exc)
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def __call__(self) -> List[Dict]:
-        alerts: List[Dict] = []
-        for u in self.urls:
-            try:
-                r = requests.get(u, timeout=self.timeout)
-                if r.status_code == 200:
-                    alerts.append({'id': f'net-reachable-{u}', 'text': f'Internet reachable: {u}', 'meta': {'url': u, 'status_code': r.status_code}})
-            except requests.RequestException:
-                logger.debug('Network probe failed for %s', u, exc_info=True)
-                continue
-        return alerts
+        now = time.monotonic()
+        due = [p for p in self.probes if p.retry_at <= now]
+        if not due:
+            return []
+        try:
+            result = asyncio.run(self._first_success(due))
+        except Exception:
+            logger.exception('Network probes failed unexpectedly')
+            return []
+        if result is None:
+            return []
+        probe, meta = result
+        # id 固定：哪个探测先成功每次都可能不同，不应产生报警的出现/消失增量
+        return [{'id': 'net-reachable', 'text': f'Internet reachable: {probe.spec}', 'meta': {'url': probe.spec, **meta}}]
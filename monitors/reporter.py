@@ -1,30 +1,71 @@
+"""把监视器报警上报到考试服务器
+
+只上报增量：每条增量包含新出现的报警 (raised) 与已消失的报警 id (cleared) 以及递增的序号 seq，
+服务端据此去重（重试可能重复投递）并发现缺失；登录后的第一条、spool 丢弃过记录后以及服务端要求重新同步
+（响应 {"resync": true}）时上报全量 (full)。增量先写入本地 spool（monitors.spool.AlertSpool），
+由后台线程以 {"deltas": [...]} 批量上报，服务器不可达期间不会丢失。
+队列为空时每隔 heartbeat_interval 发送一次心跳，携带当前报警数与已确认的序号。
+较大的请求体使用 gzip 压缩，连接通过 keep-alive 会话复用，失败时有限次重试
+"""
+import gzip
 import json
+import time
 from typing import List, Dict
 
 import requests
+from requests.adapters import HTTPAdapter
 from urllib import parse
+from urllib3.util.retry import Retry
 
 from .service import MonitorService
+from .spool import AlertSpool
+from config import alert_spool_path, alert_spool_max_bytes, alert_spool_batch_size
+from utils.event_bus import event_bus
 from utils.logger import getLogger
 
 
 logger = getLogger(__name__)
 
+# 请求体超过该大小（字节）时 gzip 压缩
+GZIP_MIN_BYTES = 1024
+# (连接超时, 读取超时) 秒
+REQUEST_TIMEOUT = (3.0, 10.0)
+
+
+def _alert_id(alert: Dict) -> str:
+    # 与 MonitorService._merge_alerts 的退化 id 一致
+    return alert.get('id') or f"noid-{hash(alert.get('text'))}"
+
 
 class MonitorReporter:
-    def __init__(self, username: str, password: str, endpoint: str, interval: float = 10.0):
+    def __init__(self, username: str, password: str, endpoint: str, interval: float = 10.0, heartbeat_interval: float = 60.0):
         HEADERS = {
             'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8', 
             'user-agent': 'exam-client/1.0'
         }
         data = {'uname': username, 'password': password, 'tfa': None, 'authnChallenge': None}
         self.session = requests.session()
+        # keep-alive 连接池 + 有限次重试；POST 也重试，服务端按 seq 去重
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({'POST'}), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         res = self.session.post(f'http://{endpoint}/login', data=parse.urlencode(data), headers=HEADERS)
         res.raise_for_status()
         print(self.session.cookies.get_dict())
         self.endpoint = endpoint
         self.service = MonitorService(callback=self.report, interval=interval)
         self.alerts: List[Dict] | None = None
+        self.spool = AlertSpool(alert_spool_path, self._send_batch, max_bytes=alert_spool_max_bytes,
+                                batch_size=alert_spool_batch_size, heartbeat=self._heartbeat,
+                                heartbeat_interval=heartbeat_interval)
+        # 序号在重启后延续
+        self.seq = self.spool.last_seq
+        # 最近一次写入 spool 的报警 {id: alert}；None 表示下一条增量为全量
+        self._state: Dict[str, Dict] | None = None
+        self._dropped_seen = self.spool.dropped
+        self._resync = False
 
     def get_cookies(self):
         return self.session.cookies.get_dict()
@@ -32,23 +73,67 @@ class MonitorReporter:
     def get_alerts(self):
         return self.alerts
 
+    def _post(self, payload: Dict) -> requests.Response:
+        HEADERS = {
+            'Content-Type': 'application/json;charset=utf-8',
+            'accept': 'application/json',
+            'user-agent': 'exam-client/1.0'
+        }
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        if len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body)
+            HEADERS['Content-Encoding'] = 'gzip'
+        res = self.session.post(f'http://{self.endpoint}/exam/alert', data=body, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        return res
+
+    def _check_resync(self, res: requests.Response):
+        try:
+            resync = bool(res.content) and bool(res.json().get('resync'))
+        except (ValueError, AttributeError):
+            resync = False
+        if resync:
+            logger.info('Server requested a full alert resync')
+            self._resync = True
+
+    def _send_batch(self, deltas: List[Dict]):
+        # spool 后台线程调用，抛出异常表示未送达
+        self._check_resync(self._post({'deltas': deltas}))
+
+    def _heartbeat(self):
+        self._check_resync(self._post({'heartbeat': True, 'active': len(self._state or {}), 'seq': self.spool.acked_seq}))
+
+    def _next_delta(self, current: Dict[str, Dict]) -> Dict | None:
+        if self._state is None:
+            return {'full': True, 'raised': list(current.values()), 'cleared': []}
+        raised = [a for aid, a in current.items() if aid not in self._state]
+        cleared = [aid for aid in self._state if aid not in current]
+        if raised or cleared:
+            return {'full': False, 'raised': raised, 'cleared': cleared}
+        return None
+
     def report(self, alerts: List[Dict]):
-        if not alerts:
+        self.alerts = alerts.copy()
+        current = {_alert_id(a): a for a in alerts}
+        if self._resync or self.spool.dropped != self._dropped_seen:
+            # 服务端要求或本地丢弃过增量：下一条发送全量
+            self._resync = False
+            self._dropped_seen = self.spool.dropped
+            self._state = None
+        delta = self._next_delta(current)
+        if delta is None:
             return
-        try:
-            self.alerts = alerts.copy()
-            HEADERS = {
-                'Content-Type': 'application/json;charset=utf-8',
-                'accept': 'application/json',
-                'user-agent': 'exam-client/1.0'
-            }
-            res = self.session.post(f'http://{self.endpoint}/exam/alert', json={'alerts': json.dumps(alerts)}, headers=HEADERS)
-            res.raise_for_status()
-        except Exception:
-            logger.exception('Failed to report alerts to server')
+        self.seq += 1
+        delta['seq'] = self.seq
+        delta['ts'] = time.time()
+        self.spool.put(delta)
+        self._state = current
+        event_bus.publish('alerts.delta', delta)
 
     def start(self):
+        self.spool.start()
         self.service.start()
 
     def stop(self, join: bool = True):
         self.service.stop(join=join)
+        self.spool.stop()
@@ -1,30 +1,104 @@
-"""监视服务：定期调度各监视器采样并把合并的报警通过回调返回"""
-from typing import Callable, List, Dict, Iterable, Type
+"""监视服务：定期调度各监视器采样并把合并的报警通过回调返回
+各监视器在各自的守护线程中并发运行，每个监视器有独立的采样间隔与超时：超时未返回的监视器沿用上一次的结果
+并标记为过期 (stale)，不会拖慢其他监视器，也不会被重复提交
+"""
+from concurrent.futures import Future, wait
+from typing import Callable, List, Dict, Iterable, Type, Tuple
 import threading
 import time
 
 from . import VMMonitor, VRAMMonitor, MemMonitor, NetMonitor
+from .system_sampler import SystemSampler
 from utils.logger import getLogger
 
 
 logger = getLogger(__name__)
 
+# 默认的 (采样间隔秒, 超时秒)，按监视器类名；未列出的监视器使用服务的 interval
+DEFAULT_SCHEDULES: Dict[str, Tuple[float, float]] = {
+    'VMMonitor': (60.0, 10.0),
+    'VRAMMonitor': (10.0, 5.0),
+    'MemMonitor': (10.0, 5.0),
+    'NetMonitor': (10.0, 5.0),
+}
+
+
+class _MonitorSlot:
+    """一个监视器的调度状态"""
+
+    def __init__(self, monitor, interval: float, timeout: float):
+        self.monitor = monitor
+        self.name = type(monitor).__name__
+        self.interval = interval
+        self.timeout = timeout
+        self.next_due = 0.0
+        self.future: Future | None = None
+        self.started_at = 0.0
+        self.last_result: List[Dict] = []
+        self.last_duration: float | None = None
+        self.last_success: float | None = None
+        self.stale = False
+
+    def collect(self):
+        """收取已完成的采样结果"""
+        if self.future is None or not self.future.done():
+            return
+        future, self.future = self.future, None
+        self.last_duration = time.monotonic() - self.started_at
+        try:
+            self.last_result = future.result()
+            self.last_success = time.time()
+            self.stale = False
+        except Exception:
+            logger.exception('Monitor %s raised an exception', self.name)
+            self.stale = True
+
+    def submit(self):
+        """在守护线程中运行一次采样。不使用线程池：线程池的工作线程在解释器退出时会被 join，
+        卡住的监视器（如 WMI 查询）会阻塞程序退出
+        """
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+
+        def run():
+            try:
+                future.set_result(self.monitor())
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.future = future
+        threading.Thread(target=run, daemon=True, name=f'monitor-{self.name}').start()
+
+    def alerts(self) -> List[Dict]:
+        if not self.stale:
+            return self.last_result
+        return [{**a, 'stale': True} for a in self.last_result]
+
 
 class MonitorService:
-    def __init__(self, callback: Callable[[List[Dict]], None], interval: float = 10.0, monitors: Iterable[Type] | None = None):
+    def __init__(self, callback: Callable[[List[Dict]], None], interval: float = 10.0, monitors: Iterable[Type] | None = None,
+                 schedules: Dict[str, Tuple[float, float]] | None = None, sample_metrics: bool = True):
         """
         callback: 在每次采样后被调用，参数为合并后的报警列表
-        interval: 采样间隔（秒）
+        interval: 回调间隔（秒），也是未配置监视器的采样间隔
         monitors: 可选的监视器类 iterable，默认按包内四个监视器顺序实例化
+        schedules: 可选的 {监视器类名: (采样间隔秒, 超时秒)}，覆盖 DEFAULT_SCHEDULES
+        sample_metrics: 是否同时运行 SystemSampler，把系统指标写入 monitors.timeseries.default_store
         """
+        self.sampler = SystemSampler() if sample_metrics else None
         self.callback = callback
         self.interval = interval
         self._stop_event = threading.Event()
         self._thread = None
         if monitors is None:
             monitors = [VMMonitor, VRAMMonitor, MemMonitor, NetMonitor]
+        schedules = {**DEFAULT_SCHEDULES, **(schedules or {})}
         # instantiate monitors
         self.monitors = [m() for m in monitors]
+        self._slots = []
+        for m in self.monitors:
+            every, timeout = schedules.get(type(m).__name__, (interval, interval))
+            self._slots.append(_MonitorSlot(m, every, timeout))
 
     def _merge_alerts(self, alerts_lists: Iterable[List[Dict]]) -> List[Dict]:
         # 合并并按 'id' 去重，保留首个出现的
@@ -42,19 +116,58 @@ class MonitorService:
                 merged.append(a)
         return merged
 
+    def _tick(self):
+        """提交到期的监视器并等待它们在各自的超时内完成"""
+        now = time.monotonic()
+        submitted = []
+        for slot in self._slots:
+            slot.collect()
+            if slot.future is not None:
+                # 上一次采样仍未返回（已超时），不重复提交
+                continue
+            if now >= slot.next_due:
+                slot.started_at = now
+                slot.next_due = now + slot.interval
+                slot.submit()
+                submitted.append(slot)
+        if submitted:
+            deadline = max(s.started_at + s.timeout for s in submitted)
+            wait([s.future for s in submitted], timeout=max(0.0, deadline - time.monotonic()))
+        for slot in self._slots:
+            slot.collect()
+            if slot.future is not None and time.monotonic() - slot.started_at >= slot.timeout:
+                if not slot.stale:
+                    logger.warning('Monitor %s exceeded its %.1fs timeout; reusing last result', slot.name, slot.timeout)
+                slot.stale = True
+
+    def status(self) -> Dict[str, Dict]:
+        """各监视器的最近运行状态"""
+        return {
+            s.name: {
+                'interval': s.interval,
+                'timeout': s.timeout,
+                'running': s.future is not None,
+                'stale': s.stale,
+                'last_duration': s.last_duration,
+                'last_success': s.last_success,
+            }
+            for s in self._slots
+        }
+
     def _run(self):
         while not self._stop_event.is_set():
+            started = time.monotonic()
             try:
-                all_alerts = [m() for m in self.monitors]
-                merged = self._merge_alerts(all_alerts)
+                self._tick()
+                merged = self._merge_alerts(slot.alerts() for slot in self._slots)
                 try:
                     self.callback(merged)
                 except Exception:
                     logger.exception('MonitorService callback raised an exception')
             except Exception:
                 logger.exception('Unexpected error in MonitorService main loop')
-            # 等待 interval 秒或直到停止
-            self._stop_event.wait(self.interval)
+            # 等待到下一个 interval 或直到停止，采样耗时计入间隔
+            self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
 
     def start(self):
         if self._thread and self._thread.is_alive():
@@ -62,10 +175,22 @@ class MonitorService:
         self._stop_event.clear()
         self._thread = threading.Thread(target=self._run, daemon=True)
         self._thread.start()
+        if self.sampler is not None:
+            self.sampler.start()
         logger.info('MonitorService started with interval=%s', self.interval)
 
     def stop(self, join: bool = False):
         self._stop_event.set()
+        if self.sampler is not None:
+            self.sampler.stop()
         if join and self._thread:
             self._thread.join(timeout=5.0)
+        # 结束监视器持有的常驻会话（如 VRAMMonitor 的 nvidia-smi 子进程）
+        for m in self.monitors:
+            close = getattr(m, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    logger.exception('Failed to close monitor %s', type(m).__name__)
         logger.info('MonitorService stopped')
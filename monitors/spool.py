@@ -0,0 +1,203 @@
+"""报警的本地持久化队列 (spool)
+考试服务器不可达时报警不会丢失：每条记录先追加写入本地 JSON Lines 文件，再由后台线程批量上报，
+服务端确认后记录已确认的序号；进程重启后未确认的记录会继续上报。
+上报失败按指数退避重试；文件超过 max_bytes 时从最旧的未确认记录开始丢弃。
+put() 只把记录放入内存队列，磁盘写入与网络请求都在后台线程中完成，不会拖慢监视器循环
+"""
+from collections import deque
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import json
+import os
+import threading
+import time
+
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class AlertSpool:
+    def __init__(self, path, send: Callable[[List[Dict]], None], max_bytes: int = 4 * 1024 * 1024,
+                 batch_size: int = 200, backoff_min: float = 1.0, backoff_max: float = 300.0,
+                 heartbeat: Optional[Callable[[], None]] = None, heartbeat_interval: float = 60.0):
+        """
+        path: spool 文件路径，已确认的序号保存在同目录的 <name>.ack
+        send: 上报一批记录的函数，失败时抛出异常
+        max_bytes: 未确认记录的总大小上限（字节）
+        batch_size: 每次上报的最大记录数
+        backoff_min / backoff_max: 上报失败后重试的初始与最大间隔（秒）
+        heartbeat: 可选，队列为空且 heartbeat_interval 内没有上报时在后台线程中调用
+        """
+        self.path = Path(path)
+        self.ack_path = self.path.with_name(self.path.name + '.ack')
+        self.send = send
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        # 尚未写入磁盘的记录（监视器线程写入，后台线程取出）
+        self._incoming: Deque[Dict] = deque()
+        # 已写入磁盘、尚未确认的记录 (seq, 行)
+        self._pending: Deque[Tuple[int, bytes]] = deque()
+        self._pending_bytes = 0
+        self._file_bytes = 0
+        self.acked_seq = 0
+        self.last_seq = 0
+        self.dropped = 0
+        self._backoff = backoff_min
+        self._retry_at = 0.0
+        self._last_sent = time.monotonic()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._load()
+
+    def _load(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.acked_seq = int(json.loads(self.ack_path.read_text()).get('seq', 0))
+        except (OSError, ValueError, AttributeError):
+            self.acked_seq = 0
+        self.last_seq = self.acked_seq
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        seq = int(json.loads(line)['seq'])
+                    except (ValueError, KeyError, TypeError):
+                        # 崩溃时写了一半的行
+                        continue
+                    self.last_seq = max(self.last_seq, seq)
+                    if seq > self.acked_seq:
+                        self._pending.append((seq, line if line.endswith(b'\n') else line + b'\n'))
+                        self._pending_bytes += len(self._pending[-1][1])
+        except FileNotFoundError:
+            pass
+        if self._pending:
+            logger.info('Alert spool %s has %d unsent records', self.path, len(self._pending))
+        self._rewrite()
+
+    def _rewrite(self):
+        """只保留未确认的记录（原子替换）"""
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            for _, line in self._pending:
+                f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._file_bytes = self._pending_bytes
+
+    def _write_ack(self):
+        tmp = self.ack_path.with_name(self.ack_path.name + '.tmp')
+        tmp.write_text(json.dumps({'seq': self.acked_seq}))
+        os.replace(tmp, self.ack_path)
+
+    def put(self, record: Dict):
+        """追加一条带 'seq' 的记录，立即返回"""
+        self._incoming.append(record)
+        self._wake.set()
+
+    def _drain_incoming(self):
+        if not self._incoming:
+            return
+        lines = []
+        while self._incoming:
+            record = self._incoming.popleft()
+            line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+            lines.append((int(record['seq']), line))
+        with open(self.path, 'ab') as f:
+            for _, line in lines:
+                f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        for seq, line in lines:
+            self._pending.append((seq, line))
+            self._pending_bytes += len(line)
+            self._file_bytes += len(line)
+            self.last_seq = max(self.last_seq, seq)
+        if self._pending_bytes > self.max_bytes:
+            dropped = 0
+            while self._pending and self._pending_bytes > self.max_bytes:
+                seq, line = self._pending.popleft()
+                self._pending_bytes -= len(line)
+                self.acked_seq = max(self.acked_seq, seq)
+                dropped += 1
+            self.dropped += dropped
+            logger.warning('Alert spool over %d bytes; dropped %d oldest records', self.max_bytes, dropped)
+            self._write_ack()
+            self._rewrite()
+
+    def _flush_batch(self) -> bool:
+        batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+        try:
+            self.send([json.loads(line) for _, line in batch])
+        except Exception as e:
+            logger.warning('Failed to flush %d spooled alert records (%s); retrying in %.0fs', len(batch), e, self._backoff)
+            return False
+        for _ in batch:
+            _, line = self._pending.popleft()
+            self._pending_bytes -= len(line)
+        self.acked_seq = max(self.acked_seq, batch[-1][0])
+        self._write_ack()
+        # 已确认的部分占多数时压缩文件
+        if not self._pending or self._file_bytes > 2 * self._pending_bytes:
+            self._rewrite()
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            # 先清除再处理：处理期间 put() 设置的唤醒不会丢失
+            self._wake.clear()
+            try:
+                self._drain_incoming()
+                now = time.monotonic()
+                if self._pending and now >= self._retry_at:
+                    if self._flush_batch():
+                        self._backoff = self.backoff_min
+                        self._retry_at = 0.0
+                        self._last_sent = time.monotonic()
+                        continue
+                    self._retry_at = now + self._backoff
+                    self._backoff = min(self._backoff * 2, self.backoff_max)
+                elif not self._pending and self.heartbeat and now - self._last_sent >= self.heartbeat_interval:
+                    self._last_sent = now
+                    try:
+                        self.heartbeat()
+                    except Exception:
+                        logger.debug('Heartbeat failed', exc_info=True)
+            except Exception:
+                logger.exception('Unexpected error in AlertSpool loop')
+                self._retry_at = time.monotonic() + self._backoff
+            now = time.monotonic()
+            if self._pending:
+                timeout = max(0.0, self._retry_at - now)
+            else:
+                timeout = max(0.0, self.heartbeat_interval - (now - self._last_sent)) if self.heartbeat else None
+            self._wake.wait(timeout)
+
+    def pending_count(self) -> int:
+        return len(self._pending) + len(self._incoming)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='alert-spool')
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """停止后台线程；内存中尚未落盘的记录写入磁盘，下次启动时继续上报"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        if self._thread is None or not self._thread.is_alive():
+            try:
+                self._drain_incoming()
+            except OSError:
+                logger.exception('Failed to persist spooled alerts on stop')
@@ -0,0 +1,118 @@
+"""系统指标采样线程
+每秒把系统 CPU 占用、内存占用、磁盘读写速率写入时序存储，并对 CPU 占用最高的若干进程
+记录各自的 CPU 占用与磁盘读写速率。进程排名每隔 rescan_interval 秒全量扫描一次，
+其余时间只读取被跟踪进程的计数器
+"""
+from typing import Dict, Optional, Tuple
+import threading
+import time
+
+import psutil
+
+from .timeseries import TimeSeriesStore, default_store, series_name
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class SystemSampler:
+    def __init__(self, store: TimeSeriesStore = default_store, interval: float = 1.0, top_processes: int = 10,
+                 rescan_interval: float = 30.0):
+        self.store = store
+        self.interval = interval
+        self.top_processes = top_processes
+        self.rescan_interval = rescan_interval
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_disk = None
+        self._last_time = None
+        # {pid: (Process, name, 上次 cpu 时间, 上次读字节, 上次写字节)}
+        self._watched: Dict[int, Tuple[psutil.Process, str, float, Optional[int], Optional[int]]] = {}
+        self._last_rescan = 0.0
+        # 上次全量扫描时各进程的 CPU 时间，用于按增量排名
+        self._cpu_totals: Dict[int, float] = {}
+
+    @staticmethod
+    def _counters(p: psutil.Process) -> Tuple[float, Optional[int], Optional[int]]:
+        cpu = p.cpu_times()
+        try:
+            io = p.io_counters()
+            read, write = io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.AccessDenied):
+            # macOS 没有进程级 io_counters
+            read = write = None
+        return cpu.user + cpu.system, read, write
+
+    def _rescan(self):
+        """按 CPU 时间增量选出最忙的进程"""
+        ranked = []
+        totals = {}
+        for p in psutil.process_iter(['name', 'cpu_times']):
+            times = p.info.get('cpu_times')
+            if times is None:
+                continue
+            totals[p.pid] = times.user + times.system
+            ranked.append((totals[p.pid] - self._cpu_totals.get(p.pid, 0.0), p))
+        self._cpu_totals = totals
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        watched = {}
+        for _, p in ranked[:self.top_processes]:
+            previous = self._watched.get(p.pid)
+            if previous is not None and previous[0].is_running():
+                watched[p.pid] = previous
+                continue
+            try:
+                watched[p.pid] = (p, p.info.get('name') or '', *self._counters(p))
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        self._watched = watched
+
+    def sample(self):
+        now = time.time()
+        store = self.store
+        store.record('cpu.percent', psutil.cpu_percent(None), now)
+        store.record('mem.used_percent', psutil.virtual_memory().percent, now)
+        disk = psutil.disk_io_counters()
+        dt = now - self._last_time if self._last_time else None
+        if disk is not None and self._last_disk is not None and dt:
+            store.record('disk.read_bps', max(0, disk.read_bytes - self._last_disk.read_bytes) / dt, now)
+            store.record('disk.write_bps', max(0, disk.write_bytes - self._last_disk.write_bytes) / dt, now)
+        self._last_disk = disk
+
+        # 先按上一轮的计数器记录本轮样本，再重新排名：保留的进程沿用刚更新的计数器，下一轮的增量只包含一轮
+        if dt:
+            for pid, (p, name, cpu0, read0, write0) in list(self._watched.items()):
+                try:
+                    cpu, read, write = self._counters(p)
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    del self._watched[pid]
+                    continue
+                store.record(series_name('cpu.percent', pid=pid, name=name), max(0.0, cpu - cpu0) / dt * 100, now)
+                if read is not None and read0 is not None:
+                    store.record(series_name('disk.read_bps', pid=pid, name=name), max(0, read - read0) / dt, now)
+                    store.record(series_name('disk.write_bps', pid=pid, name=name), max(0, write - write0) / dt, now)
+                self._watched[pid] = (p, name, cpu, read, write)
+        if time.monotonic() - self._last_rescan >= self.rescan_interval:
+            self._last_rescan = time.monotonic()
+            self._rescan()
+        self._last_time = now
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception:
+                logger.exception('System metrics sampling failed')
+            self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='system-sampler')
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
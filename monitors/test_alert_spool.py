@@ -0,0 +1,94 @@
+"""用本地替身服务验证 AlertSpool：服务不可用期间记录留在 spool，恢复后批量补报；
+超出 max_bytes 时从最旧的记录开始丢弃"""
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from monitors.spool import AlertSpool
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+state = {'up': False, 'received': []}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not state['up']:
+            self.send_response(503)
+            self.end_headers()
+            return
+        state['received'].append([d['seq'] for d in json.loads(body)['deltas']])
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def record(seq):
+    return {'seq': seq, 'full': False, 'raised': [{'id': f'alert-{seq}', 'text': 'test'}], 'cleared': []}
+
+
+def test_max_bytes(directory):
+    path = directory + '/overflow.jsonl'
+    line_bytes = len(json.dumps(record(1), ensure_ascii=False).encode('utf-8')) + 1
+    # 只容得下 3 条记录；不启动后台线程，直接落盘
+    spool = AlertSpool(path, lambda deltas: None, max_bytes=3 * line_bytes + 1)
+    for seq in range(1, 7):
+        spool.put(record(seq))
+    spool._drain_incoming()
+    assert [seq for seq, _ in spool._pending] == [4, 5, 6], spool._pending
+    assert spool.dropped == 3 and spool.acked_seq == 3
+
+    # 丢弃的记录不会在重启后复活
+    restarted = AlertSpool(path, lambda deltas: None, max_bytes=3 * line_bytes + 1)
+    assert [seq for seq, _ in restarted._pending] == [4, 5, 6], restarted._pending
+    assert restarted.last_seq == 6
+    logger.info('Over max_bytes: dropped %d oldest records', spool.dropped)
+
+
+def main():
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    url = f'http://127.0.0.1:{server.server_address[1]}/exam/alert'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def send(deltas):
+        requests.post(url, json={'deltas': deltas}, timeout=3).raise_for_status()
+
+    directory = tempfile.mkdtemp()
+    path = directory + '/alerts.jsonl'
+    spool = AlertSpool(path, send, batch_size=4, backoff_min=0.5, backoff_max=2.0)
+    spool.start()
+    for seq in range(1, 11):
+        spool.put(record(seq))
+    time.sleep(1.0)
+    spool.stop()
+    logger.info('Server down: %d records spooled', spool.pending_count())
+    assert spool.pending_count() == 10
+    assert state['received'] == []
+
+    # 模拟重启：新的 spool 从文件恢复未确认的记录
+    state['up'] = True
+    spool = AlertSpool(path, send, batch_size=4, backoff_min=0.5, backoff_max=2.0)
+    spool.start()
+    time.sleep(1.0)
+    spool.stop()
+    logger.info('Server up: received batches %s, %d records left', state['received'], spool.pending_count())
+    assert [seq for batch in state['received'] for seq in batch] == list(range(1, 11))
+    assert all(len(batch) <= 4 for batch in state['received'])
+    assert spool.pending_count() == 0
+    server.shutdown()
+
+    test_max_bytes(directory)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
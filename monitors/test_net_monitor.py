@@ -0,0 +1,38 @@
+"""用本地替身服务验证 NetMonitor 的并发探测与失败退避（不需要外网）"""
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from monitors.net_monitor import NetMonitor
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # 端口 1 拒绝连接、.invalid 域名无法解析，用于验证失败与退避
+        monitor = NetMonitor(probes=['tcp://127.0.0.1:1', f'http://127.0.0.1:{port}/', f'tcp://127.0.0.1:{port}'], timeout=1)
+        logger.info('Reachable: %s', monitor())
+        offline = NetMonitor(probes=['tcp://127.0.0.1:1', 'dns://probe.invalid'], timeout=1)
+        logger.info('Offline: %s', offline())
+        # 两个探测都在退避期内，立即返回
+        logger.info('Offline (backing off): %s', offline())
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
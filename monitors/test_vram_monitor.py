@@ -0,0 +1,63 @@
+"""用假的 nvidia-smi 验证 VRAMMonitor 的常驻查询会话（不需要显卡）"""
+import os
+import stat
+import sys
+import tempfile
+import time
+
+from monitors.vram_monitor import VRAMMonitor
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+FAKE_NVIDIA_SMI = '''#!{python}
+import sys, time
+args = ' '.join(sys.argv[1:])
+if '--query-gpu' in args:
+    print('GPU-0000, 8192')
+    sys.exit(0)
+i = 0
+while True:
+    ts = '2024/01/01 00:00:%02d.000' % (i % 60)
+    print(ts + ', GPU-0000, 1234, python.exe, 7000', flush=True)
+    print(ts + ', GPU-0000, 5678, game.exe, %d' % (1000 + i), flush=True)
+    i += 1
+    time.sleep(1)
+'''
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    binary = os.path.join(folder, 'nvidia-smi')
+    with open(binary, 'w') as f:
+        f.write(FAKE_NVIDIA_SMI.format(python=sys.executable))
+    os.chmod(binary, os.stat(binary).st_mode | stat.S_IEXEC)
+
+    monitor = VRAMMonitor(nvidia_smi=binary, loop_seconds=1, use_nvml=False, store=None, restart_backoff=1.0)
+    try:
+        for _ in range(3):
+            alerts = monitor()
+            logger.info('Alerts: %s', alerts)
+            time.sleep(1.5)
+        assert [a['id'] for a in alerts] == ['vram-nvidia-1234'], alerts
+        # 杀掉子进程：退避期间沿用上一次的报警并标记为过期
+        killed = monitor._smi._proc
+        killed.kill()
+        killed.wait()
+        alerts = monitor()
+        logger.info('After kill: %s', alerts)
+        assert alerts and all(a.get('stale') for a in alerts), alerts
+        # 退避结束后会话重启，报警恢复
+        time.sleep(1.5)
+        alerts = monitor()
+        logger.info('After restart: %s', alerts)
+        assert monitor._smi._proc is not None and monitor._smi._proc is not killed
+        assert [a['id'] for a in alerts] == ['vram-nvidia-1234'] and not alerts[0].get('stale'), alerts
+        logger.info('ok')
+    finally:
+        monitor.close()
+
+
+if __name__ == '__main__':
+    main()
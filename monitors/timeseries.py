@@ -0,0 +1,155 @@
+"""监视数据的时序存储
+每个序列（如 cpu.percent、mem.rss_mb{pid=1234,name=python.exe}）按多个粒度保存在定长的 NumPy 环形缓冲区中，
+默认 1 秒 × 3600（1 小时）、1 分钟 × 1440（1 天）、10 分钟 × 1008（7 天）。
+写入时同一粒度桶内的样本先在累加器中聚合，桶结束后写入一行 (时间, 平均, 最小, 最大)，
+内存占用固定，查询按时间二分定位后直接返回数组切片
+"""
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import threading
+import time
+
+import numpy as np
+
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+# (粒度秒, 行数)
+DEFAULT_TIERS: Tuple[Tuple[float, int], ...] = ((1.0, 3600), (60.0, 1440), (600.0, 1008))
+
+
+class _Tier:
+    """一个粒度的环形缓冲区与当前桶的累加器"""
+
+    def __init__(self, step: float, capacity: int):
+        self.step = step
+        self.capacity = capacity
+        self.t = np.zeros(capacity, dtype=np.float64)
+        # 列：平均、最小、最大
+        self.v = np.zeros((capacity, 3), dtype=np.float32)
+        self.head = 0
+        self.size = 0
+        self.bucket: Optional[float] = None
+        self.acc_sum = 0.0
+        self.acc_count = 0
+        self.acc_min = 0.0
+        self.acc_max = 0.0
+
+    def add(self, ts: float, value: float):
+        bucket = ts - ts % self.step
+        if bucket != self.bucket:
+            self._flush()
+            self.bucket = bucket
+            self.acc_sum, self.acc_count, self.acc_min, self.acc_max = 0.0, 0, value, value
+        self.acc_sum += value
+        self.acc_count += 1
+        self.acc_min = min(self.acc_min, value)
+        self.acc_max = max(self.acc_max, value)
+
+    def _flush(self):
+        if self.bucket is None or not self.acc_count:
+            return
+        self.t[self.head] = self.bucket
+        self.v[self.head] = (self.acc_sum / self.acc_count, self.acc_min, self.acc_max)
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def ordered(self) -> Tuple[np.ndarray, np.ndarray]:
+        """按时间排序的 (t, v)，包含尚未结束的当前桶"""
+        if self.size < self.capacity:
+            t, v = self.t[:self.size], self.v[:self.size]
+        else:
+            t = np.concatenate((self.t[self.head:], self.t[:self.head]))
+            v = np.concatenate((self.v[self.head:], self.v[:self.head]))
+        if self.acc_count:
+            t = np.append(t, self.bucket)
+            v = np.vstack((v, np.array([[self.acc_sum / self.acc_count, self.acc_min, self.acc_max]], dtype=np.float32)))
+        return t, v
+
+    def oldest(self) -> Optional[float]:
+        if self.size:
+            return float(self.t[self.head if self.size == self.capacity else 0])
+        return self.bucket
+
+
+class TimeSeries:
+    def __init__(self, tiers: Tuple[Tuple[float, int], ...] = DEFAULT_TIERS):
+        self.tiers = [_Tier(step, capacity) for step, capacity in tiers]
+        self.updated = 0.0
+
+    def add(self, ts: float, value: float):
+        for tier in self.tiers:
+            tier.add(ts, value)
+        self.updated = ts
+
+    def query(self, start: float, end: float, step: Optional[float] = None) -> Dict:
+        """返回 [start, end] 内的数据；step 为期望的最小粒度，
+        默认选择仍覆盖 start 的最细粒度；都不覆盖时（如启动后的第一个小时）选择尚未覆盖写入、
+        保存了全部数据的最细粒度
+        """
+        candidates = [t for t in self.tiers if step is None or t.step >= step] or self.tiers[-1:]
+        tier = None
+        for candidate in candidates:
+            oldest = candidate.oldest()
+            if oldest is not None and oldest <= start:
+                tier = candidate
+                break
+        if tier is None:
+            tier = next((t for t in candidates if t.size < t.capacity), candidates[-1])
+        t, v = tier.ordered()
+        lo = int(np.searchsorted(t, start - tier.step, side='right'))
+        hi = int(np.searchsorted(t, end, side='right'))
+        return {'step': tier.step, 't': t[lo:hi], 'mean': v[lo:hi, 0], 'min': v[lo:hi, 1], 'max': v[lo:hi, 2]}
+
+
+class TimeSeriesStore:
+    """线程安全的命名序列集合；序列数超过 max_series 时淘汰最久未更新的"""
+
+    def __init__(self, tiers: Tuple[Tuple[float, int], ...] = DEFAULT_TIERS, max_series: int = 128):
+        self.tiers = tiers
+        self.max_series = max_series
+        self._series: "OrderedDict[str, TimeSeries]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, value: float, ts: Optional[float] = None):
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = TimeSeries(self.tiers)
+                while len(self._series) > self.max_series:
+                    evicted, _ = self._series.popitem(last=False)
+                    logger.debug('Evicted time series %s', evicted)
+            else:
+                self._series.move_to_end(name)
+            series.add(ts, float(value))
+
+    def names(self, prefix: str = '') -> List[str]:
+        with self._lock:
+            return sorted(n for n in self._series if n.startswith(prefix))
+
+    def query(self, name: str, start: Optional[float] = None, end: Optional[float] = None,
+              step: Optional[float] = None) -> Optional[Dict]:
+        """返回序列在时间范围内的 {'step', 't', 'mean', 'min', 'max'}（NumPy 数组），序列不存在时返回 None
+        start / end 为 Unix 时间戳，默认最近一小时到现在
+        """
+        end = time.time() if end is None else end
+        start = end - 3600 if start is None else start
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                return None
+            return series.query(start, end, step)
+
+
+def series_name(metric: str, **labels) -> str:
+    """'mem.rss_mb', pid=1, name='a' -> 'mem.rss_mb{pid=1,name=a}'"""
+    if not labels:
+        return metric
+    return metric + '{' + ','.join(f'{k}={v}' for k, v in labels.items()) + '}'
+
+
+# 进程内共享的默认存储：监视器写入，服务端查询
+default_store = TimeSeriesStore()
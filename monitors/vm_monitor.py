@@ -1,73 +1,144 @@
 """虚拟机检测监视器
 实现一个类 VMMonitor，仿函数接口：__call__() -> list[dict]
+
+硬件信息（制造商 / 型号、网卡 MAC）几乎不会变化，只在首次采样时读取一次并缓存报警结果；
+之后每次采样只比较网卡名称列表，发现网卡热插拔时才重新读取 MAC。
+Windows 使用 WMI，Linux 读取 /sys/class/dmi/id 与 /sys/class/net/*/address
 """
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional
+import os
 import platform
 
-import wmi
+import psutil
 
 from utils.logger import getLogger
 
+try:
+    import wmi
+except ImportError:
+    wmi = None
+
 
 logger = getLogger(__name__)
 
+VM_OUIS = ['00:05:69', '00:0c:29', '00:1c:14', '00:50:56', '08:00:27']
+
+
+class _WmiBackend:
+    """Windows：通过 python-wmi 查询；每次查询新建连接（COM 对象不能跨线程复用）"""
+    source = 'WMI'
+
+    def system(self) -> List[Tuple[str, str]]:
+        c = wmi.WMI()
+        return [((s.Manufacturer or '').lower(), (s.Model or '').lower()) for s in c.Win32_ComputerSystem()]
+
+    def macs(self) -> List[str]:
+        c = wmi.WMI()
+        return [mac for mac in (getattr(nic, 'MACAddress', None) or '' for nic in c.Win32_NetworkAdapter()) if mac]
+
+    def adapter_signature(self) -> Tuple[str, ...]:
+        return tuple(sorted(psutil.net_if_addrs()))
+
+
+class _SysfsBackend:
+    """Linux：读取 sysfs，无需额外依赖"""
+    source = 'DMI'
+    DMI_DIR = '/sys/class/dmi/id'
+    NET_DIR = '/sys/class/net'
+
+    @staticmethod
+    def _read(path: str) -> str:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    def system(self) -> List[Tuple[str, str]]:
+        manufacturer = self._read(os.path.join(self.DMI_DIR, 'sys_vendor')).lower()
+        model = self._read(os.path.join(self.DMI_DIR, 'product_name')).lower()
+        return [(manufacturer, model)] if manufacturer or model else []
+
+    def macs(self) -> List[str]:
+        macs = []
+        for name in self.adapter_signature():
+            mac = self._read(os.path.join(self.NET_DIR, name, 'address'))
+            if mac and mac != '00:00:00:00:00:00':
+                macs.append(mac)
+        return macs
+
+    def adapter_signature(self) -> Tuple[str, ...]:
+        try:
+            return tuple(sorted(os.listdir(self.NET_DIR)))
+        except OSError:
+            return ()
+
 
 class VMMonitor:
-    """Windows-only VM detection monitor using python-wmi.
+    """VM detection monitor (WMI on Windows, sysfs on Linux).
 
-    简化实现：使用 WMI 查询 Manufacturer / Model，并检测常见虚拟化关键字；
+    简化实现：检查制造商 / 型号中的常见虚拟化关键字；
     也进行网络接口 MAC OUI 检查。
     """
     def __init__(self):
-        if platform.system().lower() != 'windows':
-            raise RuntimeError('VMMonitor is Windows-only')
         # 预置一些可疑的系统产品名或制造商关键字
         self.suspect_keywords = [
             'virtual', 'vmware', 'vbox', 'virtualbox', 'kvm', 'microsoft corporation', 'qemu', 'xen'
         ]
+        system = platform.system().lower()
+        self._backend = None
+        if system == 'windows' and wmi is not None:
+            self._backend = _WmiBackend()
+        elif system == 'linux':
+            self._backend = _SysfsBackend()
+        else:
+            logger.warning('VMMonitor has no backend for platform %s; VM checks disabled', platform.system())
+        # 缓存的报警结果；None 表示尚未检查
+        self._system_alerts: Optional[List[Dict]] = None
+        self._mac_alerts: List[Dict] = []
+        self._adapters: Optional[Tuple[str, ...]] = None
 
-    def _check_wmi_system(self) -> List[Dict]:
+    def _check_system(self) -> Optional[List[Dict]]:
         alerts = []
-        if not wmi:
-            return alerts
         try:
-            c = wmi.WMI()
-            for sys in c.Win32_ComputerSystem():
-                manufacturer = (sys.Manufacturer or '').lower()
-                model = (sys.Model or '').lower()
+            for manufacturer, model in self._backend.system():
                 text = f"{manufacturer} {model}"
                 for kw in self.suspect_keywords:
                     if kw in text:
-                        alerts.append({'id': f'vm-dmi-{kw}', 'text': f"Detected virtualization keyword in WMI: {kw}", 'meta': {'matched': kw, 'manufacturer': manufacturer, 'model': model}})
+                        alerts.append({'id': f'vm-dmi-{kw}', 'text': f"Detected virtualization keyword in {self._backend.source}: {kw}", 'meta': {'matched': kw, 'manufacturer': manufacturer, 'model': model}})
         except Exception:
-            logger.exception('WMI system check failed')
+            logger.exception('%s system check failed', self._backend.source)
+            return None
         return alerts
 
-    def _check_mac_oui(self) -> List[Dict]:
+    def _check_mac_oui(self) -> Optional[List[Dict]]:
         alerts = []
         try:
-            # Use WMI to enumerate NICs
-            if not wmi:
-                return alerts
-            c = wmi.WMI()
-            macs = []
-            for nic in c.Win32_NetworkAdapter():
-                mac = (getattr(nic, 'MACAddress', None) or '')
-                if mac:
-                    macs.append(mac)
-
-            vm_ouis = ['00:05:69', '00:0c:29', '00:1c:14', '00:50:56', '08:00:27']
-            for mac in macs:
+            for mac in self._backend.macs():
                 prefix = mac.replace('-', ':').lower()[0:8]
-                if prefix in vm_ouis:
+                if prefix in VM_OUIS:
                     alerts.append({'id': f'vm-mac-{prefix}', 'text': f'Network MAC OUI suggests virtual NIC: {mac}', 'meta': {'mac': mac}})
         except Exception:
             logger.exception('MAC OUI check failed')
+            return None
         return alerts
 
     def __call__(self) -> List[Dict]:
-        alerts: List[Dict] = []
-        alerts.extend(self._check_wmi_system())
-        alerts.extend(self._check_mac_oui())
-        return alerts
-
+        if self._backend is None:
+            return []
+        if self._system_alerts is None:
+            # 失败时保持 None，下次采样重试
+            self._system_alerts = self._check_system()
+        try:
+            adapters = self._backend.adapter_signature()
+        except Exception:
+            logger.exception('Network adapter enumeration failed')
+            adapters = self._adapters
+        if adapters != self._adapters or self._adapters is None:
+            mac_alerts = self._check_mac_oui()
+            if mac_alerts is not None:
+                if self._adapters is not None:
+                    logger.info('Network adapters changed: %s -> %s', self._adapters, adapters)
+                self._mac_alerts = mac_alerts
+                self._adapters = adapters
+        return (self._system_alerts or []) + self._mac_alerts
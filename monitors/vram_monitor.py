@@ -2,24 +2,239 @@
 VRAMMonitor 会在初始化时查找可用的显卡查询工具（如 nvidia-smi、rocminfo/rocm-smi、intel_gpu_top）
 实例作为仿函数调用时执行一次采样并返回异常显存占用的进程列表作为报警
 报警格式: {'id': unique, 'text': str, 'meta': {...}}
+
+NVIDIA 显卡不再每次采样都启动 nvidia-smi：安装了 pynvml 时使用常驻的 NVML 会话，
+否则维持一个 `nvidia-smi --loop` 子进程并在后台线程中增量解析其输出。显存总量等静态信息只查询一次，
+会话出错或子进程退出后按退避间隔自动重启
 """
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import shutil
 import subprocess
+import threading
+import time
 import re
 
+from .timeseries import TimeSeriesStore, default_store, series_name
 from utils.logger import getLogger
 
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
 
 logger = getLogger(__name__)
 
+# (pid, process_name, used_mb, gpu_total_mb)
+GpuProcess = Tuple[str, str, int, Optional[int]]
+
+# 会话重启退避（秒）
+RESTART_BACKOFF_MIN = 5.0
+RESTART_BACKOFF_MAX = 300.0
+
+
+def _to_mb(value: str) -> int:
+    try:
+        return int(re.sub(r'[^0-9]', '', value))
+    except ValueError:
+        return 0
+
+
+class NvmlSession:
+    """常驻 NVML 会话：句柄与显存总量初始化时缓存，出错后关闭并在下次采样时重新初始化"""
 
-class VRAMMonitor:
     def __init__(self):
+        self._handles = None
+        self._totals: List[int] = []
+        self._names: Dict[int, str] = {}
+        self._retry_at = 0.0
+        self._backoff = RESTART_BACKOFF_MIN
+
+    def _init(self):
+        pynvml.nvmlInit()
+        count = pynvml.nvmlDeviceGetCount()
+        self._handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(count)]
+        self._totals = [int(pynvml.nvmlDeviceGetMemoryInfo(h).total / 1024 / 1024) for h in self._handles]
+        logger.info('NVML session started: %d GPU(s), total memory %s MiB', count, self._totals)
+
+    def _name(self, pid: int) -> str:
+        name = self._names.get(pid)
+        if name is None:
+            try:
+                name = pynvml.nvmlSystemGetProcessName(pid)
+                if isinstance(name, bytes):
+                    name = name.decode(errors='replace')
+            except pynvml.NVMLError:
+                name = ''
+            self._names[pid] = name
+        return name
+
+    def snapshot(self) -> Optional[List[GpuProcess]]:
+        """返回当前各 GPU 上的计算进程；会话不可用时返回 None"""
+        if self._handles is None:
+            if time.monotonic() < self._retry_at:
+                return None
+            try:
+                self._init()
+            except pynvml.NVMLError:
+                logger.debug('NVML init failed', exc_info=True)
+                self._fail()
+                return None
+        try:
+            result = []
+            for handle, total in zip(self._handles, self._totals):
+                for p in pynvml.nvmlDeviceGetComputeRunningProcesses(handle):
+                    used_mb = int((p.usedGpuMemory or 0) / 1024 / 1024)
+                    result.append((str(p.pid), self._name(p.pid), used_mb, total))
+        except pynvml.NVMLError:
+            logger.warning('NVML query failed; restarting session', exc_info=True)
+            self._fail()
+            return None
+        live = {int(r[0]) for r in result}
+        self._names = {pid: n for pid, n in self._names.items() if pid in live}
+        self._backoff = RESTART_BACKOFF_MIN
+        return result
+
+    def _fail(self):
+        self.close()
+        self._retry_at = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, RESTART_BACKOFF_MAX)
+
+    def close(self):
+        if self._handles is not None:
+            self._handles = None
+            try:
+                pynvml.nvmlShutdown()
+            except pynvml.NVMLError:
+                pass
+
+
+class NvidiaSmiSession:
+    """常驻的 `nvidia-smi --query-compute-apps ... --loop=N` 子进程
+    每轮输出的行带有相同的 timestamp，据此把行分组为一次完整的采样；
+    没有计算进程时该轮没有输出，因此超过两个轮询周期没有新行即视为当前无进程
+    """
+    FIELDS = 'timestamp,gpu_uuid,pid,process_name,used_memory'
+
+    def __init__(self, binary: str = 'nvidia-smi', loop_seconds: int = 5, startup_wait: float = 2.0,
+                 backoff_min: float = RESTART_BACKOFF_MIN):
+        self.binary = binary
+        self.loop_seconds = max(1, int(loop_seconds))
+        self.startup_wait = startup_wait
+        self.backoff_min = backoff_min
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # 静态信息：{gpu_uuid: total_mb}，以及首块 GPU 的总量作为未知 uuid 的回退
+        self._totals: Dict[str, int] = {}
+        self._first_total: Optional[int] = None
+        self._batch_ts: Optional[str] = None
+        self._batch: List[GpuProcess] = []
+        self._last_line = 0.0
+        self._retry_at = 0.0
+        self._backoff = backoff_min
+
+    def _query_totals(self):
+        out = subprocess.check_output([self.binary, '--query-gpu=uuid,memory.total', '--format=csv,noheader,nounits'],
+                                      text=True, timeout=10)
+        for line in out.splitlines():
+            parts = [p.strip() for p in line.split(',')]
+            if len(parts) >= 2:
+                total = _to_mb(parts[1])
+                self._totals[parts[0]] = total
+                if self._first_total is None:
+                    self._first_total = total
+        logger.info('nvidia-smi GPU total memory: %s', self._totals)
+
+    def _start(self):
+        if not self._totals:
+            try:
+                self._query_totals()
+            except (subprocess.SubprocessError, OSError):
+                logger.debug('nvidia-smi memory.total query failed', exc_info=True)
+        self._ready.clear()
+        with self._lock:
+            self._batch_ts, self._batch = None, []
+        self._proc = subprocess.Popen(
+            [self.binary, f'--query-compute-apps={self.FIELDS}', '--format=csv,noheader,nounits', f'--loop={self.loop_seconds}'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, text=True, bufsize=1)
+        threading.Thread(target=self._reader, args=(self._proc,), daemon=True).start()
+        logger.info('Started %s --loop=%d (pid %s)', self.binary, self.loop_seconds, self._proc.pid)
+
+    def _reader(self, proc: subprocess.Popen):
+        for line in proc.stdout:
+            parts = [p.strip() for p in line.split(',')]
+            if len(parts) < 5:
+                continue
+            ts, uuid, pid, pname, used = parts[:5]
+            record = (pid, pname, _to_mb(used), self._totals.get(uuid, self._first_total))
+            with self._lock:
+                if ts != self._batch_ts:
+                    self._batch_ts, self._batch = ts, []
+                self._batch.append(record)
+                self._last_line = time.monotonic()
+            self._ready.set()
+        # EOF: the child exited; snapshot() notices via poll() and restarts it
+        self._ready.set()
+
+    def snapshot(self) -> Optional[List[GpuProcess]]:
+        """返回最近一轮的计算进程；会话不可用时返回 None"""
+        if self._proc is None or self._proc.poll() is not None:
+            if self._proc is not None:
+                logger.warning('%s exited with code %s; restarting', self.binary, self._proc.returncode)
+                self._proc = None
+                self._retry_at = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, RESTART_BACKOFF_MAX)
+            if time.monotonic() < self._retry_at:
+                return None
+            try:
+                self._start()
+            except OSError:
+                logger.debug('Failed to start %s', self.binary, exc_info=True)
+                self._retry_at = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, RESTART_BACKOFF_MAX)
+                return None
+            # the first iteration is printed immediately
+            self._ready.wait(self.startup_wait)
+        with self._lock:
+            if time.monotonic() - self._last_line > 2 * self.loop_seconds:
+                return []
+            self._backoff = self.backoff_min
+            return list(self._batch)
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+class VRAMMonitor:
+    def __init__(self, nvidia_smi: str = 'nvidia-smi', loop_seconds: int = 5, use_nvml: bool = True,
+                 store: TimeSeriesStore | None = default_store, restart_backoff: float = RESTART_BACKOFF_MIN):
+        """
+        nvidia_smi: nvidia-smi 可执行文件（名称或路径），测试时可指向假的工具
+        loop_seconds: nvidia-smi --loop 的轮询间隔（秒）
+        use_nvml: pynvml 可用时优先使用 NVML 会话
+        store: 记录各进程显存占用的时序存储，None 表示不记录
+        restart_backoff: nvidia-smi 子进程退出后首次重启前的等待时间（秒），之后每次失败翻倍
+        """
+        self.store = store
+        # 最近一次成功采样的 NVIDIA 报警；会话重启期间沿用并标记为过期
+        self._nvidia_alerts: List[Dict] = []
+        self._nvidia_available = False
         # discover available tools
         self.tools = []
-        if shutil.which('nvidia-smi'):
+        self._nvml: Optional[NvmlSession] = None
+        self._smi: Optional[NvidiaSmiSession] = None
+        if use_nvml and pynvml is not None:
+            self._nvml = NvmlSession()
+        if shutil.which(nvidia_smi):
             self.tools.append('nvidia-smi')
+            self._smi = NvidiaSmiSession(nvidia_smi, loop_seconds, backoff_min=restart_backoff)
         # rocm-smi sometimes available for AMD
         if shutil.which('rocm-smi'):
             self.tools.append('rocm-smi')
@@ -27,40 +242,37 @@ class VRAMMonitor:
         if shutil.which('intel_gpu_top'):
             self.tools.append('intel_gpu_top')
 
+    def _nvidia_snapshot(self) -> Optional[List[GpuProcess]]:
+        """返回当前的计算进程；所有会话都不可用（如正在退避重启）时返回 None"""
+        if self._nvml is not None:
+            result = self._nvml.snapshot()
+            if result is not None:
+                return result
+        if self._smi is not None:
+            return self._smi.snapshot()
+        return None
+
     def _parse_nvidia_smi(self) -> List[Dict]:
+        snapshot = self._nvidia_snapshot()
+        if snapshot is None:
+            # 与"没有计算进程"区分：沿用上一次的结果并标记为过期
+            if self._nvidia_available:
+                logger.warning('GPU query session unavailable; reusing last result until it restarts')
+                self._nvidia_available = False
+            return [{**a, 'stale': True} for a in self._nvidia_alerts]
+        self._nvidia_available = True
         alerts = []
-        try:
-            # Query per-process usage
-            out = subprocess.check_output(['nvidia-smi', '--query-compute-apps=pid,process_name,used_memory', '--format=csv,noheader,nounits'], text=True)
-            # Try to get total GPU memory via nvidia-smi --query-gpu=memory.total
-            total_mem_mb = None
-            try:
-                tot = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits'], text=True)
-                # take first GPU's total memory as representative for thresholding
-                first = tot.splitlines()[0].strip()
-                total_mem_mb = int(re.sub(r'[^0-9]', '', first))
-            except Exception:
-                total_mem_mb = None
-
-            for line in out.splitlines():
-                parts = [p.strip() for p in line.split(',')]
-                if len(parts) >= 3:
-                    pid, pname, used = parts[0], parts[1], parts[2]
-                    try:
-                        used_mb = int(re.sub(r'[^0-9]', '', used))
-                    except Exception:
-                        used_mb = 0
-                    # heuristics:
-                    # - alert if total GPU memory >= 6 GiB and any process uses >= 6 GiB
-                    # - or if total_mem_mb known and single process uses >= 70% of total
-                    if used_mb >= 6 * 1024:
-                        alerts.append({'id': f'vram-nvidia-{pid}', 'text': f'Process {pname} (pid {pid}) using {used_mb} MiB GPU memory >= 6 GiB', 'meta': {'pid': pid, 'process': pname, 'used_mb': used_mb}})
-                    elif total_mem_mb and used_mb >= int(total_mem_mb * 0.7):
-                        alerts.append({'id': f'vram-nvidia-highpct-{pid}', 'text': f'Process {pname} (pid {pid}) using {used_mb} MiB >= 70% of GPU total {total_mem_mb} MiB', 'meta': {'pid': pid, 'process': pname, 'used_mb': used_mb, 'gpu_total_mb': total_mem_mb}})
-        except subprocess.CalledProcessError:
-            logger.debug('nvidia-smi query failed', exc_info=True)
-        except FileNotFoundError:
-            logger.debug('nvidia-smi not found')
+        for pid, pname, used_mb, total_mem_mb in snapshot:
+            if self.store is not None:
+                self.store.record(series_name('vram.used_mb', pid=pid, name=pname), used_mb)
+            # heuristics:
+            # - alert if any process uses >= 6 GiB
+            # - or if total_mem_mb known and single process uses >= 70% of its GPU's total
+            if used_mb >= 6 * 1024:
+                alerts.append({'id': f'vram-nvidia-{pid}', 'text': f'Process {pname} (pid {pid}) using {used_mb} MiB GPU memory >= 6 GiB', 'meta': {'pid': pid, 'process': pname, 'used_mb': used_mb}})
+            elif total_mem_mb and used_mb >= int(total_mem_mb * 0.7):
+                alerts.append({'id': f'vram-nvidia-highpct-{pid}', 'text': f'Process {pname} (pid {pid}) using {used_mb} MiB >= 70% of GPU total {total_mem_mb} MiB', 'meta': {'pid': pid, 'process': pname, 'used_mb': used_mb, 'gpu_total_mb': total_mem_mb}})
+        self._nvidia_alerts = alerts
         return alerts
 
     def _parse_rocm_smi(self) -> List[Dict]:
@@ -101,9 +313,16 @@ class VRAMMonitor:
 
     def __call__(self) -> List[Dict]:
         alerts: List[Dict] = []
-        if 'nvidia-smi' in self.tools:
+        if self._nvml is not None or self._smi is not None:
             alerts.extend(self._parse_nvidia_smi())
         if 'rocm-smi' in self.tools:
             alerts.extend(self._parse_rocm_smi())
         # For Intel or others it's left as no-op fallback for now
         return alerts
+
+    def close(self):
+        """结束常驻的查询会话"""
+        if self._nvml is not None:
+            self._nvml.close()
+        if self._smi is not None:
+            self._smi.close()
@@ -1,28 +1,61 @@
-import threading
-import time
-import io
+import asyncio
+import json
+import re
+from pathlib import Path
 from typing import Optional
 import os
 
-from fastapi import FastAPI, Response, Request
-from fastapi.responses import JSONResponse
+import anyio
+from fastapi import FastAPI, Response, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-import mss
-from PIL import Image
 import uvicorn
 
 from .range_response import RangeResponse
 from .auth import JWTAuthMiddleware
-from capture.service import get_recorder_names, get_recorder
+from .media_cache import MediaCache
+from .screenshot import FORMATS, ScreenshotCache
+from .frame_extract import FrameExtractor
+from .static_files import PrecompressedStaticFiles
+from .rate_limit import RateLimiter, RateLimitMiddleware
+from config import (media_cache_bytes, rate_limit_client_rps, rate_limit_client_burst, rate_limit_client_bps,
+                    rate_limit_client_burst_bytes, rate_limit_global_rps, rate_limit_global_burst,
+                    rate_limit_global_bps, rate_limit_global_burst_bytes, rate_limit_trusted_proxies)
+from capture.service import get_recorder_names, get_recorder, add_segment_listener, health
+from capture.archive_playlist import INDEX_NAME as ARCHIVE_INDEX_NAME, parse_playlist_entries
+from capture.live_stream import codec_mime
+from capture.preroll import CLIP_FORMATS
+from capture.storyboard import STORYBOARD_DIR, build_vtt, load_storyboard_index
+from monitors.timeseries import default_store as metrics_store
+from utils.event_bus import event_bus
 from utils.logger import getLogger
+from utils.segment_pack import find_packed_segment
 
 
 logger = getLogger("server.app")
 MEDIA_ROOT = os.path.abspath('./media')
+SEGMENT_NAME_PATTERN = re.compile(r'^video_(\d+)\.ts$')
+STORYBOARD_VTT_PATTERN = re.compile(r'^(video|archive_\d+)\.vtt$')
+SPRITE_NAME_PATTERN = re.compile(r'^sprite_(\d+)\.jpg$')
+PLAYLIST_NAME_PATTERN = re.compile(r'^(video|archive_\d+)$')
 
 app = FastAPI()
 
+# Throttle viewers so segment and screenshot pulls cannot starve the recorder;
+# added before CORS so 429 responses (and Retry-After) carry CORS headers
+rate_limiter = RateLimiter(
+    client_rps=rate_limit_client_rps,
+    client_burst=rate_limit_client_burst,
+    client_bps=rate_limit_client_bps,
+    client_burst_bytes=rate_limit_client_burst_bytes,
+    global_rps=rate_limit_global_rps,
+    global_burst=rate_limit_global_burst,
+    global_bps=rate_limit_global_bps,
+    global_burst_bytes=rate_limit_global_burst_bytes,
+)
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter, paths=["/recorder/", "/screenshot"],
+                   trusted_proxies=rate_limit_trusted_proxies)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -35,57 +68,46 @@ app.add_middleware(
 app.add_middleware(JWTAuthMiddleware, exempt_paths=["/screenshot/latest"])
 
 
-# Thread-safe container for latest screenshot bytes
-_screenshot_lock = threading.Lock()
-_screenshot_png: Optional[bytes] = None
+screenshot_cache = ScreenshotCache()
 
 
-def _screenshot_worker(interval: float = 10.0):
-    """Background worker that captures the primary monitor every `interval` seconds
-    and stores PNG bytes in `_screenshot_png` guarded by `_screenshot_lock`.
+def _screenshot_recorder(monitor: Optional[str]):
+    """Resolve `?monitor=` to a screen recorder: a recorder name, or an
+    index into the screen recorder list (default: the first screen).
     """
-    global _screenshot_png
-    if mss is None or Image is None:
-        logger.error("mss or Pillow not available; screenshot worker will not run")
-        return
-
-    sct = mss.mss()
-    logger.info("Screenshot worker started, interval=%s seconds", interval)
-    while True:
-        try:
-            monitor = sct.monitors[0]  # primary monitor
-            img = sct.grab(monitor)
-            # convert to PNG bytes via PIL for cross-platform consistency
-            img_pil = Image.frombytes("RGB", img.size, img.rgb)
-            buf = io.BytesIO()
-            img_pil.save(buf, format="PNG")
-            png = buf.getvalue()
-            with _screenshot_lock:
-                _screenshot_png = png
-            logger.debug("Captured screenshot (%d bytes)", len(png))
-        except Exception as e:
-            logger.exception("Exception in screenshot worker: %s", e)
-        time.sleep(interval)
-
-
-# start background thread (daemon)
-_worker_thread = threading.Thread(target=_screenshot_worker, args=(10.0,), daemon=True)
-_worker_thread.start()
-logger.info("Background screenshot worker thread started")
+    screens = get_recorder_names()['screen']
+    if monitor is None or monitor.isdigit():
+        idx = int(monitor or 0)
+        return get_recorder(screens[idx]) if idx < len(screens) else None
+    return get_recorder(monitor)
 
 
 @app.get("/screenshot")
-async def latest_screenshot():
-    """Return latest screenshot PNG captured by background thread.
+async def latest_screenshot(request: Request, monitor: Optional[str] = None, width: Optional[int] = None,
+                            format: str = "jpeg", quality: int = 80):
+    """Return the newest frame captured by a screen recorder as JPEG or WebP.
 
-    Returns 204 if no screenshot is available yet.
+    `width` scales the image down (aspect ratio kept), `quality` is 1-100.
+    Returns 204 if the recorder has not captured a frame yet.
     """
-    with _screenshot_lock:
-        png = _screenshot_png
-    logger.info("/screenshot/latest requested; available=%s", bool(png))
-    if not png:
+    format = format.lower()
+    if format not in FORMATS or not 1 <= quality <= 100 or (width is not None and width <= 0):
+        return JSONResponse(status_code=400, content={"error": "Invalid screenshot parameters"})
+    recorder = _screenshot_recorder(monitor)
+    if recorder is None:
+        return JSONResponse(status_code=404, content={"error": "Recorder not found"})
+    frame = recorder.frames.latest()
+    logger.debug("/screenshot requested for %s; available=%s", recorder.name, frame is not None)
+    if frame is None:
         return Response(status_code=204)
-    return Response(content=png, media_type="image/png")
+
+    key = screenshot_cache.key_for(recorder.name, frame, format, width, quality)
+    headers = {"etag": key.etag, "cache-control": "no-cache", "access-control-expose-headers": "etag"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and key.etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    data = await screenshot_cache.get(key, frame)
+    return Response(content=data, media_type=FORMATS[format][0], headers=headers)
 
 
 @app.get("/recorder/list")
@@ -94,6 +116,62 @@ async def list_recorders():
     return get_recorder_names()
 
 
+# comment line sent on idle event streams so proxies keep the connection open
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def _sse(event: str, data, event_id: Optional[int] = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _state_snapshot() -> dict:
+    return {"health": health(), "recorders": get_recorder_names()}
+
+
+@app.get("/events")
+async def event_stream(request: Request):
+    """Server-Sent Events for recorder and alert state: `recorder.started`,
+    `recorder.stopped`, `segment.closed`, `health` and `alerts.delta`.
+
+    A new connection first gets a `state` snapshot. A reconnecting client
+    sends Last-Event-ID and is replayed the events it missed; if too many
+    were missed (or it falls behind) it gets a `resync` snapshot instead.
+    """
+    try:
+        last_event_id = int(request.headers["last-event-id"])
+    except (KeyError, ValueError):
+        last_event_id = None
+    subscriber = event_bus.subscribe(asyncio.get_running_loop(), last_event_id)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            if last_event_id is None:
+                yield _sse("state", _state_snapshot())
+            while True:
+                if subscriber.lagged:
+                    subscriber.lagged = False
+                    yield _sse("resync", _state_snapshot())
+                event = await subscriber.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if event is None:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(event.type, event.data, event.id)
+        finally:
+            event_bus.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
+
+
 @app.get("/recorder/live/{name}.m3u8")
 async def live_recorder(name: str):
     """Stub endpoint for future live streaming of recorder by name."""
@@ -103,6 +181,98 @@ async def live_recorder(name: str):
     return Response(content=recorder.generate_live_m3u8(), media_type="application/vnd.apple.mpegurl")
 
 
+@app.websocket("/recorder/ws/{name}")
+async def live_websocket(websocket: WebSocket, name: str):
+    """Low-latency live stream as fragmented MP4 over a WebSocket.
+
+    The first message is a text frame `{"mime": ...}` for MediaSource, then
+    binary frames: the init segment followed by media fragments starting at
+    the latest keyframe. A viewer that falls behind skips to the next keyframe.
+    """
+    recorder = get_recorder(name)
+    if recorder is None:
+        await websocket.close(code=4404, reason="Recorder not found")
+        return
+    await websocket.accept()
+    subscriber = recorder.live.subscribe(asyncio.get_running_loop())
+
+    async def watch_disconnect():
+        # the client never sends anything; receive() only returns on disconnect
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+
+    disconnected = asyncio.create_task(watch_disconnect())
+    try:
+        while True:
+            next_data = asyncio.ensure_future(subscriber.get())
+            done, _ = await asyncio.wait({next_data, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                next_data.cancel()
+                break
+            data = next_data.result()
+            if data is None:
+                break
+            if data is subscriber.init:
+                await websocket.send_text(json.dumps({"mime": codec_mime(data)}))
+            await websocket.send_bytes(data)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disconnected.cancel()
+        recorder.live.unsubscribe(subscriber)
+    try:
+        await websocket.close()
+    except RuntimeError:
+        # already closed by the client
+        pass
+
+
+@app.get("/recorder/replay/{name}")
+async def instant_replay(name: str, seconds: float = 60.0, format: str = "mp4"):
+    """Return the last `seconds` of a recorder as a playable clip, built in
+    memory from the recorder's pre-roll buffer (no disk access).
+
+    The clip starts at a keyframe, so it may be slightly longer than asked.
+    Returns 204 if nothing has been buffered yet.
+    """
+    format = format.lower()
+    if format not in CLIP_FORMATS or seconds <= 0:
+        return JSONResponse(status_code=400, content={"error": "Invalid replay parameters"})
+    recorder = get_recorder(name)
+    if recorder is None:
+        return JSONResponse(status_code=404, content={"error": "Recorder not found"})
+    clip = await anyio.to_thread.run_sync(recorder.preroll.clip, seconds, format)
+    if not clip:
+        return Response(status_code=204)
+    return Response(
+        content=clip,
+        media_type=CLIP_FORMATS[format][2],
+        headers={
+            "cache-control": "no-store",
+            "content-disposition": f'inline; filename="{name}_replay.{format}"',
+        },
+    )
+
+
+@app.get("/recorder/archive/{name}")
+async def archive_index(name: str):
+    """Return the rolling archive index of a recorder: one sub-playlist per
+    time chunk, so clients can fetch only the chunk they need.
+    """
+    index_path = os.path.abspath(os.path.join(MEDIA_ROOT, name, ARCHIVE_INDEX_NAME))
+    if os.path.dirname(os.path.dirname(index_path)) != MEDIA_ROOT or not os.path.isfile(index_path):
+        return JSONResponse(status_code=404, content={"error": "Archive not found"})
+    with open(index_path, encoding="utf-8") as f:
+        index = json.load(f)
+    for chunk in index.get("chunks", []):
+        chunk["url"] = f"/recorder/file/{name}/{chunk['playlist']}"
+        chunk["thumbnails"] = f"/recorder/storyboard/{name}/{os.path.splitext(chunk['playlist'])[0]}.vtt"
+    return index
+
+
 def _is_safe_media_path(rel_path: str) -> bool:
     """Return True if the provided relative path points to a file inside MEDIA_ROOT
     and has an allowed extension. This prevents path traversal attacks.
@@ -120,21 +290,39 @@ def _is_safe_media_path(rel_path: str) -> bool:
     _, ext = os.path.splitext(full_path)
     if ext.lower() not in ('.ts', '.m3u8'):
         return False
-    # must exist and be a file
-    if not os.path.isfile(full_path):
-        return False
     return True
 
 
+def _resolve_media_file(full_path: str) -> tuple[str, int, int | None] | None:
+    """Locate a validated media path on disk. Segments that the retention
+    manager has packed are served from their byte region in the pack file.
+
+    Returns (file path, offset, length) or None if the file does not exist.
+    """
+    if os.path.isfile(full_path):
+        return full_path, 0, None
+    m = SEGMENT_NAME_PATTERN.match(os.path.basename(full_path))
+    if not m:
+        return None
+    segment = find_packed_segment(Path(os.path.dirname(full_path)), int(m.group(1)))
+    if segment is None:
+        return None
+    return str(segment.pack_path), segment.offset, segment.length
+
+
 @app.get("/recorder/file/{path:path}")
 async def get_media_file(request: Request, path: str):
     """Serve a media file from the media directory. Path is treated as a
     relative path and validated to prevent traversal. Returns 404 if invalid.
     """
-    if not _is_safe_media_path(path):
+    resolved = None
+    if _is_safe_media_path(path):
+        full_path = os.path.abspath(os.path.join(MEDIA_ROOT, os.path.normpath(path)))
+        resolved = _resolve_media_file(full_path)
+    if resolved is None:
         logger.warning("Attempt to access invalid media path: %s", path)
         return JSONResponse(status_code=404, content={"error": "File not found"})
-    full_path = os.path.abspath(os.path.join(MEDIA_ROOT, os.path.normpath(path)))
+    file_path, offset, length = resolved
     _, ext = os.path.splitext(full_path)
     ext = ext.lower()
     if ext == '.m3u8':
@@ -143,14 +331,166 @@ async def get_media_file(request: Request, path: str):
         media_type = "video/mp2t"
     else:
         media_type = "application/octet-stream"
-    return RangeResponse(request, full_path, content_type=media_type)
+    closed, hot = _segment_state(full_path)
+    # playlists and the newest closed segments are shared by every live viewer: serve them from memory
+    data = None
+    if ext == '.m3u8' or closed:
+        data = await media_cache.get(file_path, offset, length, populate=hot or ext == '.m3u8')
+    # closed segments are still rewritten by the re-encoder and moved into packs by
+    # retention, so they are revalidated with their ETag rather than cached as immutable
+    return RangeResponse(request, file_path, content_type=media_type, offset=offset, length=length, data=data)
+
+
+def _segment_state(full_path: str) -> tuple[bool, bool]:
+    """Return (closed, hot) for a media path. A segment is closed (and will
+    never change again) unless it is the newest segment of a recorder that
+    is still recording; it is hot while it is among the recorder's latest
+    segments that live viewers are fetching.
+    """
+    m = SEGMENT_NAME_PATTERN.match(os.path.basename(full_path))
+    if not m:
+        return False, False
+    number = int(m.group(1))
+    recorder = get_recorder(os.path.basename(os.path.dirname(full_path)))
+    if recorder is None or not recorder.recording:
+        return True, False
+    latest = recorder.get_latest_segments()
+    if not latest:
+        return True, False
+    return number < latest[-1], latest[0] <= number < latest[-1]
+
+
+def _prefill_closed_segment(recorder, segment_number: int):
+    """Segment-completion listener: warm the cache before viewers ask."""
+    media_cache.prefill(os.path.abspath(os.path.join(recorder.output_path, f'video_{segment_number}.ts')))
+
+
+media_cache = MediaCache(max_bytes=media_cache_bytes)
+add_segment_listener(_prefill_closed_segment)
+
+
+@app.get("/recorder/storyboard/{name}/{file}")
+async def storyboard_file(request: Request, name: str, file: str):
+    """Serve a recorder's storyboard: `<playlist>.vtt` is a WebVTT thumbnail
+    track for `video.m3u8` or an `archive_<n>.m3u8` chunk, `sprite_<k>.jpg`
+    are the sprite sheets it points into.
+    """
+    folder = os.path.abspath(os.path.join(MEDIA_ROOT, name))
+    if os.path.dirname(folder) != MEDIA_ROOT:
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+    index = load_storyboard_index(Path(folder))
+    if index is None:
+        return JSONResponse(status_code=404, content={"error": "Storyboard not found"})
+
+    m = SPRITE_NAME_PATTERN.match(file)
+    if m:
+        sprite_path = os.path.join(folder, STORYBOARD_DIR, file)
+        if not os.path.isfile(sprite_path):
+            return JSONResponse(status_code=404, content={"error": "File not found"})
+        per_sheet = index["columns"] * index["rows"]
+        # sheets before the one being filled never change again
+        filling = index.get("first_sheet", 0) + max(0, len(index["thumbs"]) - 1) // per_sheet
+        return RangeResponse(request, sprite_path, content_type="image/jpeg", immutable=int(m.group(1)) < filling)
+
+    m = STORYBOARD_VTT_PATTERN.match(file)
+    playlist_path = os.path.join(folder, f"{m.group(1)}.m3u8") if m else None
+    if playlist_path is None or not os.path.isfile(playlist_path):
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+    index_mtime = os.stat(os.path.join(folder, STORYBOARD_DIR, "index.json")).st_mtime_ns
+    etag = f'"{index_mtime:x}-{os.stat(playlist_path).st_mtime_ns:x}"'
+    headers = {"etag": etag, "cache-control": "no-cache", "access-control-expose-headers": "etag"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    with open(playlist_path, encoding="utf-8") as f:
+        entries = parse_playlist_entries(f.read())
+    vtt = build_vtt(index, entries, f"/recorder/storyboard/{name}/")
+    return Response(content=vtt, media_type="text/vtt", headers=headers)
+
+
+frame_extractor = FrameExtractor()
+
+
+@app.get("/recorder/frame/{name}")
+async def frame_at_time(request: Request, name: str, t: float, playlist: str = "video", quality: int = 85):
+    """Return the frame shown `t` seconds into a recorder playlist
+    (`video` or an `archive_<n>` chunk) as JPEG.
+    """
+    if t < 0 or not 1 <= quality <= 100 or not PLAYLIST_NAME_PATTERN.match(playlist):
+        return JSONResponse(status_code=400, content={"error": "Invalid frame parameters"})
+    folder = os.path.abspath(os.path.join(MEDIA_ROOT, name))
+    playlist_path = os.path.join(folder, f"{playlist}.m3u8")
+    if os.path.dirname(folder) != MEDIA_ROOT or not os.path.isfile(playlist_path):
+        return JSONResponse(status_code=404, content={"error": "Playlist not found"})
+    with open(playlist_path, encoding="utf-8") as f:
+        entries = parse_playlist_entries(f.read())
+
+    start = 0.0
+    for number, duration in entries:
+        if t < start + duration:
+            break
+        start += duration
+    else:
+        return JSONResponse(status_code=404, content={"error": "Time is beyond the end of the playlist"})
+    resolved = _resolve_media_file(os.path.join(folder, f"video_{number}.ts"))
+    if resolved is None:
+        return JSONResponse(status_code=404, content={"error": "Segment not found"})
+    file_path, offset, length = resolved
+
+    etag = f'"{number}-{os.stat(file_path).st_mtime_ns:x}-{round((t - start) * 1000):x}-{quality}"'
+    headers = {"etag": etag, "cache-control": "no-cache", "access-control-expose-headers": "etag"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    jpeg = await anyio.to_thread.run_sync(frame_extractor.extract_jpeg, file_path, offset, length, t - start, quality)
+    if jpeg is None:
+        return JSONResponse(status_code=404, content={"error": "No decodable frame"})
+    return Response(content=jpeg, media_type="image/jpeg", headers=headers)
+
+
+@app.get("/recorder/cache/stats")
+async def media_cache_stats():
+    """Hit/miss counters and memory usage of the hot media cache."""
+    return media_cache.stats()
+
+
+@app.get("/recorder/ratelimit/stats")
+async def rate_limit_stats():
+    """Per-client request, rejection and byte counters of the rate limiter."""
+    return rate_limiter.stats()
+
+
+@app.get("/metrics")
+async def metric_names(prefix: str = ""):
+    """Names of the recorded monitor time series, optionally filtered by prefix."""
+    return {"names": metrics_store.names(prefix)}
+
+
+@app.get("/metrics/query")
+async def metric_query(name: str, start: Optional[float] = None, end: Optional[float] = None,
+                       step: Optional[float] = None):
+    """Samples of one time series between `start` and `end` (Unix seconds,
+    default the last hour) at the finest stored resolution that covers the
+    range, or at least `step` seconds.
+    """
+    if start is not None and end is not None and start > end:
+        return JSONResponse(status_code=400, content={"error": "Invalid time range"})
+    result = metrics_store.query(name, start, end, step)
+    if result is None:
+        return JSONResponse(status_code=404, content={"error": "Metric not found"})
+    return {
+        "name": name,
+        "step": result["step"],
+        "t": result["t"].tolist(),
+        "mean": result["mean"].tolist(),
+        "min": result["min"].tolist(),
+        "max": result["max"].tolist(),
+    }
 
 
 # Mount static files directory at root so that files in ./static are served from '/'
 # Use html=True to allow serving index.html for '/'
 static_dir = os.path.abspath('./static')
 if os.path.isdir(static_dir):
-    app.mount('/', StaticFiles(directory=static_dir, html=True), name='static')
+    app.mount('/', PrecompressedStaticFiles(directory=static_dir, html=True), name='static')
     logger.info("Mounted static files at / -> %s", static_dir)
 else:
     logger.warning("Static directory not found, not mounted: %s", static_dir)
@@ -1,8 +1,14 @@
-import typing
+import hashlib
 import ipaddress
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
+import threading
+import time
+import typing
+from collections import OrderedDict
+
 import jwt
+from starlette.requests import HTTPConnection
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from config import jwt_public_key
 from utils.logger import getLogger
@@ -11,93 +17,158 @@ from utils.logger import getLogger
 logger = getLogger("server.auth")
 
 
-class JWTAuthMiddleware(BaseHTTPMiddleware):
-    """Middleware that checks for a valid JWT in the 'teacher_jwt' cookie.
+class TokenCache:
+    """Bounded cache of verified JWT payloads keyed by a hash of the token.
+
+    Entries live until the token's `exp` (or `max_ttl` seconds for tokens
+    without one), so each token pays for a full RS256 verification once.
+    """
+
+    def __init__(self, max_size: int = 1024, max_ttl: float = 300.0):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries: "OrderedDict[bytes, tuple[dict, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> typing.Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token: str, payload: dict):
+        now = time.time()
+        exp = payload.get("exp")
+        expires_at = min(float(exp), now + self.max_ttl) if isinstance(exp, (int, float)) else now + self.max_ttl
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class JWTAuthMiddleware:
+    """Pure ASGI middleware that checks for a valid JWT in the 'teacher_jwt' cookie.
 
     Behavior change: requests coming from loopback addresses (e.g. 127.0.0.1 or ::1)
     will bypass JWT verification. For such local requests `request.state.teacher_payload`
     will be set to {'local': True} so downstream handlers can detect the bypass.
+
+    Unlike a BaseHTTPMiddleware it does not wrap or buffer the response, so
+    streaming media responses pass straight through. Verified tokens are
+    cached until they expire.
     """
 
-    def __init__(self, app, exempt_paths: typing.Optional[typing.List[str]] = None):
-        super().__init__(app)
+    def __init__(self, app: ASGIApp, exempt_paths: typing.Optional[typing.List[str]] = None,
+                 cache_size: int = 1024):
+        self.app = app
         self.exempt_paths = exempt_paths or []
+        self.token_cache = TokenCache(max_size=cache_size)
         logger.info("JWTAuthMiddleware initialized; exempt_paths=%s", self.exempt_paths)
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        conn = HTTPConnection(scope)
         # allow exempted paths through
-        path = request.url.path
+        path = conn.url.path
         if any(path.startswith(p) for p in self.exempt_paths):
             logger.debug("Path exempted from auth: %s", path)
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
 
         # try to detect if request comes from a loopback (localhost) IP and skip auth
         # Note: depending on deployment (reverse proxy), the client IP may be in headers
         client_ip = None
         # prefer X-Forwarded-For if present (first value), fall back to client.host
-        xff = request.headers.get("x-forwarded-for") or request.headers.get("X-Forwarded-For")
+        xff = conn.headers.get("x-forwarded-for")
         if xff:
             # X-Forwarded-For may contain comma-separated list; take first
             client_ip = xff.split(",")[0].strip()
-            logger.debug("Found X-Forwarded-For: %s", client_ip)
-        else:
-            # starlette Request.client may be None in some cases; guard it
-            if request.client and request.client.host:
-                client_ip = request.client.host
+        elif conn.client and conn.client.host:
+            # client may be None in some cases; guard it
+            client_ip = conn.client.host
 
         if client_ip:
             try:
-                ip = ipaddress.ip_address(client_ip)
-                if ip.is_loopback:
+                if ipaddress.ip_address(client_ip).is_loopback:
                     # mark as local and bypass JWT verification
-                    request.state.teacher_payload = {"local": True}
-                    logger.info("Bypassing JWT for local request from %s to %s", client_ip, path)
-                    return await call_next(request)
+                    state["teacher_payload"] = {"local": True}
+                    logger.debug("Bypassing JWT for local request from %s to %s", client_ip, path)
+                    await self.app(scope, receive, send)
+                    return
             except ValueError:
                 # not a valid IP address; proceed with normal auth
                 logger.debug("Could not parse client IP: %s", client_ip)
 
-        token = None
-        token_source = None
-
-        cookie_token = request.cookies.get("teacher_jwt")
-        if cookie_token:
-            token = cookie_token
-            token_source = "cookie"
-
-        if not token:
-            header_token = request.headers.get("x-teacher-jwt") or request.headers.get("X-Teacher-JWT")
-            if header_token:
-                token = header_token
-                token_source = "header:x-teacher-jwt"
-
-        if not token:
-            qp = request.query_params
-            q_token = qp.get("teacher_jwt") or qp.get("token")
-            if q_token:
-                token = q_token
-                token_source = "query"
-
+        token, token_source = self._find_token(conn)
         if not token:
             logger.warning(
                 "Missing token for path: %s (client_ip=%s). Supported locations: cookie 'teacher_jwt', header 'X-Teacher-JWT', or query 'teacher_jwt'/'token'",
                 path,
                 client_ip,
             )
-            raise HTTPException(status_code=401, detail="Missing token (check cookie, header, or query param)")
-
-        try:
-            # verify RS256 JWT using provided public key
-            payload = jwt.decode(token, jwt_public_key, algorithms=["RS256"], options={"verify_aud": False})
-            # attach payload and token metadata to request.state for downstream handlers
-            request.state.teacher_payload = payload
-            request.state.teacher_token_source = token_source
-            logger.info("JWT validated for path %s, sub=%s (source=%s)", path, payload.get("sub"), token_source)
-        except jwt.ExpiredSignatureError:
-            logger.warning("Expired token for path: %s (source=%s)", path, token_source)
-            raise HTTPException(status_code=401, detail="Token expired")
-        except jwt.InvalidTokenError as e:
-            logger.error("Invalid token for path %s (source=%s): %s", path, token_source, e)
-            raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
-
-        return await call_next(request)
+            await self._reject(scope, receive, send, "Missing token (check cookie, header, or query param)")
+            return
+
+        payload = self.token_cache.get(token)
+        if payload is None:
+            try:
+                # verify RS256 JWT using provided public key
+                payload = jwt.decode(token, jwt_public_key, algorithms=["RS256"], options={"verify_aud": False})
+            except jwt.ExpiredSignatureError:
+                logger.warning("Expired token for path: %s (source=%s)", path, token_source)
+                await self._reject(scope, receive, send, "Token expired")
+                return
+            except jwt.InvalidTokenError as e:
+                logger.error("Invalid token for path %s (source=%s): %s", path, token_source, e)
+                await self._reject(scope, receive, send, f"Invalid token: {e}")
+                return
+            self.token_cache.put(token, payload)
+            logger.info("JWT validated, sub=%s (source=%s)", payload.get("sub"), token_source)
+        else:
+            logger.debug("JWT cache hit for path %s, sub=%s (source=%s)", path, payload.get("sub"), token_source)
+
+        # attach payload and token metadata to request.state for downstream handlers
+        state["teacher_payload"] = payload
+        state["teacher_token_source"] = token_source
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def _find_token(conn: HTTPConnection) -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+        cookie_token = conn.cookies.get("teacher_jwt")
+        if cookie_token:
+            return cookie_token, "cookie"
+        header_token = conn.headers.get("x-teacher-jwt")
+        if header_token:
+            return header_token, "header:x-teacher-jwt"
+        qp = conn.query_params
+        q_token = qp.get("teacher_jwt") or qp.get("token")
+        if q_token:
+            return q_token, "query"
+        return None, None
+
+    @staticmethod
+    async def _reject(scope: Scope, receive: Receive, send: Send, detail: str):
+        if scope["type"] == "websocket":
+            # policy violation; the handshake is refused before it is accepted
+            await send({"type": "websocket.close", "code": 1008, "reason": detail})
+            return
+        response = JSONResponse(status_code=401, content={"detail": detail})
+        await response(scope, receive, send)
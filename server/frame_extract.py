@@ -0,0 +1,180 @@
+"""Still-frame extraction from recorded segments.
+
+A request decodes from the segment's keyframe (its first frame) forward
+only as far as the target frame. The decoder for each recently
+used segment (a segment is a single GOP) is kept in a small LRU together
+with its last few decoded frames, so scrubbing back and forth around the
+same moment reuses decoded frames or continues decoding from where the
+previous request stopped instead of starting at the keyframe again.
+"""
+import io
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Optional
+
+import av
+import cv2
+
+from utils.logger import getLogger
+
+
+logger = getLogger("server.frame_extract")
+
+
+class RegionFile(io.RawIOBase):
+    """Read-only view of a byte region of a file (a segment inside a pack)."""
+
+    def __init__(self, path: str, offset: int, length: int):
+        self._f = open(path, "rb")
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        size = min(len(b), self._length - self._pos)
+        if size <= 0:
+            return 0
+        self._f.seek(self._offset + self._pos)
+        data = self._f.read(size)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._length
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+class GopCursor:
+    """Open decoder positioned somewhere inside one segment."""
+
+    def __init__(self, path: str, offset: int, length: Optional[int], keep_frames: int):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.source = None
+        self.container = None
+        self._open()
+        self.start = float(self.stream.start_time * self.stream.time_base) if self.stream.start_time is not None else 0.0
+        self.lock = threading.Lock()
+        self.closed = False
+        # recent decoded frames as (time, frame), oldest first
+        self.recent: deque = deque(maxlen=keep_frames)
+        self._frames = None
+
+    def _open(self):
+        self._close_container()
+        self.source = RegionFile(self.path, self.offset, self.length) if self.length is not None else self.path
+        self.container = av.open(self.source)
+        self.stream = self.container.streams.video[0]
+        self._fresh = True
+
+    def _close_container(self):
+        if self.container is not None:
+            self.container.close()
+        if isinstance(self.source, RegionFile):
+            self.source.close()
+
+    def _restart(self, target: float):
+        self.recent.clear()
+        # A segment is a single GOP, so its only keyframe is the first frame.
+        # A timestamp seek in mpegts lands past it and nothing decodes; reopen
+        # the container to decode from the start with a fresh decoder.
+        if not self._fresh:
+            self._open()
+        self._fresh = False
+        self._frames = self.container.decode(self.stream)
+
+    def frame_at(self, offset: float):
+        """Return the last frame whose time is <= segment start + offset."""
+        target = self.start + max(0.0, offset)
+        if self.recent and self.recent[0][0] <= target <= self.recent[-1][0]:
+            return max((f for f in self.recent if f[0] <= target), key=lambda f: f[0])[1]
+        if self._frames is None or not self.recent or target < self.recent[0][0]:
+            self._restart(target)
+        best = self.recent[-1][1] if self.recent and self.recent[-1][0] <= target else None
+        for frame in self._frames:
+            if frame.time is None:
+                continue
+            self.recent.append((frame.time, frame))
+            if frame.time > target:
+                return best if best is not None else frame
+            best = frame
+        # past the last frame: the segment ends before the target
+        self._frames = None
+        return best
+
+    def close(self):
+        self.closed = True
+        self._close_container()
+
+
+class FrameExtractor:
+    def __init__(self, max_cursors: int = 4, keep_frames: int = 8):
+        self.max_cursors = max_cursors
+        self.keep_frames = keep_frames
+        self._cursors: "OrderedDict[tuple, GopCursor]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cursor(self, path: str, offset: int, length: Optional[int]) -> GopCursor:
+        key = (path, offset, length, os.stat(path).st_mtime_ns)
+        evicted = []
+        # create under the lock so concurrent misses share one cursor instead
+        # of overwriting (and leaking) each other's open container
+        with self._lock:
+            cursor = self._cursors.get(key)
+            if cursor is not None:
+                self._cursors.move_to_end(key)
+                return cursor
+            cursor = GopCursor(path, offset, length, self.keep_frames)
+            self._cursors[key] = cursor
+            while len(self._cursors) > self.max_cursors:
+                evicted.append(self._cursors.popitem(last=False)[1])
+        for old in evicted:
+            with old.lock:
+                old.close()
+        return cursor
+
+    def extract_jpeg(self, path: str, offset: int, length: Optional[int], seconds: float,
+                     quality: int = 85) -> Optional[bytes]:
+        """Decode the frame `seconds` into a segment and return it as JPEG
+        (None if the segment has no decodable frame). Blocking: run in a
+        worker thread.
+        """
+        cursor = self._cursor(path, offset, length)
+        with cursor.lock:
+            if cursor.closed:
+                # evicted by a concurrent request; use a private decoder
+                cursor = GopCursor(path, offset, length, self.keep_frames)
+                try:
+                    frame = cursor.frame_at(seconds)
+                    image = frame.to_ndarray(format="bgr24") if frame is not None else None
+                finally:
+                    cursor.close()
+            else:
+                frame = cursor.frame_at(seconds)
+                image = frame.to_ndarray(format="bgr24") if frame is not None else None
+        if image is None:
+            return None
+        ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise RuntimeError("Failed to encode frame as JPEG")
+        return buf.tobytes()
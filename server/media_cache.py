@@ -0,0 +1,129 @@
+"""In-memory cache for hot media files.
+
+Every viewer of a live stream asks for the same few newest segments and
+playlists. `MediaCache` keeps them in a byte-budgeted LRU so repeated
+requests never touch the disk, and collapses concurrent misses on the same
+file into a single read (single-flight). Closed segments are pushed in
+from the recorder's segment-completion event before anyone asks for them.
+"""
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import anyio
+
+from utils.logger import getLogger
+
+
+logger = getLogger("server.media_cache")
+
+# (path, offset, length, mtime_ns, file size): a file that changes on disk gets a new key
+CacheKey = tuple[str, int, int, int, int]
+
+
+def _read(path: str, offset: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+class MediaCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: "OrderedDict[CacheKey, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # single-flight futures; only touched from the event loop thread
+        self._inflight: dict[CacheKey, asyncio.Future] = {}
+        self._prefill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-cache")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(path: str, offset: int, length: Optional[int]) -> Optional[CacheKey]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if length is None:
+            length = st.st_size - offset
+        return (path, offset, length, st.st_mtime_ns, st.st_size)
+
+    def _lookup(self, key: CacheKey) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return data
+
+    def _store(self, key: CacheKey, data: bytes):
+        if len(data) > self.max_entry_bytes or len(data) != key[2]:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            # drop older versions of the same region (a rewritten file may have a different length)
+            for stale in [k for k in self._entries if k[:2] == key[:2]]:
+                self._size -= len(self._entries.pop(stale))
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    async def get(self, path: str, offset: int = 0, length: Optional[int] = None, populate: bool = True) -> Optional[bytes]:
+        """Return the region's bytes from memory, reading it once on a miss.
+
+        With `populate=False` only a cache hit is returned (cold archive
+        reads should stream from disk instead of evicting hot entries).
+        Returns None when the caller should fall back to streaming from disk.
+        """
+        key = self._key(path, offset, length)
+        if key is None:
+            return None
+        data = self._lookup(key)
+        if data is not None or not populate or key[2] > self.max_entry_bytes:
+            return data
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        data = None
+        try:
+            data = await anyio.to_thread.run_sync(_read, path, offset, key[2])
+            self._store(key, data)
+        except OSError:
+            logger.debug("Cache read failed for %s", path, exc_info=True)
+        finally:
+            del self._inflight[key]
+            # waiters fall back to disk on None
+            future.set_result(data)
+        return data
+
+    def prefill(self, path: str):
+        """Schedule a background read of a just-closed file into the cache."""
+        def _task():
+            key = self._key(path, 0, None)
+            if key is None:
+                return
+            with self._lock:
+                if key in self._entries:
+                    return
+            try:
+                self._store(key, _read(path, 0, key[2]))
+            except OSError:
+                logger.debug("Cache prefill failed for %s", path, exc_info=True)
+        self._prefill_executor.submit(_task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
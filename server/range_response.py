@@ -1,74 +1,259 @@
 import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
 from typing import BinaryIO
 
-from fastapi import HTTPException, Request, status
-from fastapi.responses import StreamingResponse
+import anyio
+from fastapi import Request, status
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
 
 
-def send_bytes_range_requests(
-    file_obj: BinaryIO, start: int, end: int, chunk_size: int = 10_000
-):
-    """Send a file in chunks using Range Requests specification RFC7233
+# Bytes read per worker-thread hop; a 2 MB segment needs only one or two hops
+READ_CHUNK_SIZE = 1024 * 1024
 
-    `start` and `end` parameters are inclusive due to specification
-    """
-    with file_obj as f:
-        f.seek(start)
-        while (pos := f.tell()) <= end:
-            read_size = min(chunk_size, end + 1 - pos)
-            yield f.read(read_size)
+
+class RangeNotSatisfiable(Exception):
+    pass
 
 
-def _get_range_header(range_header: str, file_size: int) -> tuple[int, int]:
-    def _invalid_range():
-        return HTTPException(
-            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-            detail=f"Invalid request range (Range:{range_header!r})",
-        )
+def _parse_range_header(range_header: str, file_size: int) -> list[tuple[int, int]]:
+    """Parse a Range header (RFC 7233) into a sorted list of merged,
+    inclusive (start, end) ranges. Unsatisfiable parts are dropped; if none
+    remain RangeNotSatisfiable is raised.
+    """
+    unit, sep, spec = range_header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        raise RangeNotSatisfiable()
 
+    ranges = []
     try:
-        h = range_header.replace("bytes=", "").split("-")
-        start = int(h[0]) if h[0] != "" else 0
-        end = int(h[1]) if h[1] != "" else file_size - 1
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            start_s, dash, end_s = part.partition("-")
+            if not dash:
+                raise RangeNotSatisfiable()
+            if start_s.strip() == "":
+                # suffix range: last N bytes
+                suffix = int(end_s)
+                if suffix <= 0:
+                    continue
+                start, end = max(0, file_size - suffix), file_size - 1
+            else:
+                start = int(start_s)
+                end = int(end_s) if end_s.strip() else file_size - 1
+                end = min(end, file_size - 1)
+            if start < 0 or start > end or start >= file_size:
+                continue
+            ranges.append((start, end))
     except ValueError:
-        raise _invalid_range()
+        raise RangeNotSatisfiable()
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _read_region(f: BinaryIO, pos: int, size: int) -> bytes:
+    f.seek(pos)
+    return f.read(size)
+
+
+class MediaFileResponse(Response):
+    """Serve a byte region of a file with ETag/Last-Modified validators,
+    304 handling, If-Range, and single or multipart byte ranges.
+
+    When `data` holds the region's bytes (from the media cache) the body is
+    sliced from memory. Otherwise, if the ASGI server advertises the
+    `http.response.zerocopysend` extension, the body is handed over as a
+    file descriptor (sendfile); failing that it is read in large chunks in
+    a worker thread.
+    """
+
+    def __init__(self, request: Request, file_path: str, content_type: str,
+                 offset: int = 0, length: int | None = None, immutable: bool = False,
+                 data: bytes | None = None):
+        super().__init__(status_code=status.HTTP_200_OK)
+        self.request = request
+        self.file_path = file_path
+        self.content_type = content_type
+        st = os.stat(file_path)
+        self.offset = offset
+        self.data = data
+        if data is not None:
+            self.size = len(data)
+        else:
+            self.size = st.st_size - offset if length is None else length
+        self.mtime = st.st_mtime
+        self.etag = f'"{st.st_mtime_ns:x}-{self.size:x}-{offset:x}"'
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.immutable = immutable
 
-    if start > end or start < 0 or end > file_size - 1:
-        raise _invalid_range()
-    return start, end
+    def _base_headers(self) -> dict[str, str]:
+        return {
+            "accept-ranges": "bytes",
+            "etag": self.etag,
+            "last-modified": self.last_modified,
+            # only content that can never change is immutable; everything else is revalidated with the ETag
+            "cache-control": "public, max-age=31536000, immutable" if self.immutable else "no-cache",
+            "access-control-expose-headers": (
+                "content-type, accept-ranges, content-length, "
+                "content-range, content-encoding, etag, last-modified"
+            ),
+        }
+
+    def _not_modified(self) -> bool:
+        headers = self.request.headers
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags or f"W/{self.etag}" in tags
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return int(self.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _range_applies(self) -> bool:
+        """If-Range: only honor Range when the validator still matches"""
+        if_range = self.request.headers.get("if-range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == self.etag
+        return if_range == self.last_modified
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        headers = self._base_headers()
+        send_body = scope.get("method", "GET").upper() != "HEAD"
+
+        if self._not_modified():
+            await self._start(send, status.HTTP_304_NOT_MODIFIED, headers)
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        range_header = self.request.headers.get("range")
+        ranges = None
+        if range_header is not None and self._range_applies():
+            try:
+                ranges = _parse_range_header(range_header, self.size)
+            except RangeNotSatisfiable:
+                headers["content-range"] = f"bytes */{self.size}"
+                headers["content-length"] = "0"
+                await self._start(send, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers)
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+        if not ranges:
+            headers["content-type"] = self.content_type
+            headers["content-length"] = str(self.size)
+            await self._start(send, status.HTTP_200_OK, headers)
+            await self._send_regions(scope, send, [(None, 0, self.size - 1)], send_body)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers["content-type"] = self.content_type
+            headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+            headers["content-length"] = str(end - start + 1)
+            await self._start(send, status.HTTP_206_PARTIAL_CONTENT, headers)
+            await self._send_regions(scope, send, [(None, start, end)], send_body)
+            return
+
+        # multipart/byteranges
+        boundary = uuid.uuid4().hex
+        parts = []
+        total = 0
+        for start, end in ranges:
+            part_header = (
+                f"--{boundary}\r\n"
+                f"content-type: {self.content_type}\r\n"
+                f"content-range: bytes {start}-{end}/{self.size}\r\n\r\n"
+            ).encode("latin-1")
+            parts.append((part_header, start, end))
+            total += len(part_header) + (end - start + 1) + 2
+        trailer = f"--{boundary}--\r\n".encode("latin-1")
+        total += len(trailer)
+        headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["content-length"] = str(total)
+        await self._start(send, status.HTTP_206_PARTIAL_CONTENT, headers)
+        await self._send_regions(scope, send, parts, send_body, trailer=trailer)
+
+    async def _start(self, send: Send, status_code: int, headers: dict[str, str]):
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+        })
+
+    async def _send_regions(self, scope: Scope, send: Send, regions, send_body: bool, trailer: bytes = b""):
+        """Send (prefix, start, end) regions of the file; prefix/trailer are
+        multipart framing bytes (None for plain responses).
+        """
+        if not send_body:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if self.data is not None:
+            view = memoryview(self.data)
+            for prefix, start, end in regions:
+                body = bytes(view[start:end + 1])
+                if prefix:
+                    body = prefix + body + b"\r\n"
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+            await send({"type": "http.response.body", "body": trailer, "more_body": False})
+            return
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        with open(self.file_path, "rb") as f:
+            for prefix, start, end in regions:
+                if prefix:
+                    await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                pos = self.offset + start
+                remaining = end - start + 1
+                if zerocopy:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": pos,
+                        "count": remaining,
+                        "more_body": True,
+                    })
+                else:
+                    while remaining > 0:
+                        data = await anyio.to_thread.run_sync(_read_region, f, pos, min(READ_CHUNK_SIZE, remaining))
+                        if not data:
+                            break
+                        pos += len(data)
+                        remaining -= len(data)
+                        await send({"type": "http.response.body", "body": data, "more_body": True})
+                if prefix:
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+        await send({"type": "http.response.body", "body": trailer, "more_body": False})
 
 
 def RangeResponse(
-    request: Request, file_path: str, content_type: str = 'audio/mpeg'
+    request: Request, file_path: str, content_type: str = 'audio/mpeg',
+    offset: int = 0, length: int | None = None, immutable: bool = False,
+    data: bytes | None = None,
 ):
-    """Returns StreamingResponse using Range Requests of a given file"""
-
-    file_size = os.stat(file_path).st_size
-    range_header = request.headers.get("range")
-
-    headers = {
-        "content-type": content_type,
-        "accept-ranges": "bytes",
-        "content-encoding": "identity",
-        "content-length": str(file_size),
-        "access-control-expose-headers": (
-            "content-type, accept-ranges, content-length, "
-            "content-range, content-encoding"
-        ),
-    }
-    start = 0
-    end = file_size - 1
-    status_code = status.HTTP_200_OK
-
-    if range_header is not None:
-        start, end = _get_range_header(range_header, file_size)
-        size = end - start + 1
-        headers["content-length"] = str(size)
-        headers["content-range"] = f"bytes {start}-{end}/{file_size}"
-        status_code = status.HTTP_206_PARTIAL_CONTENT
-
-    return StreamingResponse(
-        send_bytes_range_requests(open(file_path, mode="rb"), start, end),
-        headers=headers,
-        status_code=status_code,
-    )
+    """Returns a MediaFileResponse for a given file
+
+    `offset` and `length` select a byte region of the file (e.g. a segment
+    inside a pack file); ranges are relative to that region. `immutable`
+    marks content that will never change (full storyboard sprites) as cacheable
+    forever. `data`, if given, is the region's content already in memory.
+    """
+    return MediaFileResponse(request, file_path, content_type, offset=offset, length=length,
+                             immutable=immutable, data=data)
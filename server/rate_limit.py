@@ -0,0 +1,206 @@
+"""Token-bucket rate limiting for the media and screenshot endpoints.
+
+Every client (keyed by its peer address, or by the X-Forwarded-For chain
+only when the peer is a configured trusted proxy) has a request bucket and a byte bucket, and all clients together share a global
+pair. A request needs one request token from both its own and the global
+bucket, and is refused while either byte bucket is in debt; response bytes
+are charged after they are sent (they are not known up front), so a large
+download pushes the client into debt and its next request waits until the
+debt is paid back. Refusals are 429 with Retry-After.
+
+All state is touched from the event loop thread only, so no locking.
+"""
+import math
+import time
+import typing
+from collections import OrderedDict
+
+from starlette.requests import HTTPConnection
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.logger import getLogger
+
+
+logger = getLogger("server.rate_limit")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float = 0.0) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now);
+        with amount 0 this is the time until the bucket is out of debt.
+        """
+        self._refill()
+        missing = amount - self.tokens if amount else -self.tokens
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float):
+        """Take tokens; the bucket may go into debt."""
+        self._refill()
+        self.tokens -= amount
+
+
+class ClientState:
+    def __init__(self, requests: typing.Optional[TokenBucket], bytes_: typing.Optional[TokenBucket]):
+        self.requests = requests
+        self.bytes = bytes_
+        self.allowed = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self.last_seen = time.time()
+
+
+class RateLimiter:
+    def __init__(self, client_rps: typing.Optional[float] = 20.0, client_burst: float = 40.0,
+                 client_bps: typing.Optional[float] = 16 * 1024 * 1024, client_burst_bytes: float = 32 * 1024 * 1024,
+                 global_rps: typing.Optional[float] = 100.0, global_burst: float = 200.0,
+                 global_bps: typing.Optional[float] = 64 * 1024 * 1024, global_burst_bytes: float = 128 * 1024 * 1024,
+                 max_clients: int = 1024):
+        """A None rate disables that bucket."""
+        self.client_rps, self.client_burst = client_rps, client_burst
+        self.client_bps, self.client_burst_bytes = client_bps, client_burst_bytes
+        self.global_requests = TokenBucket(global_rps, global_burst) if global_rps else None
+        self.global_bytes = TokenBucket(global_bps, global_burst_bytes) if global_bps else None
+        self.max_clients = max_clients
+        self.clients: "OrderedDict[str, ClientState]" = OrderedDict()
+        self.global_rejected = 0
+
+    def _client(self, client: str) -> ClientState:
+        state = self.clients.get(client)
+        if state is None:
+            state = ClientState(
+                TokenBucket(self.client_rps, self.client_burst) if self.client_rps else None,
+                TokenBucket(self.client_bps, self.client_burst_bytes) if self.client_bps else None,
+            )
+            self.clients[client] = state
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(client)
+        state.last_seen = time.time()
+        return state
+
+    def acquire(self, client: str) -> float:
+        """Admit one request. Returns 0 if allowed, else seconds to wait."""
+        state = self._client(client)
+        waits = [0.0]
+        if state.requests:
+            waits.append(state.requests.wait_time(1))
+        if state.bytes:
+            waits.append(state.bytes.wait_time())
+        client_wait = max(waits)
+        if self.global_requests:
+            waits.append(self.global_requests.wait_time(1))
+        if self.global_bytes:
+            waits.append(self.global_bytes.wait_time())
+        wait = max(waits)
+        if wait > 0:
+            state.rejected += 1
+            if client_wait <= 0:
+                self.global_rejected += 1
+            return wait
+        for bucket in (state.requests, self.global_requests):
+            if bucket:
+                bucket.consume(1)
+        state.allowed += 1
+        return 0.0
+
+    def charge_bytes(self, client: str, amount: int):
+        state = self.clients.get(client)
+        if state is not None:
+            state.bytes_sent += amount
+            if state.bytes:
+                state.bytes.consume(amount)
+        if self.global_bytes:
+            self.global_bytes.consume(amount)
+
+    def stats(self) -> dict:
+        return {
+            "global_rejected": self.global_rejected,
+            "clients": {
+                client: {
+                    "allowed": s.allowed,
+                    "rejected": s.rejected,
+                    "bytes_sent": s.bytes_sent,
+                    "last_seen": s.last_seen,
+                }
+                for client, s in self.clients.items()
+            },
+        }
+
+
+def client_key(conn: HTTPConnection, trusted_proxies: typing.Collection[str] = ()) -> str:
+    """Client address used as the bucket key.
+
+    X-Forwarded-For is client-controlled, so it is only honoured when the
+    peer is a trusted proxy; then the nearest hop that is not itself a
+    trusted proxy is the client.
+    """
+    peer = conn.client.host if conn.client and conn.client.host else None
+    if peer is None:
+        return "unknown"
+    if peer in trusted_proxies:
+        hops = [h.strip() for h in conn.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        for hop in reversed(hops):
+            if hop not in trusted_proxies:
+                return hop
+    return peer
+
+
+class RateLimitMiddleware:
+    """Pure ASGI middleware applying a RateLimiter to requests whose path
+    starts with one of `paths`.
+    """
+
+    def __init__(self, app: ASGIApp, limiter: RateLimiter, paths: typing.Optional[typing.List[str]] = None,
+                 trusted_proxies: typing.Optional[typing.Collection[str]] = None):
+        self.app = app
+        self.limiter = limiter
+        self.paths = paths or []
+        self.trusted_proxies = frozenset(trusted_proxies or ())
+        logger.info("RateLimitMiddleware initialized; paths=%s", self.paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ("http", "websocket") or not any(scope["path"].startswith(p) for p in self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        client = client_key(HTTPConnection(scope), self.trusted_proxies)
+        wait = self.limiter.acquire(client)
+        if wait > 0:
+            logger.debug("Rate limited %s on %s; retry after %.2fs", client, scope["path"], wait)
+            if scope["type"] == "websocket":
+                await send({"type": "websocket.close", "code": 1013, "reason": "Rate limit exceeded"})
+                return
+            response = JSONResponse(
+                status_code=429,
+                content={"error": "Rate limit exceeded"},
+                headers={"retry-after": str(max(1, math.ceil(wait))), "access-control-expose-headers": "retry-after"},
+            )
+            await response(scope, receive, send)
+            return
+
+        if scope["type"] == "websocket":
+            # live streams are long-lived by design; only the connection attempt is limited
+            await self.app(scope, receive, send)
+            return
+
+        async def counting_send(message: Message):
+            if message["type"] == "http.response.body":
+                self.limiter.charge_bytes(client, len(message.get("body", b"")))
+            elif message["type"] == "http.response.zerocopysend":
+                self.limiter.charge_bytes(client, message.get("count") or 0)
+            await send(message)
+
+        await self.app(scope, receive, counting_send)
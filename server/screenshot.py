@@ -0,0 +1,97 @@
+"""On-demand screenshots from the recorders' shared frame bus.
+
+Nothing is captured or encoded until a client asks: the newest frame a
+recorder already grabbed is encoded to JPEG or WebP (optionally scaled
+down) and the result is kept per frame, so any number of clients polling
+the same frame cost one encode. Each variant has an ETag derived from the
+frame sequence number, which lets unchanged frames be answered with 304
+before any encoding happens. Sequence numbers restart with every recorder
+instance, so keys and ETags also carry the frame bus epoch.
+"""
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import anyio
+import cv2
+
+from capture.frame_bus import Frame
+from utils.logger import getLogger
+
+
+logger = getLogger("server.screenshot")
+
+FORMATS = {
+    "jpeg": ("image/jpeg", ".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": ("image/webp", ".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+class ScreenshotKey(NamedTuple):
+    recorder: str
+    epoch: str
+    seq: int
+    fmt: str
+    width: int
+    quality: int
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.recorder}-{self.epoch}-{self.seq:x}-{self.fmt}-{self.width}-{self.quality}"'
+
+
+def _encode(image, fmt: str, width: int, quality: int) -> bytes:
+    height, src_width = image.shape[:2]
+    if width < src_width:
+        image = cv2.resize(image, (width, max(1, round(height * width / src_width))), interpolation=cv2.INTER_AREA)
+    _, ext, quality_flag = FORMATS[fmt]
+    ok, buf = cv2.imencode(ext, image, [quality_flag, quality])
+    if not ok:
+        raise RuntimeError(f"Failed to encode screenshot as {fmt}")
+    return buf.tobytes()
+
+
+class ScreenshotCache:
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[ScreenshotKey, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        # single-flight encodes; only touched from the event loop thread
+        self._inflight: dict[ScreenshotKey, asyncio.Future] = {}
+
+    @staticmethod
+    def key_for(recorder: str, frame: Frame, fmt: str, width: Optional[int], quality: int) -> ScreenshotKey:
+        src_width = frame.image.shape[1]
+        width = src_width if not width else min(width, src_width)
+        return ScreenshotKey(recorder, frame.epoch, frame.seq, fmt, width, quality)
+
+    async def get(self, key: ScreenshotKey, frame: Frame) -> bytes:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data = await anyio.to_thread.run_sync(_encode, frame.image, key.fmt, key.width, key.quality)
+        except Exception as e:
+            future.set_exception(e)
+            # mark retrieved so waiters-less failures are not reported as unhandled
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(data)
+        with self._lock:
+            self._entries[key] = data
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logger.debug("Encoded screenshot %s (%d bytes)", key, len(data))
+        return data
@@ -0,0 +1,143 @@
+"""Static file serving with precompressed variants and long-lived caching.
+
+`PrecompressedStaticFiles` is a drop-in `StaticFiles` that, for text-like
+assets, serves a `.br` or `.gz` sidecar chosen by `Accept-Encoding`.
+Sidecars produced at build time are used as-is; missing or stale ones are
+generated once in a background thread when the app starts (brotli only if
+the `brotli` package is installed). Content-hashed build outputs
+(`assets/name-<hash>.js`) are marked immutable; everything else, notably
+`index.html`, is revalidated with its ETag on every load.
+"""
+import gzip
+import os
+import re
+import threading
+from mimetypes import guess_type
+from typing import Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from utils.logger import getLogger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = getLogger("server.static_files")
+
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.mjs', '.css', '.json', '.map', '.svg', '.txt', '.wasm', '.xml', '.ico'}
+# smaller files gain nothing from compression
+MIN_COMPRESS_SIZE = 1024
+# vite emits assets/<name>-<8 char hash>.<ext>
+HASHED_ASSET_PATTERN = re.compile(r'(^|/)assets/.+[.-][A-Za-z0-9_-]{8}\.\w+$')
+# preferred order when the client accepts several
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(','):
+        token, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if token and q > 0:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def _is_stale(source: str, sidecar: str) -> bool:
+    try:
+        return os.stat(sidecar).st_mtime < os.stat(source).st_mtime
+    except OSError:
+        return True
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def precompress_directory(directory: str) -> int:
+    """Create missing or stale .gz/.br sidecars for compressible files.
+    Returns the number of sidecars written.
+    """
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            try:
+                if os.path.getsize(path) < MIN_COMPRESS_SIZE:
+                    continue
+                data = None
+                if _is_stale(path, path + '.gz'):
+                    data = open(path, 'rb').read()
+                    _write_atomic(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+                    written += 1
+                if brotli is not None and _is_stale(path, path + '.br'):
+                    data = data if data is not None else open(path, 'rb').read()
+                    _write_atomic(path + '.br', brotli.compress(data, quality=11))
+                    written += 1
+            except OSError as e:
+                logger.warning("Failed to precompress %s: %s", path, e)
+    return written
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def __init__(self, *args, precompress: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if precompress and self.directory is not None:
+            threading.Thread(target=self._precompress, daemon=True).start()
+
+    def _precompress(self):
+        written = precompress_directory(str(self.directory))
+        logger.info("Precompressed static assets in %s (%d files written, brotli=%s)",
+                    self.directory, written, brotli is not None)
+
+    @staticmethod
+    def _variant(full_path: str, request_headers: Headers) -> tuple[Optional[str], str, Optional[os.stat_result]]:
+        if os.path.splitext(full_path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            return None, full_path, None
+        accepted = _accepted_encodings(request_headers.get('accept-encoding', ''))
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            candidate = full_path + suffix
+            # a sidecar older than its source is stale (being regenerated)
+            if not _is_stale(full_path, candidate):
+                return encoding, candidate, os.stat(candidate)
+        return None, full_path, None
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        full_path = str(full_path)
+        request_headers = Headers(scope=scope)
+        encoding, served_path, served_stat = self._variant(full_path, request_headers)
+        media_type = guess_type(full_path)[0] or 'text/plain'
+        response = FileResponse(served_path, status_code=status_code, stat_result=served_stat or stat_result,
+                                media_type=media_type)
+        if encoding:
+            response.headers['content-encoding'] = encoding
+        if os.path.splitext(full_path)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            response.headers['vary'] = 'Accept-Encoding'
+        rel_path = os.path.relpath(full_path, str(self.directory)).replace(os.sep, '/')
+        if HASHED_ASSET_PATTERN.search(rel_path):
+            response.headers['cache-control'] = 'public, max-age=31536000, immutable'
+        else:
+            # index.html and other unhashed files: revalidate with ETag / Last-Modified
+            response.headers['cache-control'] = 'no-cache'
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,121 @@
+"""
+进程内事件总线
+录制器启动/停止、切片关闭、健康状态变化、报警增量等事件由任意线程 publish，
+同步监听者在发布线程中直接回调，异步订阅者（服务端 SSE 连接）通过各自事件循环的队列接收。
+每个事件带递增的 id，最近的事件保留在回放缓冲中，断线重连的客户端可按 Last-Event-ID 补齐
+"""
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+import asyncio
+import itertools
+import threading
+import time
+
+from utils.logger import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Event:
+    __slots__ = ('id', 'type', 'data', 'time')
+
+    def __init__(self, id: int, type: str, data: Any):
+        self.id = id
+        self.type = type
+        self.data = data
+        self.time = time.time()
+
+
+class EventSubscriber:
+    """一个异步订阅者；队列满时丢弃最旧的事件并标记 lagged，客户端应重新拉取完整状态"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_queue: int):
+        self.loop = loop
+        self.queue: Deque[Event] = deque(maxlen=max_queue)
+        self.lagged = False
+        self._ready = asyncio.Event()
+
+    def _push(self, event: Event):
+        # 在订阅者的事件循环中执行
+        if len(self.queue) == self.queue.maxlen:
+            self.lagged = True
+        self.queue.append(event)
+        self._ready.set()
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Event]:
+        """取下一个事件；超时返回 None"""
+        if not self.queue:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.popleft()
+
+
+class EventBus:
+    def __init__(self, replay_size: int = 256):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[Event], None]] = []
+        self._subscribers: List[EventSubscriber] = []
+        self._replay: Deque[Event] = deque(maxlen=replay_size)
+        self._last_id = 0
+
+    def publish(self, type: str, data: Any = None) -> Event:
+        with self._lock:
+            event = Event(next(self._ids), type, data)
+            self._last_id = event.id
+            self._replay.append(event)
+            listeners = list(self._listeners)
+            subscribers = list(self._subscribers)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception('Event listener failed for %s', type)
+        for sub in subscribers:
+            try:
+                sub.loop.call_soon_threadsafe(sub._push, event)
+            except RuntimeError:
+                # 事件循环已关闭
+                self.unsubscribe(sub)
+        return event
+
+    def add_listener(self, listener: Callable[[Event], None]):
+        """注册同步监听者，在发布线程中调用，应尽快返回"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop, last_event_id: Optional[int] = None,
+                  max_queue: int = 256) -> EventSubscriber:
+        """创建异步订阅者；给出 last_event_id 时先放入回放缓冲中之后的事件"""
+        sub = EventSubscriber(loop, max_queue)
+        with self._lock:
+            if last_event_id is not None:
+                missed = [e for e in self._replay if e.id > last_event_id]
+                if self._replay and self._replay[0].id > last_event_id + 1:
+                    # 回放缓冲已不包含全部错过的事件
+                    sub.lagged = True
+                elif last_event_id > self._last_id:
+                    # 比本进程发布过的任何事件都新：客户端的状态来自重启之前
+                    sub.lagged = True
+                for event in missed:
+                    sub._push(event)
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: EventSubscriber):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'listeners': len(self._listeners),
+                    'last_id': self._last_id}
+
+
+# 进程内共享的事件总线
+event_bus = EventBus()
@@ -0,0 +1,127 @@
+"""
+切片签名用的 Merkle 树工具
+叶子为 (切片编号, 切片加盐哈希)，每批切片只签名一次树根，并为每个切片生成包含证明，
+录制端 (capture.recorder) 与校验脚本 (utils.verify_signatures) 共用同一实现
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+# 叶子与内部节点使用不同前缀，防止把内部节点伪装成叶子
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = '.msig'
+
+
+def leaf_hash(segment_number: int, digest_hex: str) -> bytes:
+    """叶子哈希：绑定切片编号与切片内容哈希，防止切片被调换顺序"""
+    h = hashlib.sha1(LEAF_PREFIX)
+    h.update(segment_number.to_bytes(8, 'big'))
+    h.update(bytes.fromhex(digest_hex))
+    return h.digest()
+
+
+def _node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha1(NODE_PREFIX + left + right).digest()
+
+
+def build_levels(leaves: List[bytes]) -> List[List[bytes]]:
+    """自底向上构建整棵树，奇数个节点时最后一个直接提升到上一层"""
+    if not leaves:
+        raise ValueError('Merkle 树至少需要一个叶子')
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parent = [_node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parent.append(level[-1])
+        levels.append(parent)
+    return levels
+
+
+def inclusion_proof(levels: List[List[bytes]], index: int) -> List[Tuple[str, str]]:
+    """生成第 index 个叶子的包含证明: [(兄弟节点方位 'L'/'R', 兄弟节点哈希), ...]"""
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(('L' if sibling < index else 'R', level[sibling].hex()))
+        index //= 2
+    return proof
+
+
+def root_from_proof(leaf: bytes, proof: List[Tuple[str, str]]) -> bytes:
+    node = leaf
+    for side, sibling_hex in proof:
+        sibling = bytes.fromhex(sibling_hex)
+        node = _node_hash(sibling, node) if side == 'L' else _node_hash(node, sibling)
+    return node
+
+
+def sign_root(root: bytes, salt: bytes) -> str:
+    """对树根做与单切片签名相同方式的加盐 SHA-1"""
+    h = hashlib.sha1(salt)
+    h.update(root)
+    return h.hexdigest()
+
+
+def manifest_name(first: int, last: int, prefix: str = 'batch') -> str:
+    return f'{prefix}_{first}_{last}{MANIFEST_SUFFIX}'
+
+
+def build_manifest(digests: Dict[int, str], sid: str, salt: bytes) -> Dict:
+    """
+    为一批切片生成签名清单
+
+    Args:
+        digests: {切片编号: 切片加盐哈希}
+        sid: 会话 id
+        salt: 签名盐
+
+    Returns:
+        dict: 可直接 JSON 序列化的清单
+    """
+    numbers = sorted(digests)
+    levels = build_levels([leaf_hash(n, digests[n]) for n in numbers])
+    root = levels[-1][0]
+    return {
+        'version': MANIFEST_VERSION,
+        'sid': sid,
+        'segments': numbers,
+        'root': root.hex(),
+        'signature': sign_root(root, salt),
+        'proofs': {str(n): inclusion_proof(levels, i) for i, n in enumerate(numbers)},
+    }
+
+
+def write_manifest(folder: Path, manifest: Dict, prefix: str = 'batch') -> Path:
+    """先写临时文件再替换，避免校验方读到半个清单"""
+    segments = manifest['segments']
+    path = folder / manifest_name(segments[0], segments[-1], prefix)
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    tmp_path.write_text(json.dumps(manifest, separators=(',', ':')), encoding='utf-8')
+    tmp_path.replace(path)
+    return path
+
+
+def load_manifest(path: Path) -> Optional[Dict]:
+    try:
+        return parse_manifest(path.read_text(encoding='utf-8'))
+    except Exception:
+        return None
+
+
+def parse_manifest(text: str) -> Optional[Dict]:
+    try:
+        manifest = json.loads(text)
+    except Exception:
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    if not all(k in manifest for k in ('sid', 'segments', 'root', 'signature', 'proofs')):
+        return None
+    return manifest
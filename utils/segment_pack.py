@@ -0,0 +1,98 @@
+"""
+切片打包格式
+把一个已结束的归档子列表中的大量小 .ts 切片合并为一个 pack_<first>_<last>.pack 文件，
+并写入同名 .json 索引（每个切片的偏移/长度/修改时间，以及对应的 .sig 与 .msig 签名内容），
+服务端按索引做范围读取，校验脚本按索引读取切片计算哈希
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+import json
+import re
+
+
+PACK_VERSION = 1
+PACK_INDEX_PATTERN = re.compile(r'^pack_(\d+)_(\d+)\.json$')
+
+
+@dataclass(frozen=True)
+class PackedSegment:
+    """打包后切片在 pack 文件中的位置"""
+    number: int
+    pack_path: Path
+    offset: int
+    length: int
+    mtime: float
+
+    def iter_chunks(self, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        with open(self.pack_path, 'rb') as f:
+            f.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+
+def pack_name(first: int, last: int) -> str:
+    return f'pack_{first}_{last}.pack'
+
+
+def index_name(first: int, last: int) -> str:
+    return f'pack_{first}_{last}.json'
+
+
+def iter_pack_indexes(folder: Path) -> Iterator[Path]:
+    """按起始切片编号顺序列出目录中的打包索引"""
+    found = []
+    for path in Path(folder).glob('pack_*.json'):
+        m = PACK_INDEX_PATTERN.match(path.name)
+        if m:
+            found.append((int(m.group(1)), path))
+    for _, path in sorted(found):
+        yield path
+
+
+@lru_cache(maxsize=64)
+def _load_index_cached(path: str, mtime: float) -> Optional[Dict]:
+    try:
+        index = json.loads(Path(path).read_text(encoding='utf-8'))
+    except Exception:
+        return None
+    if not isinstance(index, dict) or index.get('version') != PACK_VERSION:
+        return None
+    return index
+
+
+def load_index(index_path: Path) -> Optional[Dict]:
+    """读取打包索引，索引文件不变时复用已解析结果"""
+    try:
+        mtime = index_path.stat().st_mtime
+    except OSError:
+        return None
+    return _load_index_cached(str(index_path), mtime)
+
+
+def packed_segments(index_path: Path) -> Dict[int, PackedSegment]:
+    index = load_index(index_path)
+    if not index:
+        return {}
+    pack_path = index_path.parent / index['pack']
+    return {
+        int(n): PackedSegment(int(n), pack_path, info['offset'], info['length'], info.get('mtime', 0.0))
+        for n, info in index['segments'].items()
+    }
+
+
+def find_packed_segment(folder: Path, number: int) -> Optional[PackedSegment]:
+    """查找某个切片所在的 pack，未打包时返回 None"""
+    for index_path in iter_pack_indexes(folder):
+        m = PACK_INDEX_PATTERN.match(index_path.name)
+        if m and int(m.group(1)) <= number <= int(m.group(2)):
+            segment = packed_segments(index_path).get(number)
+            if segment is not None:
+                return segment
+    return None
@@ -7,6 +7,9 @@
 1. 扫描 media 下每个 recorder 文件夹(按项目中实现为: media/<recorder_name>)，检查每 6 个 ts 文件至少有 1 个对应的 .sig 文件；如果缺失，输出 warning 并给出缺失文件编号范围和时间范围。
 2. 检查所有 .sig 文件中的 sid 字段是否一致，如果不一致输出 warning 列表。
 3. 对有签名的文件校验签名是否正确，如果不正确输出具体文件名。
+4. 对 Merkle 批量签名清单(batch_<first>_<last>.msig)先整批重建树根比对，只有树根不一致时才逐个切片用包含证明定位错误文件。
+5. 已被保留管理器打包的切片(pack_<first>_<last>.pack + .json 索引)与散落文件一样参与上述检查。
+6. 后台重编码过的切片先用重编码清单(reencode_<first>_<last>.msig)校验新文件，再用其中记录的原始哈希校验原始签名。
 
 """
 import sys
@@ -14,7 +17,14 @@ from pathlib import Path
 import hashlib
 import re
 import datetime
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Set
+
+try:
+    from utils import merkle, segment_pack
+except ImportError:  # 直接以脚本方式运行
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    from utils import merkle, segment_pack
+from utils.segment_pack import PackedSegment
 
 ROOT = Path(__file__).resolve().parents[1]
 MEDIA_DIR = ROOT / 'media'
@@ -24,19 +34,26 @@ SIG_PATTERN = re.compile(r'^(?P<hash>[0-9a-fA-F]{40})\+(?P<sid>.*)$')
 
 def load_sig(sig_path: Path) -> Optional[Tuple[str, str]]:
     try:
-        text = sig_path.read_text(encoding='utf-8').strip()
+        text = sig_path.read_text(encoding='utf-8')
     except Exception:
         return None
-    m = SIG_PATTERN.match(text)
+    return parse_sig(text)
+
+
+def parse_sig(text: str) -> Optional[Tuple[str, str]]:
+    m = SIG_PATTERN.match(text.strip())
     if not m:
         return None
     return m.group('hash'), m.group('sid')
 
 
+def signature_salt(sid: str) -> bytes:
+    return f"CkyfExamClient_video_signature_{sid}".encode('utf-8')
+
+
 def compute_hash_for_file(ts_path: Path, sid: str) -> str:
-    salt = f"CkyfExamClient_video_signature_{sid}"
     h = hashlib.sha1()
-    h.update(salt.encode('utf-8'))
+    h.update(signature_salt(sid))
     # read in chunks
     with open(ts_path, 'rb') as f:
         for chunk in iter(lambda: f.read(8192), b''):
@@ -44,6 +61,103 @@ def compute_hash_for_file(ts_path: Path, sid: str) -> str:
     return h.hexdigest()
 
 
+def compute_hash_for_segment(segment: PackedSegment, sid: str) -> str:
+    h = hashlib.sha1()
+    h.update(signature_salt(sid))
+    for chunk in segment.iter_chunks():
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def collect_folder(folder: Path) -> Tuple[Dict[int, PackedSegment], Dict[int, str], Dict[str, str]]:
+    """
+    汇总目录中的散落文件与打包数据。
+    Returns: (segments, sig_texts, manifest_texts)
+    散落的 ts 文件也表示为 offset=0 的 PackedSegment，便于统一读取
+    """
+    segments: Dict[int, PackedSegment] = {}
+    sig_texts: Dict[int, str] = {}
+    manifest_texts: Dict[str, str] = {}
+
+    for index_path in segment_pack.iter_pack_indexes(folder):
+        index = segment_pack.load_index(index_path)
+        if not index:
+            continue
+        segments.update(segment_pack.packed_segments(index_path))
+        sig_texts.update({int(n): text for n, text in index.get('sigs', {}).items()})
+        manifest_texts.update(index.get('manifests', {}))
+
+    for ts in folder.glob('video_*.ts'):
+        try:
+            idx = int(ts.stem.split('_')[1])
+        except (ValueError, IndexError):
+            continue
+        st = ts.stat()
+        segments[idx] = PackedSegment(idx, ts, 0, st.st_size, st.st_mtime)
+    for sig_path in folder.glob('video_*.sig'):
+        try:
+            idx = int(sig_path.stem.split('_')[1])
+            sig_texts[idx] = sig_path.read_text(encoding='utf-8')
+        except Exception:
+            continue
+    for manifest_path in folder.glob('*' + merkle.MANIFEST_SUFFIX):
+        try:
+            manifest_texts[manifest_path.name] = manifest_path.read_text(encoding='utf-8')
+        except Exception:
+            continue
+    return segments, sig_texts, manifest_texts
+
+
+def verify_manifest(name: str, text: str, segments: Dict[int, PackedSegment],
+                    digest_overrides: Optional[Dict[int, str]] = None) -> Tuple[List[str], Optional[str], Set[int], List[str]]:
+    """
+    校验一个 Merkle 批量签名清单。
+    digest_overrides: 已重编码切片的原始内容哈希，校验原始清单时代替对当前文件计算的哈希
+    Returns: (warnings, sid, covered_segments, bad_signatures)
+    """
+    warnings: List[str] = []
+    bad_signatures: List[str] = []
+    manifest = merkle.parse_manifest(text)
+    if not manifest:
+        warnings.append(f"无法解析签名清单: {name}")
+        return warnings, None, set(), bad_signatures
+
+    sid = manifest['sid']
+    salt = signature_salt(sid)
+    numbers = [int(n) for n in manifest['segments']]
+    if merkle.sign_root(bytes.fromhex(manifest['root']), salt) != manifest['signature']:
+        warnings.append(f"签名清单树根签名不正确: {name}")
+        return warnings, sid, set(), [f"video_{n}.ts" for n in numbers]
+
+    leaves = {}
+    for n in numbers:
+        if digest_overrides and n in digest_overrides:
+            leaves[n] = merkle.leaf_hash(n, digest_overrides[n])
+            continue
+        segment = segments.get(n)
+        if segment is None:
+            warnings.append(f"签名清单中的 ts 不存在: {name} -> video_{n}.ts")
+            continue
+        try:
+            leaves[n] = merkle.leaf_hash(n, compute_hash_for_segment(segment, sid))
+        except Exception as e:
+            warnings.append(f"计算文件哈希失败: video_{n}.ts, 错误: {e}")
+
+    # 整批重建树根：全部切片都在且树根一致时一次比对即可完成校验
+    if len(leaves) == len(numbers):
+        levels = merkle.build_levels([leaves[n] for n in numbers])
+        if levels[-1][0].hex() == manifest['root']:
+            return warnings, sid, set(numbers), bad_signatures
+
+    # 树根不一致或有切片缺失：用包含证明逐个定位
+    root = bytes.fromhex(manifest['root'])
+    for n, leaf in leaves.items():
+        proof = manifest['proofs'].get(str(n))
+        if proof is None or merkle.root_from_proof(leaf, proof) != root:
+            bad_signatures.append(f"video_{n}.ts")
+    return warnings, sid, set(numbers), bad_signatures
+
+
 def scan_recorder_folder(folder: Path) -> Tuple[List[str], List[str], List[str]]:
     """
     Scan one recorder folder.
@@ -59,22 +173,46 @@ def scan_recorder_folder(folder: Path) -> Tuple[List[str], List[str], List[str]]
     if not folder.exists() or not folder.is_dir():
         return warnings, sid_list, bad_signatures
 
-    # collect ts files and sig files
-    ts_files = sorted(folder.glob('video_*.ts'), key=lambda p: int(p.stem.split('_')[1]) if '_' in p.stem else -1)
-    sig_files = {p.stem: p for p in folder.glob('video_*.sig')}
-
-    # 连续扫描：连续 N 个（这里 N=6）没有签名则记录一个缺失区间，遇到签名则重置计数
+    # collect ts files and sig files (including packed ones)
+    segments, sig_texts, manifest_texts = collect_folder(folder)
+    ts_files = [segments[n] for n in sorted(segments)]
+
+    # Merkle 批量签名清单覆盖的切片视为已签名
+    merkle_covered: Set[int] = set()
+    # 先校验重编码清单，得到校验通过的重编码切片的原始哈希
+    original_digests: Dict[int, str] = {}
+    for name in sorted(n for n in manifest_texts if n.startswith('reencode_')):
+        m_warnings, sid, covered, bad = verify_manifest(name, manifest_texts[name], segments)
+        warnings.extend(m_warnings)
+        bad_signatures.extend(bad)
+        merkle_covered |= covered
+        manifest = merkle.parse_manifest(manifest_texts[name])
+        sources = manifest.get('sources', {}) if manifest else {}
+        for n in covered:
+            if f"video_{n}.ts" not in bad and str(n) in sources:
+                original_digests[n] = sources[str(n)]
+    batch_manifests = sorted(n for n in manifest_texts if not n.startswith('reencode_'))
+    for name in batch_manifests:
+        m_warnings, sid, covered, bad = verify_manifest(name, manifest_texts[name], segments, original_digests)
+        warnings.extend(m_warnings)
+        if sid is not None:
+            sid_list.append(sid)
+        merkle_covered |= covered
+        bad_signatures.extend(bad)
+
+    # 连续扫描：连续 N 个（这里 N=6）没有签名则记录一个缺失区间，遇到签名则重置计数。
+    # 批量签名会在录制结束时覆盖剩余切片，存在批量签名清单的目录不再容忍缺失，
+    # 每个未被覆盖的切片都要报告
     missing_ranges: List[Tuple[int, int, datetime.datetime, datetime.datetime]] = []
     if ts_files:
-        N = 6
+        N = 1 if batch_manifests else 6
         consec = 0
         range_start_idx = None
         range_start_time = None
 
         for ts in ts_files:
-            idx = int(ts.stem.split('_')[1])
-            sig_name = ts.with_suffix('.sig').stem
-            has_sig = sig_name in sig_files
+            idx = ts.number
+            has_sig = idx in sig_texts or idx in merkle_covered
 
             if not has_sig:
                 # 未签名
@@ -82,16 +220,16 @@ def scan_recorder_folder(folder: Path) -> Tuple[List[str], List[str], List[str]]
                 if consec == 1:
                     # 记录潜在区间开始
                     range_start_idx = idx
-                    range_start_time = datetime.datetime.fromtimestamp(ts.stat().st_mtime)
+                    range_start_time = datetime.datetime.fromtimestamp(ts.mtime)
 
                 # 如果达到了 N，则记录/开启缺失区间
                 if consec >= N:
                     # 结束索引为当前 idx
                     end_idx = idx
-                    end_time = datetime.datetime.fromtimestamp(ts.stat().st_mtime)
+                    end_time = datetime.datetime.fromtimestamp(ts.mtime)
                     # 确保 start 不为 None（兜底使用当前 idx/time）
                     s_idx = range_start_idx if range_start_idx is not None else idx
-                    s_time = range_start_time if range_start_time is not None else datetime.datetime.fromtimestamp(ts.stat().st_mtime)
+                    s_time = range_start_time if range_start_time is not None else datetime.datetime.fromtimestamp(ts.mtime)
                     # 如果上一个记录与当前相邻或重叠，会在后面合并
                     missing_ranges.append((s_idx, end_idx, s_time, end_time))
                     # 注意：不要在这里重置 range_start，因为如果后续继续未签名我们希望扩展上次记录；
@@ -126,29 +264,31 @@ def scan_recorder_folder(folder: Path) -> Tuple[List[str], List[str], List[str]]
                 )
 
     # gather sids and validate signatures
-    for sig_path in folder.glob('video_*.sig'):
-        sig_info = load_sig(sig_path)
+    for idx, text in sig_texts.items():
+        sig_name = f"video_{idx}.sig"
+        sig_info = parse_sig(text)
         if not sig_info:
-            warnings.append(f"无法解析签名文件: {sig_path.name}")
+            warnings.append(f"无法解析签名文件: {sig_name}")
             continue
         hash_value, sid = sig_info
         sid_list.append(sid)
 
-        ts_candidate = folder / (sig_path.stem + '.ts')
-        if not ts_candidate.exists():
-            warnings.append(f"签名文件但对应 ts 不存在: {sig_path.name}")
+        segment = segments.get(idx)
+        if segment is None:
+            warnings.append(f"签名文件但对应 ts 不存在: {sig_name}")
             continue
 
         # compute and compare
         try:
-            computed = compute_hash_for_file(ts_candidate, sid)
+            computed = compute_hash_for_segment(segment, sid)
         except Exception as e:
-            warnings.append(f"计算文件哈希失败: {ts_candidate.name}, 错误: {e}")
+            warnings.append(f"计算文件哈希失败: video_{idx}.ts, 错误: {e}")
             continue
         if computed.lower() != hash_value.lower():
-            bad_signatures.append(ts_candidate.name)
+            bad_signatures.append(f"video_{idx}.ts")
 
-    return warnings, sid_list, bad_signatures
+    # 同一文件可能同时被多个清单判定错误，去重后返回
+    return warnings, sid_list, list(dict.fromkeys(bad_signatures))
 
 
 def main() -> int:
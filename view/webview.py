@@ -1,4 +1,4 @@
-from threading import Thread
+from threading import Thread, Event
 import time
 
 import webview
@@ -8,10 +8,12 @@ import json
 
 from monitors.reporter import MonitorReporter
 from server.app import run_server
-from capture.service import health, start_screen_recording, start_camera_recording
+from capture.service import health, start_screen_recording, start_camera_recording, uploader
 from capture.camera_capture import get_available_cameras
 from capture.screen_capture import get_available_monitors
+from config import upload_path
 from utils.cookie import session_to_cookie_string
+from utils.event_bus import event_bus
 from utils.logger import getLogger
 
 logger = getLogger("webview")
@@ -90,6 +92,7 @@ class JsApi:
                 print(e.response.text)
                 return {'success': False, 'error': f'登录失败: {e}'}
         self.reporter.start()
+        uploader.configure(f'http://{endpoint}{upload_path}', self.reporter.get_cookies())
         return {'success': True}
     
     def getAvailableDevices(self):
@@ -143,6 +146,24 @@ class JsApi:
     
 jsApi = JsApi()
 
+def _return_to_capture_if_unhealthy(window_obj):
+    try:
+        current_url = window_obj.get_current_url()
+
+        parsed = urlparse(current_url)
+        host = f"{parsed.hostname}:{parsed.port}" if parsed.port else (parsed.hostname or '')
+        if not host == 'localhost:34519':
+            if not health():
+                window_obj.load_url('http://localhost:34519/index.html#/captrue/')
+    except Exception:
+        logger.error("Failed to check health or URL", exc_info=True)
+
+
+# Set by the health listener (on the publisher's thread) to wake the injector
+# thread, which does the window calls itself.
+_unhealthy = Event()
+
+
 def _periodic_injector(window_obj, js_api=None, interval=10):
     time.sleep(10)
     while True:
@@ -158,24 +179,20 @@ def _periodic_injector(window_obj, js_api=None, interval=10):
             except Exception:
                 logger.error("Failed to inject script", exc_info=True)
 
-            time.sleep(5)
-            try:
-                current_url = window_obj.get_current_url()
-                
-                parsed = urlparse(current_url)
-                host = f"{parsed.hostname}:{parsed.port}" if parsed.port else (parsed.hostname or '')
-                if not host == 'localhost:34519':
-                    if not health():
-                        window_obj.load_url('http://localhost:34519/index.html#/captrue/')
-            except Exception:
-                logger.error("Failed to check health or URL", exc_info=True)
+            # an unhealthy event cuts the wait short so the check runs right away
+            for timeout in (5, interval - 5):
+                _unhealthy.wait(timeout)
+                _unhealthy.clear()
+                _return_to_capture_if_unhealthy(window_obj)
         except Exception:
             logger.error("Exception in periodic injector", exc_info=True)
-        time.sleep(interval - 5)
+            time.sleep(interval)
 
 
 window = webview.create_window('长空御风考试客户端', 'http://localhost:34519/', js_api=jsApi, width=1280, height=800)
 injector_thread = Thread(target=_periodic_injector, args=(window, jsApi), daemon=True)
 injector_thread.start()
+# 录制异常时立即返回录制页面，不必等待下一次定时检查；监听者在发布者线程中调用，只唤醒注入线程
+event_bus.add_listener(lambda e: e.type == 'health' and not e.data['ok'] and _unhealthy.set())
 
 webview.start(debug=True)